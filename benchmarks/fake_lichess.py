@@ -0,0 +1,499 @@
+"""
+Fake Lichess API server, to run and load test the bot and the web app offline. Point them at it with
+LICHESS_URL=http://127.0.0.1:8085 in .env.
+
+Serves the parts of the API the bot and the web app use:
+- /api/user/{username} and POST /api/users: users with ratings derived from their name
+- /game/export/{id}: games replayed from recordings
+- /api/stream/game/{id}: NDJSON stream of the moves of a replayed game
+- /oauth, POST /api/token and /api/account: an OAuth flow that always authorizes the account named by --account, or
+  by the username query parameter of /oauth
+
+Games are replayed from a PGN file, such as a Lichess database export, or from random games when no file is given.
+A game starts when its id is first looked up, and its moves follow at the times of their [%clk] comments, or every
+--move-time seconds, sped up by --speed. Ids that are not in the recordings are assigned one of them, so any id of 8
+characters can be watched. Users and games whose name or id starts with 'missing' are not found.
+
+Faults can be injected in every API request: latency, 429 responses (with a Retry-After header), 503 responses, and
+streams that disconnect. GET /_fake/stats returns the number of requests per endpoint and the injected faults, and
+POST /_fake/config changes the faults while the server runs, e.g. {"rate_limit": 0.1}.
+
+Usage: python benchmarks/fake_lichess.py [--port 8085] [--pgn games.pgn] [--speed 10] [--latency 0.05]
+                                         [--rate-limit 0.01] [--errors 0.01] [--disconnect 0.001]
+"""
+import argparse
+import asyncio
+import bisect
+import hashlib
+import json
+import random
+import secrets
+import time
+from collections import Counter
+from typing import Any
+
+import chess
+import chess.pgn
+from aiohttp import web
+
+STATUS_IDS = {'created': 10, 'started': 20, 'aborted': 25, 'mate': 30, 'resign': 31, 'stalemate': 32, 'timeout': 33,
+              'draw': 34, 'outoftime': 35}
+KEEP_ALIVE = 7.0  # Seconds after which an idle stream sends an empty line, like Lichess does
+
+
+class Recording:
+    """
+    Positions and clocks of a recorded game, with the time of every move since the start of the game
+    """
+
+    def __init__(self, game_id: str, white: str, black: str, white_rating: int, black_rating: int, initial: int,
+                 increment: int, plies: list[dict], times: list[float], status: str, winner: str | None):
+        self.game_id = game_id
+        self.white = white
+        self.black = black
+        self.white_rating = white_rating
+        self.black_rating = black_rating
+        self.initial = initial
+        self.increment = increment
+        self.plies = plies  # {fen, lm, wc, bc, san} after every move
+        self.times = times  # Seconds from the start of the game to every move, at normal speed
+        self.status = status
+        self.winner = winner
+
+    @property
+    def speed(self) -> str:
+        estimate = self.initial + 40 * self.increment
+        for limit, speed in ((30, 'ultraBullet'), (180, 'bullet'), (480, 'blitz'), (1500, 'rapid')):
+            if estimate < limit:
+                return speed
+        return 'classical'
+
+
+def _ply(board: chess.Board, move: chess.Move, clocks: list[float]) -> dict:
+    return {'fen': ' '.join(board.fen().split()[:2]), 'lm': move.uci(), 'wc': int(clocks[0]), 'bc': int(clocks[1])}
+
+
+def _result(board: chess.Board, result: str) -> tuple[str, str | None]:
+    """
+    Status and winner of a game that ended in the position, with the result in PGN notation
+    """
+    outcome = board.outcome()
+    if outcome is not None and outcome.termination == chess.Termination.CHECKMATE:
+        return 'mate', 'white' if outcome.winner else 'black'
+    if outcome is not None and outcome.termination == chess.Termination.STALEMATE:
+        return 'stalemate', None
+    return {'1-0': ('resign', 'white'), '0-1': ('resign', 'black')}.get(result, ('draw', None))
+
+
+def read_recordings(path: str, move_time: float) -> list[Recording]:
+    """
+    Games of a PGN file. Moves without a [%clk] comment take move_time seconds.
+    """
+    recordings = []
+    with open(path) as f:
+        while (game := chess.pgn.read_game(f)) is not None:
+            headers = game.headers
+            try:
+                initial, increment = (int(part) for part in headers.get('TimeControl', '180+2').split('+'))
+            except ValueError:  # Correspondence games have no time control
+                initial, increment = 180, 2
+            board = game.board()
+            clocks = [float(initial), float(initial)]
+            plies, times, elapsed = [], [], 0.0
+            for node in game.mainline():
+                mover = 0 if board.turn == chess.WHITE else 1
+                board.push(node.move)
+                clock = node.clock()
+                if clock is None:
+                    clock = max(0.0, clocks[mover] - move_time + increment)
+                elapsed += max(0.1, clocks[mover] + increment - clock)
+                clocks[mover] = clock
+                plies.append(_ply(board, node.move, clocks) | {'san': node.san()})
+                times.append(elapsed)
+            site = headers.get('Site', '')
+            game_id = site.rsplit('/', 1)[-1] if site.startswith('https://lichess.org/') else secrets.token_hex(4)
+            status, winner = _result(board, headers.get('Result', '*'))
+            recordings.append(Recording(game_id, headers.get('White', 'white'), headers.get('Black', 'black'),
+                                        int(headers.get('WhiteElo', '1500').strip('?') or 1500),
+                                        int(headers.get('BlackElo', '1500').strip('?') or 1500),
+                                        initial, increment, plies, times, status, winner))
+    return recordings
+
+
+def random_recordings(n: int, move_time: float, seed: int = 0) -> list[Recording]:
+    """
+    Random 3+2 games of up to 120 plies, with moves that take up to twice move_time seconds
+    """
+    rng = random.Random(seed)
+    recordings = []
+    for i in range(n):
+        board = chess.Board()
+        clocks = [180.0, 180.0]
+        plies, times, elapsed = [], [], 0.0
+        for _ in range(rng.randint(20, 120)):
+            if board.is_game_over():
+                break
+            mover = 0 if board.turn == chess.WHITE else 1
+            move = rng.choice(list(board.legal_moves))
+            san = board.san(move)
+            board.push(move)
+            spent = rng.uniform(0.1, 2 * move_time)
+            clocks[mover] = max(0.0, clocks[mover] - spent + 2)
+            elapsed += spent
+            plies.append(_ply(board, move, clocks) | {'san': san})
+            times.append(elapsed)
+        status, winner = _result(board, rng.choice(('1-0', '0-1', '1/2-1/2')))
+        recordings.append(Recording(f'rand{i:04d}', f'player{rng.randrange(10000)}', f'player{rng.randrange(10000)}',
+                                    rng.randint(800, 2800), rng.randint(800, 2800), 180, 2, plies, times, status,
+                                    winner))
+    return recordings
+
+
+class Replay:
+    """
+    A recorded game played under some game id, that started at some time
+    """
+
+    def __init__(self, game_id: str, recording: Recording, started_at: float, speed: float):
+        self.game_id = game_id
+        self.recording = recording
+        self.started_at = started_at  # Unix time
+        self.times = [started_at + t / speed for t in recording.times]  # Unix time of every move
+
+    def plies_at(self, now: float) -> int:
+        return bisect.bisect_right(self.times, now)
+
+    def finished(self, now: float) -> bool:
+        return self.plies_at(now) == len(self.times)
+
+    def status(self, now: float) -> str:
+        return self.recording.status if self.finished(now) else 'started'
+
+    def fen(self, plies: int) -> str:
+        """
+        Full FEN after the number of plies
+        """
+        if plies == 0:
+            return chess.STARTING_FEN
+        board_fen, turn = self.recording.plies[plies - 1]['fen'].split()
+        return f'{board_fen} {turn} - - 0 {plies // 2 + 1}'
+
+    def player(self, color: str, finished: bool) -> dict:
+        rec = self.recording
+        name, rating = (rec.white, rec.white_rating) if color == 'white' else (rec.black, rec.black_rating)
+        player = {'user': {'name': name, 'id': name.lower()}, 'rating': rating}
+        if finished:
+            player['ratingDiff'] = 0 if rec.winner is None else (6 if rec.winner == color else -6)
+        return player
+
+    def export(self, now: float) -> dict:
+        """
+        The game as returned by /game/export/{id}
+        """
+        rec = self.recording
+        plies = self.plies_at(now)
+        finished = plies == len(self.times)
+        game = {'id': self.game_id, 'rated': True, 'variant': 'standard', 'speed': rec.speed, 'perf': rec.speed,
+                'createdAt': int(self.started_at * 1000),
+                'lastMoveAt': int((self.times[plies - 1] if plies else self.started_at) * 1000),
+                'status': self.status(now),
+                'players': {color: self.player(color, finished) for color in ('white', 'black')},
+                'moves': ' '.join(ply['san'] for ply in rec.plies[:plies]),
+                'clock': {'initial': rec.initial, 'increment': rec.increment,
+                          'totalTime': rec.initial + 40 * rec.increment}}
+        if finished and rec.winner is not None:
+            game['winner'] = rec.winner
+        return game
+
+    def summary(self, now: float) -> dict:
+        """
+        The game as sent at the start and the end of the stream of the game
+        """
+        plies = self.plies_at(now)
+        rec = self.recording
+        status = self.status(now)
+        summary = {'id': self.game_id, 'variant': {'key': 'standard', 'name': 'Standard', 'short': 'Std'},
+                   'speed': rec.speed, 'perf': {'name': rec.speed.capitalize()}, 'rated': True,
+                   'initialFen': 'startpos', 'fen': self.fen(plies), 'player': 'white' if plies % 2 == 0 else 'black',
+                   'turns': plies, 'startedAtTurn': 0, 'source': 'pool',
+                   'status': {'id': STATUS_IDS[status], 'name': status}, 'createdAt': int(self.started_at * 1000),
+                   'players': {color: self.player(color, status != 'started') for color in ('white', 'black')}}
+        if plies:
+            summary['lastMove'] = rec.plies[plies - 1]['lm']
+        if status != 'started' and rec.winner is not None:
+            summary['winner'] = rec.winner
+        return summary
+
+    def initial_event(self) -> dict:
+        """
+        The position before the first move, with full clocks
+        """
+        return {'fen': ' '.join(chess.STARTING_FEN.split()[:2]), 'wc': self.recording.initial,
+                'bc': self.recording.initial}
+
+    def move_event(self, ply: int) -> dict:
+        return {key: value for key, value in self.recording.plies[ply].items() if key != 'san'}
+
+class Faults:
+    def __init__(self, latency: float = 0.0, jitter: float = 0.0, rate_limit: float = 0.0, retry_after: int = 60,
+                 errors: float = 0.0, disconnect: float = 0.0):
+        """
+        @param latency: seconds added to every request
+        @param jitter: maximum random seconds added on top of the latency
+        @param rate_limit: fraction of requests answered with a 429
+        @param retry_after: seconds of the Retry-After header of a 429
+        @param errors: fraction of requests answered with a 503
+        @param disconnect: probability that a stream disconnects after sending a line
+        """
+        self.latency = latency
+        self.jitter = jitter
+        self.rate_limit = rate_limit
+        self.retry_after = retry_after
+        self.errors = errors
+        self.disconnect = disconnect
+
+    def update(self, values: dict[str, Any]) -> None:
+        for name, value in values.items():
+            if name not in vars(self):
+                raise ValueError(f'Unknown fault: {name}')
+            setattr(self, name, type(getattr(self, name))(value))
+
+
+class FakeLichess:
+    def __init__(self, recordings: list[Recording], speed: float = 1.0, faults: Faults | None = None,
+                 account: str = 'fakeuser', finished_ratio: float = 0.0, seed: int | None = None):
+        """
+        @param speed: factor by which replays are sped up
+        @param account: username of the account that /oauth authorizes by default
+        @param finished_ratio: fraction of games that have already finished when they are first looked up
+        """
+        self.recordings = recordings
+        self.speed = speed
+        self.faults = faults if faults is not None else Faults()
+        self.account = account
+        self.finished_ratio = finished_ratio
+        self.rng = random.Random(seed)
+        self.replays: dict[str, Replay] = {}
+        self.codes: dict[str, str] = {}  # Authorization code to username
+        self.tokens: dict[str, str] = {}  # Access token to username
+        self.requests: Counter[str] = Counter()
+        self.faults_injected: Counter[str] = Counter()
+        self.open_streams = 0
+        self._by_id = {recording.game_id: recording for recording in recordings}
+
+    def app(self) -> web.Application:
+        app = web.Application(middlewares=[self._inject_faults])
+        app.router.add_get('/api/user/{username}', self._user)
+        app.router.add_post('/api/users', self._users)
+        app.router.add_get('/game/export/{game_id}', self._game_export)
+        app.router.add_get('/api/stream/game/{game_id}', self._stream_game)
+        app.router.add_get('/oauth', self._oauth)
+        app.router.add_post('/api/token', self._token)
+        app.router.add_get('/api/account', self._account)
+        app.router.add_get('/_fake/stats', self._stats)
+        app.router.add_post('/_fake/config', self._config)
+        return app
+
+    @web.middleware
+    async def _inject_faults(self, request: web.Request, handler) -> web.StreamResponse:
+        route = request.match_info.route.resource.canonical if request.match_info.route.resource else 'unknown'
+        if route.startswith('/_fake/'):
+            return await handler(request)
+        self.requests[f'{request.method} {route}'] += 1
+        faults = self.faults
+        if faults.latency or faults.jitter:
+            await asyncio.sleep(faults.latency + self.rng.uniform(0, faults.jitter))
+        if self.rng.random() < faults.rate_limit:
+            self.faults_injected['429'] += 1
+            return web.json_response({'error': 'Too many requests. Try again later.'}, status=429,
+                                     headers={'Retry-After': str(faults.retry_after)})
+        if self.rng.random() < faults.errors:
+            self.faults_injected['503'] += 1
+            return web.json_response({'error': 'Service unavailable'}, status=503)
+        return await handler(request)
+
+    # Users
+
+    @staticmethod
+    def make_user(username: str) -> dict:
+        """
+        A user with ratings and counts that only depend on the username
+        """
+        rng = random.Random(hashlib.sha1(username.lower().encode()).digest())
+        now = int(time.time() * 1000)
+        perfs = {perf: {'games': rng.randint(0, 5000), 'rating': rng.randint(800, 2800), 'rd': rng.randint(45, 150),
+                        'prog': rng.randint(-50, 50)} for perf in ('bullet', 'blitz', 'rapid', 'classical',
+                                                                   'correspondence', 'puzzle')}
+        perfs['classical']['prov'] = True if perfs['classical']['games'] < 20 else None
+        perfs = {perf: {k: v for k, v in values.items() if v is not None} for perf, values in perfs.items()}
+        perfs['storm'] = {'runs': rng.randint(0, 500), 'score': rng.randint(0, 60)}
+        games = sum(perf['games'] for name, perf in perfs.items() if name not in ('puzzle', 'storm'))
+        wins = rng.randint(0, games)
+        return {'id': username.lower(), 'username': username, 'perfs': perfs,
+                'createdAt': now - rng.randint(1, 3000) * 86_400_000, 'seenAt': now - rng.randint(0, 30) * 86_400_000,
+                'playTime': {'total': games * rng.randint(60, 600), 'tv': 0},
+                'count': {'all': max(games, 1), 'rated': games, 'win': wins, 'loss': games - wins, 'draw': 0},
+                'profile': {'country': 'NL', 'bio': 'Fake Lichess user'}, 'url': f'https://lichess.org/@/{username}'}
+
+    async def _user(self, request: web.Request) -> web.Response:
+        username = request.match_info['username']
+        if username.lower().startswith('missing'):
+            return web.json_response({'error': 'Not found'}, status=404)
+        return web.json_response(self.make_user(username))
+
+    async def _users(self, request: web.Request) -> web.Response:
+        usernames = [name.strip() for name in (await request.text()).split(',') if name.strip()]
+        if len(usernames) > 300:
+            return web.json_response({'error': 'Too many ids'}, status=400)
+        return web.json_response([self.make_user(name) for name in usernames
+                                  if not name.lower().startswith('missing')])
+
+    # Games
+
+    def replay(self, game_id: str) -> Replay | None:
+        """
+        The replay of the game, which starts when it is first looked up
+        """
+        if game_id.lower().startswith('missing') or len(game_id) != 8:
+            return None
+        if (replay := self.replays.get(game_id)) is None:
+            recording = self._by_id.get(game_id)
+            if recording is None:
+                index = int.from_bytes(hashlib.sha1(game_id.encode()).digest()[:4], 'big')
+                recording = self.recordings[index % len(self.recordings)]
+            started_at = time.time()
+            if self.rng.random() < self.finished_ratio:
+                started_at -= recording.times[-1] / self.speed + 1 if recording.times else 1
+            replay = self.replays[game_id] = Replay(game_id, recording, started_at, self.speed)
+        return replay
+
+    async def _game_export(self, request: web.Request) -> web.Response:
+        if (replay := self.replay(request.match_info['game_id'])) is None:
+            return web.json_response({'error': 'Not found'}, status=404)
+        return web.json_response(replay.export(time.time()))
+
+    async def _send(self, request: web.Request, resp: web.StreamResponse, event: dict | None) -> bool:
+        """
+        Send an event, or an empty line for None
+        @return: False if the stream was disconnected, by the client or as an injected fault
+        """
+        try:
+            await resp.write(b'\n' if event is None else json.dumps(event).encode() + b'\n')
+        except ConnectionError:
+            return False
+        if self.rng.random() < self.faults.disconnect:
+            self.faults_injected['disconnect'] += 1
+            if request.transport is not None:
+                request.transport.close()
+            return False
+        return True
+
+    async def _open_stream(self, request: web.Request) -> web.StreamResponse:
+        resp = web.StreamResponse(headers={'Content-Type': 'application/x-ndjson'})
+        await resp.prepare(request)
+        return resp
+
+    async def _stream_game(self, request: web.Request) -> web.StreamResponse:
+        if (replay := self.replay(request.match_info['game_id'])) is None:
+            return web.json_response({'error': 'Not found'}, status=404)
+        resp = await self._open_stream(request)
+        self.open_streams += 1
+        try:
+            now = time.time()
+            if not await self._send(request, resp, replay.summary(now)):
+                return resp
+            # Like Lichess, replay the positions so far, from the initial position, before following the game
+            if not await self._send(request, resp, replay.initial_event()):
+                return resp
+            for ply in range(replay.plies_at(now)):
+                if not await self._send(request, resp, replay.move_event(ply)):
+                    return resp
+            ply = replay.plies_at(now)
+            while ply < len(replay.times):
+                delay = replay.times[ply] - time.time()
+                if delay > KEEP_ALIVE:
+                    await asyncio.sleep(KEEP_ALIVE)
+                    if not await self._send(request, resp, None):
+                        return resp
+                    continue
+                await asyncio.sleep(max(0.0, delay))
+                if not await self._send(request, resp, replay.move_event(ply)):
+                    return resp
+                ply += 1
+            await self._send(request, resp, replay.summary(time.time()))
+            return resp
+        finally:
+            self.open_streams -= 1
+
+    # OAuth
+
+    async def _oauth(self, request: web.Request) -> web.Response:
+        if (redirect_uri := request.query.get('redirect_uri')) is None:
+            return web.json_response({'error': 'Missing redirect_uri'}, status=400)
+        code = secrets.token_urlsafe(16)
+        self.codes[code] = request.query.get('username', self.account)
+        state = f'&state={request.query["state"]}' if 'state' in request.query else ''
+        raise web.HTTPFound(f'{redirect_uri}?code={code}{state}')
+
+    async def _token(self, request: web.Request) -> web.Response:
+        data = await request.json() if request.content_type == 'application/json' else await request.post()
+        if data.get('grant_type') != 'authorization_code' or (username := self.codes.pop(data.get('code'), None)) is None:
+            return web.json_response({'error': 'invalid_grant', 'error_description': 'Invalid authorization code'},
+                                     status=400)
+        token = f'lio_{secrets.token_urlsafe(24)}'
+        self.tokens[token] = username
+        return web.json_response({'token_type': 'Bearer', 'access_token': token, 'expires_in': 31536000})
+
+    async def _account(self, request: web.Request) -> web.Response:
+        token = request.headers.get('Authorization', '').removeprefix('Bearer ')
+        if (username := self.tokens.get(token)) is None:
+            return web.json_response({'error': 'No such token'}, status=401)
+        return web.json_response(self.make_user(username))
+
+    # Control
+
+    async def _stats(self, request: web.Request) -> web.Response:
+        return web.json_response({'requests': dict(self.requests), 'faults': dict(self.faults_injected),
+                                  'open_streams': self.open_streams, 'games': len(self.replays),
+                                  'config': vars(self.faults)})
+
+    async def _config(self, request: web.Request) -> web.Response:
+        try:
+            self.faults.update(await request.json())
+        except (ValueError, TypeError) as e:
+            return web.json_response({'error': str(e)}, status=400)
+        return web.json_response(vars(self.faults))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8085)
+    parser.add_argument('--pgn', help='PGN file of the games to replay, random games if not given')
+    parser.add_argument('--games', type=int, default=100, help='number of random games')
+    parser.add_argument('--speed', type=float, default=1., help='factor by which the games are sped up')
+    parser.add_argument('--move-time', type=float, default=2., help='seconds of a move without a [%%clk] comment')
+    parser.add_argument('--finished', type=float, default=0.,
+                        help='fraction of games that have already finished when they are first looked up')
+    parser.add_argument('--account', default='fakeuser', help='username of the account that /oauth authorizes')
+    parser.add_argument('--latency', type=float, default=0., help='seconds added to every request')
+    parser.add_argument('--jitter', type=float, default=0., help='maximum random seconds added to the latency')
+    parser.add_argument('--rate-limit', type=float, default=0., help='fraction of requests answered with a 429')
+    parser.add_argument('--retry-after', type=int, default=60, help='seconds of the Retry-After header of a 429')
+    parser.add_argument('--errors', type=float, default=0., help='fraction of requests answered with a 503')
+    parser.add_argument('--disconnect', type=float, default=0.,
+                        help='probability that a stream disconnects after sending a line')
+    parser.add_argument('--seed', type=int, default=None, help='seed of the random faults')
+    args = parser.parse_args()
+
+    recordings = (read_recordings(args.pgn, args.move_time) if args.pgn
+                  else random_recordings(args.games, args.move_time))
+    recordings = [recording for recording in recordings if recording.plies]
+    if not recordings:
+        parser.error('no games with moves to replay')
+    faults = Faults(latency=args.latency, jitter=args.jitter, rate_limit=args.rate_limit,
+                    retry_after=args.retry_after, errors=args.errors, disconnect=args.disconnect)
+    fake = FakeLichess(recordings, speed=args.speed, faults=faults, account=args.account,
+                       finished_ratio=args.finished, seed=args.seed)
+    print(f'Replaying {len(recordings)} games at {args.speed:g}x on http://{args.host}:{args.port}')
+    web.run_app(fake.app(), host=args.host, port=args.port, print=None)
@@ -0,0 +1,366 @@
+"""
+Load test of the bot with simulated Discord interactions. Every simulated channel plays puzzles like a user would:
+/puzzle random, then answers (mostly correct, some wrong), hints, giving up, updated boards and flipped boards, until
+the puzzle is solved and the next one is started. The interactions are dispatched straight into the cogs and views,
+with fake interactions that answer after a simulated Discord API latency, so everything else is the bot's real code:
+puzzle selection and the channel puzzle store use the database configured in .env, and boards are rendered in the
+render process pool.
+
+Reports the throughput, the latency percentiles per kind of interaction, the saturation of the database connection
+pool and the lag of the event loop. Use --seed to fill a local database with synthetic puzzles first.
+
+Usage: python benchmarks/loadtest.py [--channels 500] [--rate 200] [--duration 60] [--discord-latency 0.05]
+                                     [--seed 100000] [--json results.json]
+"""
+import argparse
+import asyncio
+import itertools
+import json
+import os
+import random
+import statistics
+import sys
+import time
+from collections import defaultdict
+from typing import Any, Awaitable, Callable
+
+import discord
+
+sys.path.append(os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'bot'))
+
+from LichessBot import LichessBot
+from cogs.answer import Answer
+from cogs.puzzle import PuzzleCog
+from database import engine
+from views import FlipBoardView, HintView, UpdateBoardView, WrongAnswerView
+
+_ids = itertools.count(10 ** 17)  # Fake snowflakes
+
+
+class FakeUser:
+    def __init__(self):
+        self.id = next(_ids)
+        self.display_name = f'user{self.id % 10000}'
+        self.mention = f'<@{self.id}>'
+
+
+class FakeGuild:
+    def __init__(self, shard_id: int = 0):
+        self.id = next(_ids)
+        self.shard_id = shard_id
+
+
+class FakeMessage:
+    def __init__(self, channel: 'FakeChannel', content: str | None = None, embed: discord.Embed | None = None,
+                 view: discord.ui.View | None = None):
+        self.id = next(_ids)
+        self.channel = channel
+        self.content = content
+        self.embeds = [embed] if embed is not None else []
+        self.view = view
+
+
+class FakeChannel:
+    def __init__(self, harness: 'LoadTest', guild: FakeGuild,
+                 channel_type: discord.ChannelType = discord.ChannelType.text):
+        self.harness = harness
+        self.id = next(_ids)
+        self.guild = guild
+        self.type = channel_type
+        self.mention = f'<#{self.id}>'
+        self.threads: list[FakeChannel] = []
+
+    async def send(self, content: str | None = None, *, embed: discord.Embed | None = None,
+                   view: discord.ui.View | None = None, **kwargs) -> FakeMessage:
+        await self.harness.discord_call()
+        return FakeMessage(self, content, embed, view)
+
+    async def create_thread(self, *, name: str, **kwargs) -> 'FakeChannel':
+        await self.harness.discord_call()
+        thread = FakeChannel(self.harness, self.guild, discord.ChannelType.public_thread)
+        self.threads.append(thread)
+        return thread
+
+
+class FakeResponse:
+    """
+    InteractionResponse: only one response per interaction, after which followups are used
+    """
+
+    def __init__(self, interaction: 'FakeInteraction'):
+        self.interaction = interaction
+        self._done = False
+
+    def is_done(self) -> bool:
+        return self._done
+
+    async def _respond(self) -> None:
+        if self._done:
+            raise discord.InteractionResponded(self.interaction)
+        self._done = True
+        await self.interaction.harness.discord_call()
+
+    async def defer(self, **kwargs) -> None:
+        await self._respond()
+
+    async def send_message(self, content: str | None = None, **kwargs) -> None:
+        await self._respond()
+
+    async def edit_message(self, **kwargs) -> None:
+        await self._respond()
+
+
+class FakeFollowup:
+    def __init__(self, interaction: 'FakeInteraction'):
+        self.interaction = interaction
+
+    async def send(self, content: str | None = None, *, embed: discord.Embed | None = None,
+                   view: discord.ui.View | None = None, **kwargs) -> FakeMessage:
+        await self.interaction.harness.discord_call()
+        return FakeMessage(self.interaction.channel, content, embed, view)
+
+
+class FakeInteraction:
+    def __init__(self, harness: 'LoadTest', user: FakeUser, channel: FakeChannel, message: FakeMessage | None = None):
+        self.harness = harness
+        self.client = harness.client
+        self.user = user
+        self.channel = channel
+        self.channel_id = channel.id
+        self.guild = channel.guild
+        self.guild_id = channel.guild.id
+        self.message = message
+        self.type = discord.InteractionType.component if message is not None else \
+            discord.InteractionType.application_command
+        self.data: dict = {}
+        self.command = None
+        self.extras: dict = {}
+        self.app_permissions = discord.Permissions(create_public_threads=True, send_messages_in_threads=True,
+                                                   send_messages=True)
+        self.response = FakeResponse(self)
+        self.followup = FakeFollowup(self)
+
+
+class Pacer:
+    """
+    Spaces interactions over all channels with exponentially distributed gaps, for an average rate per second
+    """
+
+    def __init__(self, rate: float | None):
+        self.rate = rate
+        self._next = time.monotonic()
+
+    async def wait(self) -> None:
+        if not self.rate:
+            return
+        self._next = max(self._next, time.monotonic()) + random.expovariate(self.rate)
+        if (delay := self._next - time.monotonic()) > 0:
+            await asyncio.sleep(delay)
+
+
+class PoolSampler:
+    """
+    Samples the number of checked out connections of the database pool
+    """
+
+    def __init__(self, interval: float = 0.05):
+        self.interval = interval
+        self.samples: list[int] = []
+        pool = engine.sync_engine.pool
+        self.capacity = pool.size() + max(0, getattr(pool, '_max_overflow', 0))
+
+    async def run(self) -> None:
+        pool = engine.sync_engine.pool
+        while True:
+            self.samples.append(pool.checkedout())
+            await asyncio.sleep(self.interval)
+
+    def stats(self) -> dict[str, float]:
+        if not self.samples:
+            return {}
+        return {'capacity': self.capacity, 'checked_out_avg': statistics.fmean(self.samples),
+                'checked_out_max': max(self.samples),
+                'saturated_fraction': sum(n >= self.capacity for n in self.samples) / len(self.samples)}
+
+
+def percentile(values: list[float], q: float) -> float:
+    return values[min(len(values) - 1, round(q * (len(values) - 1)))]
+
+
+class LoadTest:
+    def __init__(self, client: LichessBot, channels: int, rate: float | None, discord_latency: float,
+                 wrong_ratio: float, hint_ratio: float, give_up_ratio: float, flip_ratio: float, seed: int = 0):
+        self.client = client
+        self.channels = channels
+        self.pacer = Pacer(rate)
+        self.discord_latency = discord_latency
+        self.wrong_ratio = wrong_ratio
+        self.hint_ratio = hint_ratio
+        self.give_up_ratio = give_up_ratio
+        self.flip_ratio = flip_ratio
+        self.rng = random.Random(seed)
+        self.puzzle_cog = PuzzleCog(client)
+        self.answer_cog = Answer(client)
+        self.latencies: dict[str, list[float]] = defaultdict(list)
+        self.errors: dict[str, int] = defaultdict(int)
+        self.solved = 0
+        self._stopping = False
+
+    async def discord_call(self) -> None:
+        """
+        Round trip to the Discord API
+        """
+        if self.discord_latency:
+            await asyncio.sleep(self.discord_latency * self.rng.uniform(0.5, 1.5))
+
+    async def dispatch(self, kind: str, handler: Callable[[FakeInteraction], Awaitable[Any]], user: FakeUser,
+                       channel: FakeChannel, message: FakeMessage | None = None) -> None:
+        await self.pacer.wait()
+        interaction = FakeInteraction(self, user, channel, message)
+        start = time.perf_counter()
+        try:
+            await handler(interaction)
+        except Exception as e:
+            self.errors[kind] += 1
+            self.client.logger.exception(f'Load test interaction {kind} failed\n{type(e).__name__}: {e}')
+        self.latencies[kind].append(time.perf_counter() - start)
+
+    async def play(self, guild: FakeGuild) -> None:
+        """
+        Play puzzles in a channel until the test stops
+        """
+        user = FakeUser()
+        channel = FakeChannel(self, guild)
+        gif = discord.Embed().set_image(url='https://lichess1.org/game/export/gif/white/abcdefgh.gif')
+        while not self._stopping:
+            await self.dispatch('puzzle random', lambda i: self.puzzle_cog.rand.callback(self.puzzle_cog, i),
+                                user, channel)
+            puzzle_channel = channel.threads.pop() if channel.threads else channel
+            started = False
+            while not self._stopping:
+                state = await self.client.channel_puzzles.get(puzzle_channel.id)
+                if state is None:
+                    self.solved += started
+                    break
+                started = True
+                roll = self.rng.random()
+                if roll < self.hint_ratio:
+                    await self.dispatch('hint', lambda i: HintView().hint.callback(i), user, puzzle_channel,
+                                        FakeMessage(puzzle_channel))
+                elif roll < self.hint_ratio + self.wrong_ratio:
+                    await self.dispatch('answer', lambda i: self.answer_cog.answer.callback(self.answer_cog, i,
+                                                                                            'Kz9'),
+                                        user, puzzle_channel)
+                    if self.rng.random() < self.give_up_ratio:
+                        await self.dispatch('give up', lambda i: WrongAnswerView().best_move.callback(i), user,
+                                            puzzle_channel, FakeMessage(puzzle_channel))
+                else:
+                    answer = state.line.san[state.ply]
+                    await self.dispatch('answer', lambda i: self.answer_cog.answer.callback(self.answer_cog, i,
+                                                                                            answer),
+                                        user, puzzle_channel)
+                    if await self.client.channel_puzzles.get(puzzle_channel.id) is not None:
+                        await self.dispatch('update board', lambda i: UpdateBoardView().show_updated_board.callback(i),
+                                            user, puzzle_channel, FakeMessage(puzzle_channel))
+                if self.rng.random() < self.flip_ratio:
+                    await self.dispatch('flip board', lambda i: FlipBoardView().flip_board.callback(i), user,
+                                        puzzle_channel, FakeMessage(puzzle_channel, embed=gif.copy()))
+
+    async def run(self, duration: float, shards: int) -> dict:
+        sampler = PoolSampler()
+        sampling = asyncio.create_task(sampler.run())
+        guilds = [FakeGuild(shard_id=i % shards) for i in range(max(1, self.channels // 10))]
+        start = time.perf_counter()
+        players = [asyncio.create_task(self.play(guilds[i % len(guilds)])) for i in range(self.channels)]
+        await asyncio.sleep(duration)
+        self._stopping = True
+        await asyncio.wait(players, timeout=30)
+        elapsed = time.perf_counter() - start
+        sampling.cancel()
+        return self.report(elapsed, sampler)
+
+    def report(self, elapsed: float, sampler: PoolSampler) -> dict:
+        interactions = {}
+        for kind, latencies in sorted(self.latencies.items()):
+            latencies.sort()
+            interactions[kind] = {'count': len(latencies), 'errors': self.errors[kind],
+                                  'mean_ms': statistics.fmean(latencies) * 1000,
+                                  'p50_ms': percentile(latencies, 0.5) * 1000,
+                                  'p95_ms': percentile(latencies, 0.95) * 1000,
+                                  'p99_ms': percentile(latencies, 0.99) * 1000}
+        total = sum(len(latencies) for latencies in self.latencies.values())
+        return {'duration_s': elapsed, 'channels': self.channels, 'interactions': total,
+                'throughput_per_s': total / elapsed, 'puzzles_solved': self.solved, 'by_kind': interactions,
+                'db_pool': sampler.stats(), 'event_loop': self.client.watchdog.stats(),
+                'render_cache': self.client.render_cache.stats(), 'prefetch_hits': self.client.prefetcher.hits,
+                'prefetch_misses': self.client.prefetcher.misses}
+
+
+def print_report(report: dict) -> None:
+    print(f'{report["interactions"]} interactions in {report["duration_s"]:.1f}s from {report["channels"]} channels: '
+          f'{report["throughput_per_s"]:.1f}/s, {report["puzzles_solved"]} puzzles solved')
+    print(f'\n{"interaction":<14} {"count":>7} {"errors":>6} {"mean":>9} {"p50":>9} {"p95":>9} {"p99":>9}')
+    for kind, stats in report['by_kind'].items():
+        print(f'{kind:<14} {stats["count"]:>7} {stats["errors"]:>6} {stats["mean_ms"]:>7.1f}ms '
+              f'{stats["p50_ms"]:>7.1f}ms {stats["p95_ms"]:>7.1f}ms {stats["p99_ms"]:>7.1f}ms')
+    pool = report['db_pool']
+    if pool:
+        print(f'\nDatabase pool: {pool["checked_out_avg"]:.1f} of {pool["capacity"]} connections in use on average, '
+              f'at most {pool["checked_out_max"]}, saturated {pool["saturated_fraction"]:.1%} of the time')
+    loop = report['event_loop']
+    print(f'Event loop lag: {loop["lag_avg"] * 1000:.1f}ms on average, at most {loop["lag_max"] * 1000:.1f}ms, '
+          f'blocked {loop["blocks"]} times')
+    print(f'Render cache: {report["render_cache"]}')
+    print(f'Prefetched puzzles: {report["prefetch_hits"]} hits, {report["prefetch_misses"]} misses')
+
+
+async def main(args: argparse.Namespace) -> dict:
+    client = LichessBot(development=False, command_prefix='%lb', intents=discord.Intents.default())
+    client.lichess.start()
+    client.renderer.start()
+    client.channel_puzzles.start()
+    client.watchdog.start()
+    await client.refresh_puzzle_stats()
+    load_test = LoadTest(client, channels=args.channels, rate=args.rate, discord_latency=args.discord_latency,
+                         wrong_ratio=args.wrong, hint_ratio=args.hint, give_up_ratio=args.give_up,
+                         flip_ratio=args.flip)
+    await client.add_cog(load_test.puzzle_cog)  # Registers the cog for the next puzzle button
+    client.prefetcher.source = load_test.puzzle_cog.select_prepared_puzzle
+    try:
+        return await load_test.run(args.duration, shards=args.shards)
+    finally:
+        # The bot never logged in to Discord, so only stop what was started here
+        client.prefetcher.stop()
+        await client.channel_puzzles.stop()
+        await client.lichess.close()
+        client.renderer.shutdown()
+        client.watchdog.stop()
+        await engine.dispose()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--channels', type=int, default=100, help='number of channels playing puzzles at once')
+    parser.add_argument('--rate', type=float, default=None,
+                        help='average number of interactions per second over all channels, unlimited if not given')
+    parser.add_argument('--duration', type=float, default=30., help='seconds to run the test')
+    parser.add_argument('--discord-latency', type=float, default=0.05,
+                        help='average seconds of a simulated Discord API call')
+    parser.add_argument('--shards', type=int, default=1, help='number of shards the fake guilds are spread over')
+    parser.add_argument('--wrong', type=float, default=0.2, help='fraction of wrong answers')
+    parser.add_argument('--hint', type=float, default=0.1, help='fraction of hints instead of answers')
+    parser.add_argument('--give-up', type=float, default=0.3, help='fraction of wrong answers followed by giving up')
+    parser.add_argument('--flip', type=float, default=0.02, help='fraction of interactions followed by a board flip')
+    parser.add_argument('--seed', type=int, metavar='N', help='first ingest N synthetic puzzles in the database')
+    parser.add_argument('--json', help='write the report to this file')
+    args = parser.parse_args()
+
+    if args.seed:
+        import puzzle_index
+        from suite import seed_database
+        puzzle_index.INDEX_DIR = seed_database(args.seed)  # The bot selects puzzles from the synthetic index
+    report = asyncio.run(main(args))
+    print_report(report)
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(report, f, indent=2)
@@ -0,0 +1,55 @@
+"""
+Compare the number of board renders per second of the available renderer backends.
+
+Usage: python benchmarks/render.py [--seconds 5] [--positions 50] [--size 1000]
+"""
+import argparse
+import os
+import random
+import sys
+import time
+
+import chess
+
+sys.path.append(os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'bot'))
+
+from rendering import RENDERERS, RenderKey, render_key
+
+
+def sample_positions(n: int, seed: int = 0) -> list[RenderKey]:
+    """
+    Positions from random games, with the last move highlighted and alternating orientation
+    """
+    rng = random.Random(seed)
+    keys = []
+    board = chess.Board()
+    while len(keys) < n:
+        moves = list(board.legal_moves)
+        if not moves or board.ply() > 80:
+            board = chess.Board()
+            continue
+        board.push(rng.choice(moves))
+        keys.append(render_key(board, lastmove=board.peek(), flipped=len(keys) % 2 == 1))
+    return keys
+
+
+def benchmark(render, keys: list[RenderKey], seconds: float) -> float:
+    render(keys[0])  # Warm up, e.g. to pre-render sprites
+    renders = 0
+    start = time.perf_counter()
+    while (elapsed := time.perf_counter() - start) < seconds:
+        render(keys[renders % len(keys)])
+        renders += 1
+    return renders / elapsed
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--seconds', type=float, default=5., help='duration per backend')
+    parser.add_argument('--positions', type=int, default=50, help='number of distinct positions to render')
+    parser.add_argument('--size', type=int, default=1000, help='board size in pixels')
+    args = parser.parse_args()
+
+    positions = [key[:-1] + (args.size,) for key in sample_positions(args.positions)]
+    for name, render_function in RENDERERS.items():
+        print(f'{name:>8}: {benchmark(render_function, positions, args.seconds):8.1f} renders/s')
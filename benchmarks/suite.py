@@ -0,0 +1,497 @@
+"""
+Micro-benchmarks of the hot paths of the bot: rendering boards, preparing puzzles and matching answers, hints, theme
+names, transforming chunks of the puzzle database and selecting puzzles. Everything runs offline on synthetic puzzles,
+except the database selection benchmarks, which run against the database configured in .env when --database is given.
+Use --seed to fill a local database with synthetic puzzles first.
+
+Results are printed, and can be written as JSON with --json. Timings depend on the machine, so they are only compared
+with a baseline on request: --baseline-ref runs the suite of another commit (e.g. main) in a temporary git worktree
+right after this run, and --baseline compares with the JSON of an earlier run on the same machine. The suite exits
+with status 1 when the median time of a benchmark regressed by more than --threshold.
+
+Usage: python benchmarks/suite.py [--seconds 1] [--filter REGEX] [--json results.json] [--baseline-ref main]
+                                  [--baseline baseline.json] [--threshold 0.1] [--database] [--seed 100000]
+"""
+import argparse
+import asyncio
+import io
+import itertools
+import json
+import os
+import platform
+import random
+import re
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from types import SimpleNamespace
+from typing import Any, Awaitable, Callable
+
+import chess
+import pandas as pd
+import zstandard
+
+sys.path.append(os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'bot'))
+
+from update_puzzles import CSV_COLUMNS, parse_puzzles, transform_puzzles
+from puzzle_index import PuzzleIndex, PuzzleIndexWriter
+from rendering import RENDERERS, BoardRenderCache, render_key
+from solution import SolutionLine
+from themes import THEME_VOCABULARY, THEME_BITS, theme_name
+
+BENCHMARKS: dict[str, Callable[['Fixtures'], Callable[[], Any]]] = {}
+DATABASE_BENCHMARKS: set[str] = set()
+
+
+def benchmark(name: str, database: bool = False):
+    """
+    Register a benchmark. The decorated function prepares it, and returns the operation to time, which may be a
+    coroutine function.
+    """
+
+    def register(setup: Callable[['Fixtures'], Callable[[], Any]]):
+        BENCHMARKS[name] = setup
+        if database:
+            DATABASE_BENCHMARKS.add(name)
+        return setup
+
+    return register
+
+
+def synthetic_puzzles(n: int, seed: int = 0) -> pd.DataFrame:
+    """
+    Puzzles in the format of the puzzle database CSV, from positions of random games. The moves are random legal moves
+    rather than solutions, which is all the benchmarked code relies on.
+    """
+    rng = random.Random(seed)
+    openings = ['Sicilian_Defense', 'French_Defense', 'Italian_Game', 'Queens_Gambit_Declined', None]
+    rows = []
+    board = chess.Board()
+    while len(rows) < n:
+        if board.is_game_over() or board.ply() > 60:
+            board = chess.Board()
+        board.push(rng.choice(list(board.legal_moves)))
+        if board.ply() < 8 or rng.random() < 0.7:
+            continue
+        line = board.copy()
+        moves = []
+        for _ in range(rng.choice((2, 4, 6))):
+            if line.is_game_over():
+                break
+            move = rng.choice(list(line.legal_moves))
+            moves.append(move.uci())
+            line.push(move)
+        if len(moves) < 2:
+            continue
+        puzzle_id = f'{len(rows):05x}'
+        opening = rng.choice(openings)
+        rows.append((puzzle_id, board.fen(), ' '.join(moves), int(rng.gauss(1500, 400)), rng.randint(70, 110),
+                     rng.randint(50, 100), rng.randint(100, 50000),
+                     ' '.join(rng.sample(THEME_VOCABULARY, rng.randint(1, 4))),
+                     f'https://lichess.org/{puzzle_id}#{board.ply()}',
+                     opening, f'{opening}_Other_variations' if opening else None))
+    return pd.DataFrame(rows, columns=CSV_COLUMNS)
+
+
+def puzzles_csv(df: pd.DataFrame) -> bytes:
+    output = io.StringIO()
+    df.to_csv(output, header=False, index=False)
+    return output.getvalue().encode()
+
+
+class Fixtures:
+    """
+    Inputs of the benchmarks, created on first use
+    """
+
+    def __init__(self, puzzles: int, database: bool):
+        self.nr_puzzles = puzzles
+        self.database = database
+        self._cache: dict[str, Any] = {}
+        self._loop: asyncio.AbstractEventLoop | None = None
+
+    def _get(self, name: str, create: Callable[[], Any]) -> Any:
+        if name not in self._cache:
+            self._cache[name] = create()
+        return self._cache[name]
+
+    @property
+    def puzzles(self) -> pd.DataFrame:
+        return self._get('puzzles', lambda: synthetic_puzzles(self.nr_puzzles))
+
+    @property
+    def csv(self) -> bytes:
+        return self._get('csv', lambda: puzzles_csv(self.puzzles))
+
+    @property
+    def lines(self) -> list[SolutionLine]:
+        return self._get('lines', lambda: [SolutionLine(fen, moves.split())
+                                           for fen, moves in zip(self.puzzles.fen[:500], self.puzzles.moves[:500])])
+
+    @property
+    def index(self) -> PuzzleIndex:
+        def create() -> PuzzleIndex:
+            directory = tempfile.mkdtemp(prefix='puzzle_index_')
+            writer = PuzzleIndexWriter()
+            writer.add(transform_puzzles(self.puzzles.copy()))
+            return PuzzleIndex(writer.write(directory))
+
+        return self._get('index', create)
+
+    @property
+    def loop(self) -> asyncio.AbstractEventLoop:
+        if self._loop is None:
+            self._loop = asyncio.new_event_loop()
+        return self._loop
+
+    @property
+    def session_factory(self):
+        def create():
+            from sqlalchemy.ext.asyncio import AsyncSession
+            from sqlalchemy.orm import sessionmaker
+            from database import engine
+            return sessionmaker(bind=engine, expire_on_commit=False, class_=AsyncSession)
+
+        return self._get('session_factory', create)
+
+    def close(self) -> None:
+        if self._loop is not None:
+            if self.database:
+                from database import engine
+                self._loop.run_until_complete(engine.dispose())
+            self._loop.close()
+
+
+def render_positions(fixtures: Fixtures) -> list:
+    """
+    Boards as shown by show_puzzle: the position after the opponent's move, oriented for the solver
+    """
+    return [render_key(chess.BaseBoard(line.board_fen(1)), lastmove=line.moves[0], flipped=line.color == 'black')
+            for line in fixtures.lines[:50]]
+
+
+@benchmark('render.svg')
+def render_svg(fixtures: Fixtures):
+    keys = itertools.cycle(render_positions(fixtures))
+    return lambda: RENDERERS['svg'](next(keys))
+
+
+@benchmark('render.sprite')
+def render_sprite(fixtures: Fixtures):
+    keys = itertools.cycle(render_positions(fixtures))
+    RENDERERS['sprite'](next(keys))  # Pre-render the sprites
+    return lambda: RENDERERS['sprite'](next(keys))
+
+
+@benchmark('render.cache_hit')
+def render_cache_hit(fixtures: Fixtures):
+    keys = render_positions(fixtures)
+    cache = BoardRenderCache(max_bytes=64 * 1024 * 1024)
+    for key in keys:
+        cache.put(key, b'\x89PNG' + bytes(40000))
+    keys = itertools.cycle(keys)
+    return lambda: cache.get(next(keys))
+
+
+@benchmark('answer.prepare')
+def answer_prepare(fixtures: Fixtures):
+    """
+    Solution line and answer table of the first move, as built by prepare_puzzle
+    """
+    puzzles = itertools.cycle(list(zip(fixtures.puzzles.fen[:500], fixtures.puzzles.moves.str.split()[:500])))
+
+    def prepare():
+        fen, moves = next(puzzles)
+        SolutionLine(fen, moves).answer_table(1)
+
+    return prepare
+
+
+@benchmark('answer.match')
+def answer_match(fixtures: Fixtures):
+    """
+    Matching answers in SAN, UCI, lowercase and illegal moves, and the mate check, as in Answer.answer
+    """
+    cases = []
+    for line in fixtures.lines[:200]:
+        table = line.answer_table(1)
+        correct_uci, correct_san = line.uci[1], line.san[1]
+        for answer in (correct_san, correct_uci, correct_san.lower(), 'Qxh7#', 'e9e4'):
+            cases.append((table, answer, correct_uci))
+    cases = itertools.cycle(cases)
+
+    def match():
+        table, answer, correct_uci = next(cases)
+        move = table.match(answer, preferred=correct_uci)
+        return move == correct_uci or move in table.mates
+
+    return match
+
+
+@benchmark('hint')
+def hint(fixtures: Fixtures):
+    """
+    Hint message of HintView.hint
+    """
+    puzzles = itertools.cycle([(line, themes.split()) for line, themes in zip(fixtures.lines, fixtures.puzzles.themes)])
+
+    def create_hint():
+        line, themes = next(puzzles)
+        piece = line.hint_pieces[1]
+        names = [theme_name(theme) for theme in themes]
+        return (f'(Click to reveal)\nThe themes of this puzzle are: ||{", ".join(names)}||\n'
+                f'You should move your ||{piece}||')
+
+    return create_hint
+
+
+@benchmark('themes.format')
+def themes_format(fixtures: Fixtures):
+    themes = itertools.cycle(THEME_VOCABULARY)
+    return lambda: theme_name(next(themes))
+
+
+@benchmark('themes.format_uncached')
+def themes_format_uncached(fixtures: Fixtures):
+    themes = itertools.cycle(THEME_VOCABULARY)
+    return lambda: theme_name.__wrapped__(next(themes))
+
+
+@benchmark('ingest.parse_chunk')
+def ingest_parse_chunk(fixtures: Fixtures):
+    """
+    Parsing and transforming a chunk of the puzzle database CSV, as done by the workers of update_puzzles_table
+    """
+    data = fixtures.csv
+    return lambda: parse_puzzles(data)
+
+
+@benchmark('ingest.transform_chunk')
+def ingest_transform_chunk(fixtures: Fixtures):
+    df = pd.read_csv(io.BytesIO(fixtures.csv), names=CSV_COLUMNS)
+    return lambda: transform_puzzles(df.copy())
+
+
+@benchmark('select.index')
+def select_index(fixtures: Fixtures):
+    index = fixtures.index
+    return lambda: index.sample(1400, 1700)
+
+
+@benchmark('select.index_theme')
+def select_index_theme(fixtures: Fixtures):
+    index = fixtures.index
+    return lambda: index.sample(1400, 1700, themes_all=THEME_BITS['fork'])
+
+
+def database_selection(fixtures: Fixtures, **criteria) -> Callable[[], Awaitable]:
+    """
+    PuzzleCog.random_puzzle without a puzzle index or histogram, so the puzzle is selected by the database
+    """
+    from cogs.puzzle import PuzzleCog
+
+    cog = SimpleNamespace(client=SimpleNamespace(puzzle_index=None, puzzle_histogram=None))
+    Session = fixtures.session_factory
+
+    async def select():
+        async with Session() as session:
+            return await PuzzleCog.random_puzzle(cog, session, **criteria)
+
+    return select
+
+
+@benchmark('select.db_random', database=True)
+def select_db_random(fixtures: Fixtures):
+    return database_selection(fixtures)
+
+
+@benchmark('select.db_rating', database=True)
+def select_db_rating(fixtures: Fixtures):
+    return database_selection(fixtures, rating_from=1400, rating_to=1700)
+
+
+@benchmark('select.db_theme', database=True)
+def select_db_theme(fixtures: Fixtures):
+    return database_selection(fixtures, rating_from=1400, rating_to=1700, themes=['fork'],
+                              excluded_themes=['mateIn1'])
+
+
+@benchmark('select.db_by_id', database=True)
+def select_db_by_id(fixtures: Fixtures):
+    """
+    Loading the puzzle selected from the puzzle index
+    """
+    from database import Puzzle
+
+    Session = fixtures.session_factory
+    puzzle_ids = itertools.cycle(fixtures.puzzles.puzzle_id[:500])
+
+    async def load():
+        async with Session() as session:
+            return await session.get(Puzzle, next(puzzle_ids))
+
+    return load
+
+
+def measure(operation: Callable[[], Any], loop: asyncio.AbstractEventLoop, seconds: float,
+            min_rounds: int = 5) -> dict[str, float]:
+    """
+    Time rounds of calls of the operation for about the given number of seconds. The number of calls per round is
+    chosen to make a round last at least 10 ms, so the timer resolution does not matter.
+    @return: statistics of the time per call in microseconds
+    """
+    if asyncio.iscoroutinefunction(operation):
+        async def run(number: int) -> float:
+            start = time.perf_counter()
+            for _ in range(number):
+                await operation()
+            return time.perf_counter() - start
+
+        def time_round(number: int) -> float:
+            return loop.run_until_complete(run(number))
+    else:
+        def time_round(number: int) -> float:
+            start = time.perf_counter()
+            for _ in range(number):
+                operation()
+            return time.perf_counter() - start
+
+    time_round(1)  # Warm up
+    number = 1
+    while (elapsed := time_round(number)) < 0.01:
+        number *= 10 if elapsed < 0.001 else 2
+    per_call: list[float] = []
+    deadline = time.perf_counter() + seconds
+    while len(per_call) < min_rounds or time.perf_counter() < deadline:
+        per_call.append(time_round(number) / number * 1e6)
+    per_call.sort()
+    median = statistics.median(per_call)
+    return {'median_us': median, 'min_us': per_call[0],
+            'p95_us': per_call[min(len(per_call) - 1, round(0.95 * (len(per_call) - 1)))],
+            'ops_per_sec': 1e6 / median, 'rounds': len(per_call), 'calls_per_round': number}
+
+
+def compare(results: dict[str, dict], baseline: dict[str, dict], threshold: float) -> list[str]:
+    """
+    Print the change of every benchmark against the baseline
+    @return: names of the benchmarks that regressed by more than the threshold
+    """
+    regressions = []
+    print(f'\n{"benchmark":<26} {"baseline":>12} {"current":>12} {"change":>8}')
+    for name, result in results.items():
+        if name not in baseline:
+            print(f'{name:<26} {"-":>12} {result["median_us"]:>10.1f}us {"new":>8}')
+            continue
+        before = baseline[name]['median_us']
+        change = result['median_us'] / before - 1
+        regressed = change > threshold
+        if regressed:
+            regressions.append(name)
+        print(f'{name:<26} {before:>10.1f}us {result["median_us"]:>10.1f}us {change:>+7.1%}'
+              f'{"  REGRESSION" if regressed else ""}')
+    return regressions
+
+
+def run_baseline(ref: str, arguments: list[str]) -> dict[str, dict]:
+    """
+    Run the suite of another commit in a temporary git worktree, with the same arguments
+    @return: the results of the run
+    """
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    with tempfile.TemporaryDirectory(prefix='benchmark_baseline_') as directory:
+        worktree = os.path.join(directory, 'worktree')
+        subprocess.run(['git', 'worktree', 'add', '--detach', worktree, ref], cwd=root, check=True,
+                       capture_output=True)
+        try:
+            output = os.path.join(directory, 'results.json')
+            print(f'\nRunning the suite of {ref} as the baseline')
+            subprocess.run([sys.executable, os.path.join(worktree, 'benchmarks', 'suite.py'), *arguments,
+                            '--baseline', '', '--json', output], check=True)
+            with open(output) as f:
+                return json.load(f)['results']
+        finally:
+            subprocess.run(['git', 'worktree', 'remove', '--force', worktree], cwd=root, capture_output=True)
+
+
+def seed_database(n: int) -> str:
+    """
+    Fill the configured database with synthetic puzzles, through the same ingestion as the real puzzle database
+    @return: the temporary directory the puzzle index of the synthetic puzzles is written to, leaving the bot's index
+    untouched
+    """
+    from database import engine, create_tables
+    from update_puzzles import update_puzzles_table
+
+    index_dir = tempfile.mkdtemp(prefix='puzzle_index_')
+    path = os.path.join(tempfile.mkdtemp(prefix='puzzles_'), 'synthetic_puzzles.csv.zst')
+    with open(path, 'wb') as f:
+        f.write(zstandard.ZstdCompressor().compress(puzzles_csv(synthetic_puzzles(n))))
+
+    async def seed():
+        await create_tables()
+        await update_puzzles_table(source=path, mode='copy', index_dir=index_dir)
+        await engine.dispose()  # The connections belong to this event loop
+
+    asyncio.run(seed())
+    return index_dir
+
+
+def environment() -> dict[str, str]:
+    try:
+        commit = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+                                cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip()
+    except OSError:
+        commit = ''
+    return {'python': platform.python_version(), 'machine': platform.machine(), 'processor': platform.processor(),
+            'commit': commit, 'time': time.strftime('%Y-%m-%dT%H:%M:%S')}
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--seconds', type=float, default=1., help='duration per benchmark')
+    parser.add_argument('--filter', default='', help='only run the benchmarks of which the name matches the regex')
+    parser.add_argument('--puzzles', type=int, default=5000, help='number of synthetic puzzles in the fixtures')
+    parser.add_argument('--json', help='write the results to this file')
+    parser.add_argument('--baseline-ref', help='git commit to run the suite of as the baseline, e.g. main')
+    parser.add_argument('--baseline', help='results of an earlier run on this machine to compare with, '
+                                           'written with --json')
+    parser.add_argument('--threshold', type=float, default=0.1,
+                        help='relative increase of the median time that counts as a regression')
+    parser.add_argument('--database', action='store_true', help='also run the benchmarks against the database')
+    parser.add_argument('--seed', type=int, metavar='N', help='first ingest N synthetic puzzles in the database')
+    args = parser.parse_args()
+
+    if args.seed:
+        seed_database(args.seed)
+    names = [name for name in BENCHMARKS if re.search(args.filter, name)
+             and (args.database or name not in DATABASE_BENCHMARKS)]
+    fixtures = Fixtures(puzzles=args.puzzles, database=args.database)
+    results: dict[str, dict] = {}
+    try:
+        for name in names:
+            operation = BENCHMARKS[name](fixtures)
+            results[name] = measure(operation, fixtures.loop, args.seconds)
+            print(f'{name:<26} {results[name]["median_us"]:>10.1f}us/op {results[name]["ops_per_sec"]:>12.1f} ops/s '
+                  f'(p95 {results[name]["p95_us"]:.1f}us, {results[name]["rounds"]} rounds)')
+    finally:
+        fixtures.close()
+
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump({'environment': environment(), 'threshold': args.threshold, 'results': results}, f, indent=2)
+            f.write('\n')
+    baseline = None
+    if args.baseline_ref:
+        arguments = ['--seconds', str(args.seconds), '--filter', args.filter, '--puzzles', str(args.puzzles)]
+        baseline = run_baseline(args.baseline_ref, arguments + (['--database'] if args.database else []))
+    elif args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)['results']
+    if baseline is not None:
+        regressions = compare(results, baseline, args.threshold)
+        if regressions:
+            print(f'\n{len(regressions)} benchmarks regressed by more than {args.threshold:.0%}: '
+                  f'{", ".join(regressions)}')
+            sys.exit(1)
@@ -2,38 +2,114 @@
 Invite the bot to your server with the following URL
 https://discord.com/api/oauth2/authorize?client_id=707287095911120968&permissions=309237696512&scope=bot%20applications.commands
 """
+import asyncio
 import os
 import sys
 import logging
 from logging import handlers
 
-import aiohttp
 import discord
-from discord.ext import commands
+from discord import app_commands
+from discord.ext import commands, tasks
 from discord.ext.commands import Context
-from async_property import async_cached_property
-from aiohttp import ClientSession
-from sqlalchemy import select, delete, func, update
+from sqlalchemy import select, delete, func, text
 from sqlalchemy.orm import sessionmaker
 from sqlalchemy.ext.asyncio import AsyncSession
 from dotenv import load_dotenv
 
-from database import engine, Puzzle, ChannelPuzzle, WatchedGame, User
+from database import engine, Puzzle, WatchedGame
 from logger import CustomFormatter
+from rendering import BoardRenderCache, RenderService
+from puzzle_index import PuzzleIndex
+from histogram import PuzzleHistogram
+from prefetch import PuzzlePrefetcher
+from channel_puzzles import ChannelPuzzleStore
+from lichess import LICHESS_URL, LichessClient, ResponseCache
+from rating_refresher import RatingRefresher
+from live_games import LiveGameHub
+from edits import EditScheduler
+from watchdog import LoopWatchdog, track
+from metrics import (MetricsServer, REGISTRY, WATCHED_GAMES, GAME_WATCHERS, LIVE_EDIT_BUDGET, GATEWAY_LATENCY,
+                     command_started, command_finished, instrument_engine, collect_cache)
+
+
+class LichessCommandTree(app_commands.CommandTree):
+    async def interaction_check(self, interaction: discord.Interaction) -> bool:
+        command_started(interaction)
+        track(interaction)
+        return True
+
+    async def on_error(self, interaction: discord.Interaction, error: app_commands.AppCommandError) -> None:
+        command_finished(interaction, status='error')
+        await super().on_error(interaction, error)
 
 
 class LichessBot(commands.AutoShardedBot):
     def __init__(self, development: bool, **kwargs):
-        super().__init__(**kwargs)
-        self.__session: ClientSession | None = None
+        super().__init__(tree_cls=LichessCommandTree, **kwargs)
         self.synced = False
         self.development = development
         self.logger = self._set_logger(debug=development)
         self.Session = sessionmaker(bind=engine, expire_on_commit=False, class_=AsyncSession)
+        self.puzzle_index: PuzzleIndex | None = None
+        self.puzzle_histogram: PuzzleHistogram | None = None
+        self._puzzle_writes: int | None = None  # Rows written to the puzzles table when the histogram was aggregated
+        self.prefetcher = PuzzlePrefetcher(size=int(os.getenv('PREFETCH_SIZE', 3)),
+                                           max_buckets=int(os.getenv('PREFETCH_BUCKETS', 64)),
+                                           logger=self.logger)
+        self.lichess = LichessClient(logger=self.logger,
+                                     base_url=os.getenv('LICHESS_URL', LICHESS_URL),
+                                     max_concurrency=int(os.getenv('LICHESS_CONCURRENCY', 8)),
+                                     timeout=float(os.getenv('LICHESS_TIMEOUT', 10)),
+                                     retries=int(os.getenv('LICHESS_RETRIES', 2)),
+                                     breaker_threshold=int(os.getenv('LICHESS_BREAKER_THRESHOLD', 5)),
+                                     breaker_reset=float(os.getenv('LICHESS_BREAKER_RESET', 30)),
+                                     cache=ResponseCache(max_entries=int(os.getenv('LICHESS_CACHE_SIZE', 4096)),
+                                                         stale_ttl=float(os.getenv('LICHESS_STALE_TTL', 3600))),
+                                     user_ttl=float(os.getenv('LICHESS_USER_TTL', 60)),
+                                     game_ttl=float(os.getenv('LICHESS_GAME_TTL', 10)))
+        self.rating_refresher = RatingRefresher(lichess=self.lichess, sessionmaker=self.Session, logger=self.logger,
+                                                interval=float(os.getenv('RATING_REFRESH_INTERVAL', 60)),
+                                                min_interval=float(os.getenv('RATING_REFRESH_MIN_INTERVAL', 600)))
+        self.channel_puzzles = ChannelPuzzleStore(sessionmaker=self.Session,
+                                                  max_size=int(os.getenv('CHANNEL_PUZZLE_CACHE_SIZE', 10000)),
+                                                  write_delay=float(os.getenv('CHANNEL_PUZZLE_WRITE_DELAY', 0)),
+                                                  logger=self.logger)
+        self.render_cache = BoardRenderCache(max_bytes=int(os.getenv('RENDER_CACHE_BYTES', 64 * 1024 * 1024)))
+        self.renderer = RenderService(cache=self.render_cache,
+                                      max_workers=int(os.getenv('RENDER_WORKERS', 2)),
+                                      max_queue=int(os.getenv('RENDER_QUEUE_SIZE', 32)),
+                                      timeout=float(os.getenv('RENDER_TIMEOUT', 10)),
+                                      backend=os.getenv('BOARD_RENDERER', 'svg'))
+        self.edit_scheduler = EditScheduler(logger=self.logger,
+                                            budget=float(os.getenv('EDIT_BUDGET', 25)),
+                                            min_interval=float(os.getenv('WATCH_EDIT_INTERVAL', 1)),
+                                            max_interval=float(os.getenv('WATCH_EDIT_MAX_INTERVAL', 30)))
+        self.live_games = LiveGameHub(lichess=self.lichess, renderer=self.renderer, edits=self.edit_scheduler,
+                                      sessionmaker=self.Session, logger=self.logger)
+        self.watchdog = LoopWatchdog(logger=self.logger,
+                                     interval=float(os.getenv('LOOP_WATCHDOG_INTERVAL', 0.1)),
+                                     threshold=float(os.getenv('LOOP_LAG_THRESHOLD', 0.5)))
+        metrics_port = os.getenv('METRICS_PORT')
+        self.metrics_server = MetricsServer(host=os.getenv('METRICS_HOST', '127.0.0.1'),
+                                            port=int(metrics_port)) if metrics_port else None
+        instrument_engine(engine)
+        collect_cache('render', self.render_cache.stats)
+        collect_cache('channel_puzzles', self.channel_puzzles.stats, size_key='channels')
+        collect_cache('lichess', self.lichess.cache.stats)
+        REGISTRY.collectors.append(self._collect_metrics)
 
     async def setup_hook(self):
         self.logger.info(f"Running setup_hook for {'DEVELOPMENT' if self.development else 'PRODUCTION'}")
-        self.__session = ClientSession()
+        self.watchdog.start()
+        self.lichess.start()
+        self.renderer.start()
+        self.channel_puzzles.start()
+        self.rating_refresher.start()
+        self.refresh_puzzle_stats.start()
+        if self.metrics_server is not None:
+            await self.metrics_server.start()
+            self.logger.info(f'Serving metrics on port {self.metrics_server.port}')
         # Load command cogs
         self.logger.info("Loading command cogs...")
         extensions = ['cogs.puzzle', 'cogs.answer', 'cogs.connect', 'cogs.rating', 'cogs.profile', 'cogs.about',
@@ -52,12 +128,24 @@ class LichessBot(commands.AutoShardedBot):
         # Delete WatchedGames from other session
         async with self.Session() as session:
             await session.execute(delete(WatchedGame))
-        os.system('rm /tmp/*.png >/dev/null 2>&1')
 
     async def close(self):
         self.logger.debug('Called LichessBot.close')
+        self.logger.info(f'Board render cache: {self.render_cache.stats()}')
+        self.logger.info(f'Channel puzzle cache: {self.channel_puzzles.stats()}')
+        self.logger.info(f'Lichess response cache: {self.lichess.cache.stats()}')
+        self.logger.info(f'Live board edits: {self.edit_scheduler.stats()}')
+        self.logger.info(f'Event loop lag: {self.watchdog.stats()}')
+        self.prefetcher.stop()
+        self.live_games.stop()
+        await self.channel_puzzles.stop()
+        await self.rating_refresher.stop()
         await super().close()
-        await self.__session.close()
+        if self.metrics_server is not None:
+            await self.metrics_server.stop()
+        await self.lichess.close()
+        self.renderer.shutdown()
+        self.watchdog.stop()
 
     async def on_ready(self):
         self.logger.debug('Called LichessBot.on_ready')
@@ -66,6 +154,10 @@ class LichessBot(commands.AutoShardedBot):
         self.logger.info(f"Logged in as {self.user}")
         self.logger.info(f"Bot id: {self.user.id}")
 
+    async def on_app_command_completion(self, interaction: discord.Interaction,
+                                        command: app_commands.Command | app_commands.ContextMenu):
+        command_finished(interaction, status='ok')
+
     async def on_command_error(self, context: Context, exception: Exception):
         self.logger.debug('Called LichessBot.on_command_error')
         if isinstance(exception, (commands.CommandNotFound, commands.NoPrivateMessage)):
@@ -75,36 +167,58 @@ class LichessBot(commands.AutoShardedBot):
 
     async def on_raw_thread_delete(self, payload: discord.RawThreadDeleteEvent):
         self.logger.debug('Called LichessBot.on_raw_thread_delete')
-        async with self.Session() as session:
-            q = delete(ChannelPuzzle).where(ChannelPuzzle.channel_id == payload.thread_id)
-            await session.execute(q)
-            await session.commit()
+        await self.channel_puzzles.delete(payload.thread_id)
 
-    @async_cached_property
-    async def total_nr_puzzles(self) -> int:
-        self.logger.debug('Called LichessBot.total_nr_puzzles')
-        async with self.Session() as session:
-            return (await session.execute(select(func.count()).select_from(Puzzle))).first()[0]
-
-    async def update_user_rating(self, lichess_username: str):
-        self.logger.debug(f'Called LichessBot.update_user_rating({lichess_username})')
-        async with aiohttp.ClientSession() as web:
-            async with web.get(url=f'https://lichess.org/api/user/{lichess_username}',
-                               headers={'Accept': 'application/json'}) as resp:
-                try:
-                    resp.raise_for_status()
-                except aiohttp.ClientResponseError:
-                    return
-                lichess_response = await resp.json()
+    def _collect_metrics(self) -> None:
+        WATCHED_GAMES.set(len(self.live_games.games), shard='all')
+        GAME_WATCHERS.set(sum(len(game.watchers) for game in self.live_games.games.values()), shard='all')
+        LIVE_EDIT_BUDGET.set(self.edit_scheduler.budget.rate, shard='all')
+        for shard_id, latency in self.latencies:
+            GATEWAY_LATENCY.set(latency, shard=shard_id)
 
-        async with self.Session() as session:
-            try:
-                await session.execute(update(User)
-                                      .where(User.lichess_username == lichess_username)
-                                      .values(puzzle_rating=lichess_response['perfs']['puzzle']['rating']))
-                await session.commit()
-            except KeyError:  # No puzzle rating
-                pass
+    @property
+    def total_nr_puzzles(self) -> int:
+        return self.puzzle_histogram.count() if self.puzzle_histogram is not None else 0
+
+    @tasks.loop(minutes=10)
+    async def refresh_puzzle_stats(self):
+        """
+        Load the puzzle index and histogram at startup, and reload them when the puzzles table has been updated, which
+        writes a new generation of the index. Without an index, the histogram is aggregated by the database, again
+        whenever the statistics of Postgres show that rows of the puzzles table were written since.
+        """
+        try:
+            generation = PuzzleIndex.current_generation()
+            if generation is not None:
+                if self.puzzle_index is not None and self.puzzle_index.generation == generation:
+                    return
+                self.puzzle_index = await asyncio.to_thread(PuzzleIndex.load)
+                self.puzzle_histogram = self.puzzle_index.histogram
+                self.prefetcher.clear()  # The prepared puzzles may have been retired
+                self.logger.info(f'Loaded puzzle index generation {generation} with {len(self.puzzle_index)} puzzles')
+            else:
+                async with self.Session() as session:
+                    # Cumulative count of inserted, updated and deleted rows, which is cheap to read
+                    writes = (await session.execute(text(
+                        "SELECT n_tup_ins + n_tup_upd + n_tup_del FROM pg_stat_user_tables WHERE relname = 'puzzles'"
+                    ))).scalar()
+                    if self.puzzle_histogram is not None and writes == self._puzzle_writes:
+                        return
+                    if self.puzzle_histogram is None:
+                        self.logger.warning('No puzzle index found, selecting puzzles from the database')
+                    totals = (await session.execute(select(Puzzle.rating, func.count())
+                                                    .filter(Puzzle.retired.is_(False))
+                                                    .group_by(Puzzle.rating))).all()
+                    theme = func.unnest(Puzzle.themes).column_valued('theme')
+                    theme_counts = (await session.execute(select(Puzzle.rating, theme, func.count())
+                                                          .filter(Puzzle.retired.is_(False))
+                                                          .group_by(Puzzle.rating, theme))).all()
+                self.puzzle_histogram = PuzzleHistogram.from_counts(totals, theme_counts)
+                self._puzzle_writes = writes
+                self.prefetcher.clear()
+                self.logger.info(f'Aggregated puzzle histogram of {self.total_nr_puzzles} puzzles')
+        except Exception as e:
+            self.logger.exception(f'Failed to refresh puzzle stats\n{type(e).__name__}: {e}')
 
     @staticmethod
     def _set_logger(debug: bool) -> logging.getLoggerClass():
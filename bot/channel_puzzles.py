@@ -0,0 +1,192 @@
+"""
+In-memory store of the puzzles that are being solved in channels, in front of the channel_puzzles table. The bot is
+the only writer of the table, so after a channel is loaded once, answers and button clicks in that channel are served
+from memory, and every change is written to the table.
+"""
+import asyncio
+import logging
+from collections import OrderedDict
+from functools import partial
+
+from sqlalchemy import select, update, delete, bindparam
+from sqlalchemy.orm import sessionmaker, selectinload
+
+from database import Puzzle, ChannelPuzzle
+from solution import SolutionLine
+
+
+class ChannelPuzzleState:
+    """
+    The puzzle being solved in a channel, and the progress in it
+    """
+
+    def __init__(self, channel_id: int, puzzle: Puzzle, moves: list[str], fen: str, line: SolutionLine | None = None):
+        self.channel_id = channel_id
+        self.puzzle = puzzle
+        self.moves = moves  # Moves left in the puzzle
+        self.fen = fen  # FEN updated according to the progress
+        self.line = line or SolutionLine(puzzle.fen, puzzle.moves)
+
+    @property
+    def ply(self) -> int:
+        """
+        Ply of the solution line to be played next
+        """
+        return self.line.ply(len(self.moves))
+
+    def seek(self, ply: int) -> None:
+        """
+        Set the progress to the position before the ply
+        """
+        self.moves = self.line.uci[ply:]
+        self.fen = self.line.fens[ply]
+
+
+class ChannelPuzzleStore:
+    """
+    Loads the state of a channel lazily from the channel_puzzles table, and caches it, including the absence of a
+    puzzle, for the `max_size` most recently used channels. New and finished puzzles are written through to the table.
+    Progress is written through as well, or, with a `write_delay`, collected and written in a single batch every
+    `write_delay` seconds.
+    """
+
+    def __init__(self, sessionmaker: sessionmaker, max_size: int, write_delay: float, logger: logging.Logger):
+        self.Session = sessionmaker
+        self.max_size = max_size
+        self.write_delay = write_delay
+        self.logger = logger
+        self.hits = 0
+        self.misses = 0
+        self._states: OrderedDict[int, ChannelPuzzleState | None] = OrderedDict()
+        self._loading: dict[int, asyncio.Task] = {}
+        self._dirty: dict[int, ChannelPuzzleState] = {}  # Progress not yet written to the table
+        # Held while a flush or a new puzzle is written, so a running flush is written before a puzzle that replaces
+        # or restarts the puzzle of its progress
+        self._writing = asyncio.Lock()
+        self._writer: asyncio.Task | None = None
+
+    def start(self) -> None:
+        if self.write_delay > 0:
+            self._writer = asyncio.create_task(self._write_behind())
+
+    async def stop(self) -> None:
+        if self._writer is not None:
+            self._writer.cancel()
+        await self.flush()
+
+    def _cache(self, channel_id: int, state: ChannelPuzzleState | None) -> None:
+        self._states[channel_id] = state
+        self._states.move_to_end(channel_id)
+        while len(self._states) > self.max_size:
+            self._states.popitem(last=False)
+
+    async def get(self, channel_id: int) -> ChannelPuzzleState | None:
+        """
+        State of the puzzle in the channel, or None if there is no active puzzle in the channel
+        """
+        if channel_id in self._states:
+            self.hits += 1
+            self._states.move_to_end(channel_id)
+            return self._states[channel_id]
+        if (state := self._dirty.get(channel_id)) is not None:  # Evicted before its progress was written
+            self._cache(channel_id, state)
+            return state
+        self.misses += 1
+        task = self._loading.get(channel_id)
+        if task is None:
+            task = self._loading[channel_id] = asyncio.create_task(self._load(channel_id))
+            task.add_done_callback(partial(self._loaded, channel_id))
+        state = await asyncio.shield(task)
+        # The channel may have been changed while it was loading
+        return self._states[channel_id] if channel_id in self._states else state
+
+    async def _load(self, channel_id: int) -> ChannelPuzzleState | None:
+        async with self.Session() as session:
+            c_puzzle: ChannelPuzzle = (await session.execute(select(ChannelPuzzle)
+                                                             .filter(ChannelPuzzle.channel_id == channel_id)
+                                                             .options(selectinload(ChannelPuzzle.puzzle)))).scalar()
+        if c_puzzle is None:
+            return None
+        return ChannelPuzzleState(channel_id=channel_id, puzzle=c_puzzle.puzzle, moves=list(c_puzzle.moves),
+                                  fen=c_puzzle.fen)
+
+    def _loaded(self, channel_id: int, task: asyncio.Task) -> None:
+        if self._loading.get(channel_id) is not task:  # Superseded by a change to the channel
+            return
+        del self._loading[channel_id]
+        if not task.cancelled() and task.exception() is None:
+            self._cache(channel_id, task.result())
+
+    async def put(self, state: ChannelPuzzleState) -> None:
+        """
+        Start a new puzzle in the channel, replacing the active puzzle, if any
+        """
+        self._loading.pop(state.channel_id, None)
+        self._dirty.pop(state.channel_id, None)
+        self._cache(state.channel_id, state)
+        async with self._writing, self.Session() as session:
+            async with session.begin():
+                await session.merge(ChannelPuzzle(channel_id=state.channel_id, puzzle_id=state.puzzle.puzzle_id,
+                                                  moves=state.moves, fen=state.fen))
+
+    async def update(self, state: ChannelPuzzleState) -> None:
+        """
+        Save the progress of the puzzle in the channel, after its moves and FEN were updated
+        """
+        if self.write_delay > 0:
+            self._dirty[state.channel_id] = state
+            return
+        async with self.Session() as session:
+            await session.execute(update(ChannelPuzzle)
+                                  .where(ChannelPuzzle.channel_id == state.channel_id)
+                                  .values(moves=state.moves, fen=state.fen))
+            await session.commit()
+
+    async def delete(self, channel_id: int) -> None:
+        """
+        Remove the puzzle from the channel, when it is completed or the channel is deleted
+        """
+        self._loading.pop(channel_id, None)
+        self._dirty.pop(channel_id, None)
+        self._cache(channel_id, None)
+        async with self._writing, self.Session() as session:
+            await session.execute(delete(ChannelPuzzle).where(ChannelPuzzle.channel_id == channel_id))
+            await session.commit()
+
+    async def flush(self) -> None:
+        """
+        Write the progress collected since the last flush in a single batch
+        """
+        async with self._writing:
+            if not self._dirty:
+                return
+            dirty, self._dirty = self._dirty, {}
+            params = [{'c_id': state.channel_id, 'c_puzzle_id': state.puzzle.puzzle_id, 'c_moves': state.moves,
+                       'c_fen': state.fen} for state in dirty.values()]
+            try:
+                async with self.Session() as session:
+                    # Match the puzzle too, in case the channel got another puzzle since the progress was made
+                    await session.execute(update(ChannelPuzzle.__table__)
+                                          .where(ChannelPuzzle.channel_id == bindparam('c_id'),
+                                                 ChannelPuzzle.puzzle_id == bindparam('c_puzzle_id'))
+                                          .values(moves=bindparam('c_moves'), fen=bindparam('c_fen')), params)
+                    await session.commit()
+            except Exception:
+                # Retry with the next flush, unless the channels changed in the meantime
+                for channel_id, state in dirty.items():
+                    if self._states.get(channel_id, state) is state:
+                        self._dirty.setdefault(channel_id, state)
+                raise
+
+    async def _write_behind(self) -> None:
+        while True:
+            await asyncio.sleep(self.write_delay)
+            try:
+                await self.flush()
+            except Exception as e:
+                self.logger.exception(f'Failed to write channel puzzle progress\n{type(e).__name__}: {e}')
+
+    def stats(self) -> dict[str, int | float]:
+        total = self.hits + self.misses
+        return {'channels': len(self._states), 'pending_writes': len(self._dirty), 'hits': self.hits,
+                'misses': self.misses, 'hit_ratio': self.hits / total if total else 0.0}
@@ -1,12 +1,12 @@
 import re
 
-import requests
 import discord
 from discord import app_commands
 from discord.utils import MISSING
 from discord.ext import commands
 
 from LichessBot import LichessBot
+from lichess import LichessError
 
 
 class About(commands.Cog):
@@ -20,9 +20,9 @@ class About(commands.Cog):
     async def about(self, interaction: discord.Interaction):
         self.client.logger.debug('Called About.about')
         try:
-            database_site = requests.get('https://database.lichess.org/#puzzles').content.decode('utf-8')
+            database_site = await self.client.lichess.get_text('https://database.lichess.org/#puzzles')
             n_puzzles = re.search(r'<strong>([\d,]+)</strong>', database_site).group(1)
-        except (requests.RequestException, AttributeError):
+        except (LichessError, AttributeError):
             n_puzzles = '3 million'
 
         embed = discord.Embed(title='Lichess Discord Bot', color=0xdbd7ca,
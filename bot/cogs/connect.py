@@ -18,7 +18,7 @@ from views import ConnectView
 class Connect(commands.Cog):
     def __init__(self, client: LichessBot):
         self.client = client
-        self.base_url = (f'https://lichess.org/oauth'
+        self.base_url = (f'{client.lichess.base_url}/oauth'
                          f'?response_type=code'
                          f'&client_id={os.getenv("CONNECT_CLIENT_ID")}'
                          f'&redirect_uri={os.getenv("CONNECT_REDIRECT_URI")}'
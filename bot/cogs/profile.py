@@ -1,7 +1,6 @@
 from datetime import datetime, timedelta
 import calendar
 
-import aiohttp
 import discord
 from discord import app_commands
 from discord.utils import MISSING
@@ -10,6 +9,7 @@ from sqlalchemy import select
 
 from LichessBot import LichessBot
 from database import User
+from lichess import LichessError, LichessNotFound
 
 
 class Profile(commands.Cog):
@@ -32,21 +32,17 @@ class Profile(commands.Cog):
                                                                'or use `/connect` to connect your Lichess account.')
             lichess_user = user.lichess_username
 
-        async with aiohttp.ClientSession() as web:
-            async with web.get(url=f'https://lichess.org/api/user/{lichess_user}',
-                               headers={'Accept': 'application/json'}) as resp:
-                if resp.status == 404:
-                    embed = discord.Embed(title=f'Profile', colour=0xcc7474)
-                    embed.add_field(name='Username not found',
-                                    value=f'_{lichess_user}_ is not an active Lichess account.')
-                    return await interaction.response.send_message(embed=embed)
-                try:
-                    resp.raise_for_status()
-                except aiohttp.ClientResponseError:
-                    return await interaction.response.send_message(f'Something went wrong with the Lichess API. '
-                                                                   f'If this keeps happening, please report it on the '
-                                                                   f'support server: https://discord.gg/KdpvMD72CV')
-                lichess_response = await resp.json()
+        try:
+            lichess_response = await self.client.lichess.user(lichess_user)
+        except LichessNotFound:
+            embed = discord.Embed(title=f'Profile', colour=0xcc7474)
+            embed.add_field(name='Username not found',
+                            value=f'_{lichess_user}_ is not an active Lichess account.')
+            return await interaction.response.send_message(embed=embed)
+        except LichessError:
+            return await interaction.response.send_message(f'Something went wrong with the Lichess API. '
+                                                           f'If this keeps happening, please report it on the '
+                                                           f'support server: https://discord.gg/KdpvMD72CV')
 
         try:
             embed = discord.Embed(title=f'{lichess_response["username"]}\'s profile',
@@ -92,7 +88,8 @@ class Profile(commands.Cog):
                                                            f'If this keeps happening, please report it on the '
                                                            f'support server: https://discord.gg/KdpvMD72CV')
 
-        await self.client.update_user_rating(lichess_username=lichess_user)
+        self.client.rating_refresher.observe(lichess_user,
+                                             lichess_response.get('perfs', {}).get('puzzle', {}).get('rating'))
 
 
 async def setup(client: LichessBot):
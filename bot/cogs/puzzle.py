@@ -1,21 +1,24 @@
-import os
+import random
 
-import cairosvg
 import requests
-import sqlalchemy
+from sqlalchemy import tuple_
 from sqlalchemy.future import select
-from sqlalchemy import func
+from sqlalchemy.ext.asyncio import AsyncSession
 import discord
 from discord import app_commands
 from discord.app_commands import Choice
 from discord.utils import MISSING
 from discord.ext import commands
 import chess
-from chess import svg
 
 from LichessBot import LichessBot
-from database import Puzzle, ChannelPuzzle, User
-from views import HintView
+from database import Puzzle, User
+from channel_puzzles import ChannelPuzzleState
+from solution import SolutionLine
+from rendering import render_key, board_file
+from themes import THEME_BITS, themes_mask
+from views import HintView, PuzzleView
+from prefetch import BucketKey, PreparedPuzzle
 
 THEMES: dict[str, str] = {'Middlegame': 'middlegame', 'Endgame': 'endgame', 'Short': 'short', 'One move': 'oneMove',
                           'Long': 'long', 'Very long': 'veryLong', 'Mate': 'mate', 'Mate in one': 'mateIn1',
@@ -25,6 +28,8 @@ THEMES: dict[str, str] = {'Middlegame': 'middlegame', 'Endgame': 'endgame', 'Sho
                           'Sacrifice': 'sacrifice', 'Discovered attack': 'discoveredAttack',
                           'Defensive move': 'defensiveMove', 'Advanced pawn': 'advancedPawn',
                           'Rook endgame': 'rookEndgame'}
+assert set(THEMES.values()) <= set(THEME_BITS), 'All theme choices should be in the theme vocabulary'
+THEME_CHOICES: list[Choice] = [Choice(name=k, value=v) for k, v in THEMES.items()]
 
 
 class PuzzleCog(commands.GroupCog, name='puzzle'):
@@ -32,25 +37,26 @@ class PuzzleCog(commands.GroupCog, name='puzzle'):
         super().__init__()
         self.client = client
 
-    async def show_puzzle(self, puzzle: Puzzle, interaction: discord.Interaction) -> None:
+    async def prepare_puzzle(self, puzzle: Puzzle) -> PreparedPuzzle:
+        """
+        Compute the solution line of the puzzle and render the board after the opponent's initial move
+        """
+        line = SolutionLine(puzzle.fen, puzzle.moves)
+        line.answer_table(1)  # Build the table to match the first answer ahead of time
+        png = await self.client.renderer.render(render_key(chess.BaseBoard(line.board_fen(1)), lastmove=line.moves[0],
+                                                           flipped=(line.color == 'black')))
+        return PreparedPuzzle(puzzle=puzzle, line=line, png=png)
+
+    async def show_puzzle(self, puzzle: Puzzle | PreparedPuzzle, interaction: discord.Interaction,
+                          bucket: BucketKey | None = None) -> None:
+        """
+        Show the puzzle in the channel of the interaction, or in a new thread. If the puzzle was selected from a
+        prefetch bucket, the puzzle message gets a button to get the next puzzle from that bucket.
+        """
         self.client.logger.debug('Called Puzzle.show_puzzle')
-        # Compute puzzle state
-        board = chess.Board(puzzle.fen)
-        initial_move_uci = puzzle.moves.pop(0)
-        move = board.parse_uci(initial_move_uci)
-        initial_move_san = board.san(move)
-        board.push(move)
-        fen = board.fen()
-        color = 'white' if ' w ' in fen else 'black'
-
-        # Create board image
-        image = chess.svg.board(board, lastmove=move, colors={'square light': '#f2d0a2', 'square dark': '#aa7249'},
-                                flipped=(color == 'black'))
-        cairosvg.svg2png(bytestring=str(image),
-                         write_to=f'/tmp/{interaction.channel_id}.png',
-                         parent_width=1000,
-                         parent_height=1000)
-        file = discord.File(f'/tmp/{interaction.channel_id}.png', filename="puzzle.png")
+        prepared = puzzle if isinstance(puzzle, PreparedPuzzle) else await self.prepare_puzzle(puzzle)
+        puzzle, color = prepared.puzzle, prepared.color
+        file = board_file(prepared.png, filename='puzzle.png')
 
         # Create embed
         embed = discord.Embed(title=f"Find the best move for {color}!\n(puzzle ID: {puzzle.puzzle_id})",
@@ -59,8 +65,9 @@ class PuzzleCog(commands.GroupCog, name='puzzle'):
                               )
         embed.set_image(url="attachment://puzzle.png")
         embed.add_field(name=f"Answer with `/answer`",
-                        value=f"Answer using SAN ({initial_move_san}) or UCI ({initial_move_uci}) notation\n"
-                              f"Puzzle difficulty rating: ||**{puzzle.rating}**||")
+                        value=f"Answer using SAN ({prepared.initial_move_san}) or UCI ({prepared.initial_move_uci}) "
+                              f"notation\nPuzzle difficulty rating: ||**{puzzle.rating}**||")
+        view = HintView() if bucket is None else PuzzleView(bucket=bucket)
 
         perms = interaction.app_permissions
         channel = interaction.channel
@@ -73,7 +80,7 @@ class PuzzleCog(commands.GroupCog, name='puzzle'):
                         type=discord.ChannelType.public_thread,
                         auto_archive_duration=1440,  # After 1 day
                         reason='New chess puzzle started')
-                    await channel.send(file=file, embed=embed, view=HintView(sessionmaker=self.client.Session))
+                    await channel.send(file=file, embed=embed, view=view)
                     await interaction.followup.send(f'I have created a new thread for your puzzle: {channel.mention}',
                                                     ephemeral=True)
                 else:
@@ -83,24 +90,100 @@ class PuzzleCog(commands.GroupCog, name='puzzle'):
                                                                    'messages in threads.')
             else:
                 await interaction.followup.send('Here\'s your puzzle!',
-                                                file=file, embed=embed, view=HintView(sessionmaker=self.client.Session))
+                                                file=file, embed=embed, view=view)
         except discord.Forbidden:
             await interaction.followup.send('Here\'s your puzzle!',
-                                            file=file, embed=embed, view=HintView(sessionmaker=self.client.Session))
+                                            file=file, embed=embed, view=view)
 
         # Add puzzle to channel_puzzles table
+        await self.client.channel_puzzles.put(ChannelPuzzleState(channel_id=channel.id, puzzle=puzzle,
+                                                                 moves=prepared.moves, fen=prepared.fen,
+                                                                 line=prepared.line))
+
+    @staticmethod
+    def bucket_range(bucket: BucketKey) -> tuple[int | None, int | None]:
+        """
+        Rating range of the puzzles in a prefetch bucket. Like the range around a user's puzzle rating, this is skewed
+        towards harder puzzles, and wider for puzzles with a theme.
+        """
+        rating_bucket, theme = bucket
+        if rating_bucket is None:
+            return None, None
+        rating = rating_bucket * 100 + 50
+        return (rating - 150, rating + 300) if theme is not None else (rating - 99, rating + 199)
+
+    async def select_prepared_puzzle(self, bucket: BucketKey) -> PreparedPuzzle | None:
+        """
+        Select and prepare a random puzzle for a prefetch bucket
+        """
+        rating_from, rating_to = self.bucket_range(bucket)
         async with self.client.Session() as session:
-            async with session.begin():
-                channel_puzzle = ChannelPuzzle(channel_id=channel.id,
-                                               puzzle_id=puzzle.puzzle_id,
-                                               moves=puzzle.moves,
-                                               fen=fen)
-                await session.merge(channel_puzzle)
-            await session.commit()
-
-        # Delete board image
-        if os.path.exists(f'/tmp/{interaction.channel_id}.png'):
-            os.remove(f'/tmp/{interaction.channel_id}.png')
+            puzzle = await self.random_puzzle(session, rating_from=rating_from, rating_to=rating_to,
+                                              themes=() if bucket[1] is None else [bucket[1]])
+        return None if puzzle is None else await self.prepare_puzzle(puzzle)
+
+    async def serve_puzzle(self, interaction: discord.Interaction, bucket: BucketKey) -> bool:
+        """
+        Show a puzzle from the prefetch bucket, or select one right away if the bucket is empty
+        @return: whether there is a puzzle in this bucket
+        """
+        prepared = self.client.prefetcher.pop(bucket)
+        if prepared is None:
+            prepared = await self.select_prepared_puzzle(bucket)
+            if prepared is None:
+                return False
+        await self.show_puzzle(prepared, interaction, bucket=bucket)
+        return True
+
+    async def random_puzzle(self, session: AsyncSession, rating_from: int | None = None, rating_to: int | None = None,
+                            themes: list[str] = (), excluded_themes: list[str] = ()) -> Puzzle | None:
+        """
+        Select a random puzzle with a rating in [rating_from, rating_to], all of the themes and none of the excluded
+        themes. The puzzle histogram answers whether there are any such puzzles without querying the database. The
+        puzzle is selected from the puzzle index if it is loaded, so only the selected puzzle is queried from the
+        database. Otherwise, every puzzle has an indexed random key, so a random puzzle is the first one at or after a
+        random point in the (rating, random key) order within the rating range, or in the key order without a range,
+        wrapping around to the first one if there is none.
+
+        The database selection is biased: the chance of a puzzle is the size of the gap before it in that order. Within
+        a rating range, every rating is as likely to be the starting point, so puzzles of ratings with few puzzles, and
+        the first puzzles after ratings without any matching puzzles, are selected more often than others.
+        """
+        histogram = self.client.puzzle_histogram
+        if histogram is not None and any(histogram.count(rating_from, rating_to, theme) == 0
+                                         for theme in (themes or [None])):
+            return None  # No puzzles in the rating range with (one of) the themes
+        required, excluded = themes_mask(themes), themes_mask(excluded_themes)
+        if (index := self.client.puzzle_index) is not None:
+            puzzle_id = index.sample(rating_from, rating_to, themes_all=required, themes_none=excluded)
+            if puzzle_id is None:
+                return None
+            if (puzzle := await session.get(Puzzle, puzzle_id)) is not None and not puzzle.retired:
+                return puzzle
+            # The index is behind or ahead of the database, fall back to selecting from the database
+
+        criteria = [Puzzle.retired.is_(False)]
+        if rating_from is not None:
+            criteria.append(Puzzle.rating >= rating_from)
+        if rating_to is not None:
+            criteria.append(Puzzle.rating <= rating_to)
+        if required:
+            criteria.append(Puzzle.themes_mask.op('&')(required) == required)
+        if excluded:
+            criteria.append(Puzzle.themes_mask.op('&')(excluded) == 0)
+        if rating_from is not None and rating_to is not None:
+            # Walk the (rating, random_key) index from a random point in the range, rather than the random key index,
+            # which would visit the puzzles of all ratings
+            q = select(Puzzle).filter(*criteria).order_by(Puzzle.rating, Puzzle.random_key).limit(1)
+            start = tuple_(Puzzle.rating, Puzzle.random_key) >= (random.randint(rating_from, rating_to),
+                                                                 random.random())
+        else:
+            q = select(Puzzle).filter(*criteria).order_by(Puzzle.random_key).limit(1)
+            start = Puzzle.random_key >= random.random()
+        puzzle = (await session.execute(q.filter(start))).scalar()
+        if puzzle is None:
+            puzzle = (await session.execute(q)).scalar()
+        return puzzle
 
     @app_commands.command(
         name='random',
@@ -110,31 +193,19 @@ class PuzzleCog(commands.GroupCog, name='puzzle'):
         self.client.logger.debug('Called Puzzle.rand')
         await interaction.response.defer()
         async with self.client.Session() as session:
-            q = select(User).filter(User.discord_id == interaction.user.id)
-            try:
-                user = (await session.execute(q)).scalar()
-                assert user is not None and user.puzzle_rating is not None
-            # User has not connected their Lichess account or has no puzzle rating, get a random puzzle
-            except AssertionError:
-                count = await self.client.total_nr_puzzles
-                puzzle = (await session.execute(select(Puzzle)
-                                                .offset(func.floor(func.random() * count))
-                                                .limit(1))).scalar()
-            # User has connected their Lichess account, get a puzzle near their puzzle rating
-            else:
-                q = (select(Puzzle).filter(sqlalchemy.and_(Puzzle.rating > (user.puzzle_rating - 100),
-                                                           Puzzle.rating < (user.puzzle_rating + 200))))
-                count = (await session.execute(select(func.count()).select_from(q.subquery()))).scalar()
-                puzzle = (await session.execute(q.offset(func.floor(func.random() * count)).limit(1))).scalar()
-                # No puzzle found within user's rating.
-                if puzzle is None:
-                    return await interaction.followup.send(
-                        f'I cannot find a puzzle with a rating near your puzzle rating '
-                        f'({user.puzzle_rating})! Please try `/puzzle rating` instead, or '
-                        f'`/disconnect` your lichess account to get completely random '
-                        f'puzzles.')
-            await self.show_puzzle(puzzle, interaction)
-        await self.client.update_user_rating(user.lichess_username)
+            user = (await session.execute(select(User).filter(User.discord_id == interaction.user.id))).scalar()
+        # User has not connected their Lichess account or has no puzzle rating, get a random puzzle
+        if user is None or user.puzzle_rating is None:
+            await self.serve_puzzle(interaction, (None, None))
+        # User has connected their Lichess account, get a puzzle near their puzzle rating
+        elif not await self.serve_puzzle(interaction, (user.puzzle_rating // 100, None)):
+            # No puzzle found within user's rating.
+            return await interaction.followup.send(f'I cannot find a puzzle with a rating near your puzzle rating '
+                                                   f'({user.puzzle_rating})! Please try `/puzzle rating` instead, or '
+                                                   f'`/disconnect` your lichess account to get completely random '
+                                                   f'puzzles.')
+        if user is not None:
+            self.client.rating_refresher.mark(user.lichess_username)
 
     @app_commands.command(
         name='id',
@@ -163,9 +234,7 @@ class PuzzleCog(commands.GroupCog, name='puzzle'):
             return await interaction.response.send_message(f'`rating_from` should be smaller than `rating_to`!')
         await interaction.response.defer()
         async with self.client.Session() as session:
-            q = select(Puzzle).filter(sqlalchemy.and_(Puzzle.rating > rating_from, Puzzle.rating < rating_to))
-            count = (await session.execute(select(func.count()).select_from(q.subquery()))).scalar()
-            puzzle = (await session.execute(q.offset(func.floor(func.random() * count)).limit(1))).scalar()
+            puzzle = await self.random_puzzle(session, rating_from=rating_from + 1, rating_to=rating_to - 1)
             if puzzle is None:
                 await interaction.followup.send(f'There are no puzzles with a rating between {rating_from} and '
                                                 f'{rating_to}.')
@@ -177,34 +246,48 @@ class PuzzleCog(commands.GroupCog, name='puzzle'):
         description='Get a random puzzle with a certain theme. Selects one near your rating after using /connect'
     )
     @app_commands.describe(theme='The theme of the puzzle',
+                           and_theme='Another theme the puzzle should have',
+                           not_theme='A theme the puzzle should not have',
                            ignore_rating='Ignore your own puzzle rating when getting a puzzle with this theme')
-    @app_commands.choices(theme=[Choice(name=k, value=v) for k, v in THEMES.items()])
-    async def theme(self, interaction: discord.Interaction, theme: str, ignore_rating: bool = False):
+    @app_commands.choices(theme=THEME_CHOICES, and_theme=THEME_CHOICES, not_theme=THEME_CHOICES)
+    async def theme(self, interaction: discord.Interaction, theme: str, and_theme: str = None, not_theme: str = None,
+                    ignore_rating: bool = False):
         self.client.logger.debug('Called Puzzle.theme')
         await interaction.response.defer()
-        async with self.client.Session() as session:
-            q = select(Puzzle).filter(Puzzle.themes.any(theme))
-            if not ignore_rating:
+        themes = [theme] if and_theme is None else [theme, and_theme]
+        excluded_themes = [] if not_theme is None else [not_theme]
+        description = ' and '.join(f'"{t}"' for t in themes) + ('' if not_theme is None else f' but not "{not_theme}"')
+        user = None
+        if not ignore_rating:
+            async with self.client.Session() as session:
                 user = (await session.execute(select(User).filter(User.discord_id == interaction.user.id))).scalar()
-            # User has not connected their Lichess account or has no puzzle rating
-            if ignore_rating or user is None or user.puzzle_rating is None:
-                pass
-            else:  # User has connected their Lichess account, get a puzzle near their puzzle rating
-                q = q.filter(Puzzle.rating.between((user.puzzle_rating - 150), (user.puzzle_rating + 300)))
-
-            count = (await session.execute(select(func.count()).select_from(q.subquery()))).scalar()
-            puzzle = (await session.execute(q.offset(func.floor(func.random() * count)).limit(1))).scalar()
-            if puzzle is None:
-                await interaction.followup.send(f'I cannot find a puzzle with the theme "{theme}" and a rating '
-                                                f'near your puzzle rating ({user.puzzle_rating})! Use the option '
-                                                f'`ignore_rating` to get a puzzle with this theme regardless of '
-                                                f'its rating.')
-            else:
+        # User has not connected their Lichess account or has no puzzle rating
+        rating_bucket = None if user is None or user.puzzle_rating is None else user.puzzle_rating // 100
+        if and_theme is None and not_theme is None:
+            found = await self.serve_puzzle(interaction, (rating_bucket, theme))
+        else:  # Combined themes are not prefetched
+            rating_from, rating_to = self.bucket_range((rating_bucket, theme))
+            async with self.client.Session() as session:
+                puzzle = await self.random_puzzle(session, rating_from=rating_from, rating_to=rating_to,
+                                                  themes=themes, excluded_themes=excluded_themes)
+            found = puzzle is not None
+            if found:
                 await self.show_puzzle(puzzle, interaction)
-        await self.client.update_user_rating(user.lichess_username)
+        if not found:
+            if rating_bucket is None:
+                return await interaction.followup.send(f'I cannot find a puzzle with the theme {description}!')
+            return await interaction.followup.send(f'I cannot find a puzzle with the theme {description} and a rating '
+                                                   f'near your puzzle rating ({user.puzzle_rating})! Use the option '
+                                                   f'`ignore_rating` to get a puzzle with this theme regardless of its '
+                                                   f'rating.')
+        if user is not None:
+            self.client.rating_refresher.mark(user.lichess_username)
 
 
 async def setup(client: LichessBot):
-    await client.add_cog(PuzzleCog(client),
+    cog = PuzzleCog(client)
+    client.prefetcher.source = cog.select_prepared_puzzle
+    client.prefetcher.refill((None, None))
+    await client.add_cog(cog,
                          guild=discord.Object(id=707286841577177140) if client.development else MISSING)
     client.logger.info('Sucessfully added cog: Puzzle')
@@ -1,4 +1,3 @@
-import requests
 import discord
 from discord import app_commands
 from discord.utils import MISSING
@@ -7,6 +6,7 @@ from sqlalchemy import select
 
 from LichessBot import LichessBot
 from database import User
+from lichess import LichessError, LichessNotFound
 
 
 class Rating(commands.Cog):
@@ -29,15 +29,13 @@ class Rating(commands.Cog):
                                                                '[lichess_user]` to lookup someone\'s Lichess rating, '
                                                                'or use `/connect` to connect your Lichess account.')
             lichess_user = user.lichess_username
-        resp = requests.get(f'https://lichess.org/api/user/{lichess_user}')
-        if resp.status_code == 404:
+        try:
+            lichess_response = await self.client.lichess.user(lichess_user)
+        except LichessNotFound:
             embed = discord.Embed(title=f"Rating", colour=0xcc7474)
             embed.add_field(name="Username not found", value=f"{lichess_user} is not an active Lichess account.")
             return await interaction.response.send_message(embed=embed)
-        try:
-            resp.raise_for_status()
-
-        except requests.HTTPError:
+        except LichessError:
             return await interaction.response.send_message(f'Something went wrong with the Lichess API. If this keeps '
                                                            f'happening, please report it on the support server: '
                                                            f'https://discord.gg/KdpvMD72CV')
@@ -47,7 +45,7 @@ class Rating(commands.Cog):
         embed.set_thumbnail(url='https://raw.githubusercontent.com/tvdhout/Lichess-discord-bot/master/media'
                                 '/lichesslogo.png')
 
-        ratings = resp.json()['perfs']
+        ratings = lichess_response['perfs']
         for mode in ratings:
             try:
                 embed.add_field(name=mode.capitalize(),
@@ -65,8 +63,7 @@ class Rating(commands.Cog):
 
         await interaction.response.send_message(embed=embed)
 
-        if user is not None:
-            await self.client.update_user_rating(lichess_username=user.lichess_username)
+        self.client.rating_refresher.observe(lichess_user, ratings.get('puzzle', {}).get('rating'))
 
 
 async def setup(client: LichessBot):
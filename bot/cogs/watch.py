@@ -1,63 +1,22 @@
-import asyncio
-import os
 import re
-import json
-import time
-import aiohttp
 
-import requests
-import cairosvg
 import chess
 import discord
-from chess import svg
 from discord import app_commands
 from discord.utils import MISSING
 from discord.ext import commands
-from sqlalchemy import select, delete
 
 from LichessBot import LichessBot
-from database import WatchedGame
+from lichess import LichessError, LichessNotFound
 from views import FlipBoardView
+from rendering import RenderTimeoutError, board_file
+from live_games import state_key
 
 
 class Watch(commands.Cog):
     def __init__(self, client: LichessBot):
         self.client = client
 
-    @staticmethod
-    def format_seconds(sec: int) -> str:
-        if sec >= 3600:
-            return time.strftime('⏱ %Hh %Mm %Ss', time.gmtime(sec))
-        if sec >= 60:
-            return time.strftime('⏱ %Mm %Ss', time.gmtime(sec))
-        return f'⏱ {sec}s'
-
-    async def update_board(self, message: discord.Message, state: dict, white: str, black: str, flipped: bool):
-        embed = message.embeds[0]
-        embed.clear_fields()
-        embed.colour = 0x000000 if flipped else 0xeeeeee
-        embed.add_field(name=white, value=self.format_seconds(state['wc']), inline=True)
-        embed.add_field(name=black, value=self.format_seconds(state['bc']), inline=True)
-
-        board = chess.Board(state['fen'])
-        lastmove_uci = state.get('lm', None)
-        if lastmove_uci:
-            lastmove = chess.Move(chess.parse_square(lastmove_uci[:2]),
-                                  chess.parse_square(lastmove_uci[2:]))
-        else:
-            lastmove = None
-        image = chess.svg.board(board,
-                                lastmove=lastmove,
-                                colors={'square light': '#f2d0a2', 'square dark': '#aa7249'},
-                                flipped=flipped)
-        cairosvg.svg2png(bytestring=str(image),
-                         write_to=f'/tmp/{message.id}.png',
-                         parent_width=1000,
-                         parent_height=1000)
-        file = discord.File(f'/tmp/{message.id}.png', filename=f"{message.id}.png")
-        embed.set_image(url=f'attachment://{message.id}.png')
-        await message.edit(embed=embed, attachments=[file])
-
     @app_commands.command(
         name='watch',
         description='Watch a (live) lichess game',
@@ -74,13 +33,14 @@ class Watch(commands.Cog):
             game_id = url[:8]
         color: bool = chess.BLACK if 'black' in url else chess.WHITE
         try:
-            async with aiohttp.ClientSession(raise_for_status=True) as req:
-                async with req.get(url=f'https://lichess.org/game/export/{game_id}',
-                                   headers={'Accept': 'application/json'}) as resp:
-                    game = await resp.json()
-        except (requests.HTTPError, json.JSONDecodeError):
+            game = await self.client.lichess.game_export(game_id)
+        except LichessNotFound:
             return await interaction.followup.send(f'There is no Lichess game with ID _{game_id}_. '
                                                    f'Note that game IDs are case sensitive.')
+        except LichessError:
+            return await interaction.followup.send('Something went wrong with the Lichess API. If this keeps '
+                                                   'happening, please report it on the support server: '
+                                                   'https://discord.gg/KdpvMD72CV')
         if game['speed'] == 'correspondence':
             return await interaction.followup.send(f"I'm sorry, I can't follow correspondence games.")
 
@@ -125,71 +85,28 @@ class Watch(commands.Cog):
             embed.add_field(name=white_player_str, value='⏱ _Please wait..._', inline=True)
             embed.add_field(name=black_player_str, value='⏱ _Please wait..._', inline=True)
 
-            async with aiohttp.ClientSession() as web:
-                try:
-                    async with web.get(f'https://lichess.org/api/stream/game/{game_id}', timeout=3600) as stream:
-                        game_state = json.loads(await stream.content.readline())
-                        board = chess.Board(game_state['fen'])
-                        latest_fen = ' '.join(game_state['fen'].split()[:2])
-                        lastmove_uci = game_state.get('lastMove', None)
-                        if lastmove_uci is not None:
-                            lastmove = chess.Move(chess.parse_square(lastmove_uci[:2]),
-                                                  chess.parse_square(lastmove_uci[2:]))
-                        else:
-                            lastmove = None
-                        image = chess.svg.board(board, lastmove=lastmove,
-                                                colors={'square light': '#f2d0a2', 'square dark': '#aa7249'},
-                                                flipped=(color == chess.BLACK))
-                        cairosvg.svg2png(bytestring=str(image),
-                                         write_to=f'/tmp/{game_id}.png',
-                                         parent_width=1000,
-                                         parent_height=1000)
-                        file = discord.File(f'/tmp/{game_id}.png', filename=f"{game_id}.png")
-                        embed.set_image(url=f'attachment://{game_id}.png')
-                        msg = await interaction.channel.send(embed=embed, file=file,
-                                                             view=FlipBoardView(sessionmaker=self.client.Session))
-                        async with self.client.Session() as session:
-                            session.add(
-                                WatchedGame(message_id=msg.id,
-                                            watcher_id=interaction.user.id,
-                                            game_id=game_id,
-                                            color=color))
-                            await session.commit()
-
-                        up_to_date = False
-
-                        async with self.client.Session() as session:
-                            stop = False
-                            async for line in stream.content:
-                                if line == b'\n':  # Sent to keep open the connection
-                                    continue
-                                state = json.loads(line)
-                                assert 'wc' in state, "Game over, summary shown"
-                                if not up_to_date:
-                                    if state['fen'] == latest_fen:
-                                        up_to_date = True
-                                    else:
-                                        continue
-                                color: bool = (await (session.execute(
-                                    select(WatchedGame.color)
-                                    .filter(WatchedGame.message_id == msg.id))
-                                )).scalar()
-                                try:
-                                    await self.update_board(message=msg, state=state, white=white_player_str,
-                                                            black=black_player_str, flipped=color == chess.BLACK)
-                                except discord.errors.NotFound:
-                                    stop = True
-                                    break
-                            raise InterruptedError  # Game finished
-                except (asyncio.exceptions.TimeoutError, InterruptedError, AssertionError):
-                    async with self.client.Session() as session:
-                        await session.execute(delete(WatchedGame)
-                                              .where(WatchedGame.message_id == msg.id))
-                        await session.commit()
-                    if os.path.exists(f'/tmp/{game_id}.png'):
-                        os.remove(f'/tmp/{game_id}.png')
-                    if stop:  # Message with game deleted
-                        return
+            live_game = await self.client.live_games.join(game_id, white=white_player_str, black=black_player_str)
+            if live_game.state is None:  # The game could not be followed, which does not mean it ended
+                return await interaction.followup.send(f"I'm sorry, I can't follow game `{game_id}` right now. "
+                                                       f"Please try again in a minute.")
+            # Leave the game when it is not shown, so it is not followed without any watchers
+            try:
+                png = await self.client.renderer.render(state_key(live_game.state, flipped=(color == chess.BLACK)))
+                file = board_file(png, filename=f'{game_id}.png')
+                embed.set_image(url=f'attachment://{game_id}.png')
+                msg = await interaction.channel.send(embed=embed, file=file, view=FlipBoardView())
+            except RenderTimeoutError:
+                await self.client.live_games.leave(live_game)
+                return await interaction.followup.send(f"I'm sorry, I can't show game `{game_id}` right now. "
+                                                       f"Please try again in a minute.")
+            except BaseException:
+                await self.client.live_games.leave(live_game)
+                raise
+            watcher = await self.client.live_games.add_watcher(live_game, msg, watcher_id=interaction.user.id,
+                                                               flipped=(color == chess.BLACK))
+            if not await watcher.done:  # Message with game deleted
+                return
+            color = chess.BLACK if watcher.flipped else chess.WHITE
 
         else:  # Game is not ongoing at command invocation
             await interaction.followup.send(f'Replaying game `{game_id}`:')
@@ -200,8 +117,10 @@ class Watch(commands.Cog):
                             f'{game_id}.gif')
 
         if msg is not None:  # Game was previously in progres, get the updated stats
-            game = requests.get(url=f'https://lichess.org/game/export/{game_id}',
-                                headers={'Accept': 'application/json'}).json()
+            try:
+                game = await self.client.lichess.game_export(game_id, refresh=True)
+            except LichessError:
+                pass  # Show the stats from the start of the game
 
         def analysis(color) -> str:
             p: dict = game['players'][color]
@@ -220,9 +139,9 @@ class Watch(commands.Cog):
         embed.add_field(name=white_player_str, value=analysis('white'), inline=True)
         embed.add_field(name=black_player_str, value=analysis('black'), inline=True)
         if msg is None:
-            await interaction.channel.send(embed=embed, view=FlipBoardView(sessionmaker=self.client.Session))
+            await interaction.channel.send(embed=embed, view=FlipBoardView())
         else:
-            await msg.edit(embed=embed, view=FlipBoardView(sessionmaker=self.client.Session), attachments=[])
+            await msg.edit(embed=embed, view=FlipBoardView(), attachments=[])
 
 
 async def setup(client: LichessBot):
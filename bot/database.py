@@ -1,12 +1,11 @@
 import asyncio
+import logging
 import os
 import sys
 
-import numpy as np
-import pandas as pd
 from dotenv import load_dotenv
 import sqlalchemy as sa
-from sqlalchemy import Column, ARRAY, Integer, SmallInteger, BigInteger, String, Text, Boolean
+from sqlalchemy import Column, ARRAY, Integer, SmallInteger, BigInteger, String, Text, Boolean, Float
 from sqlalchemy.orm import relationship, declarative_base
 from sqlalchemy.ext.asyncio import create_async_engine
 from sqlalchemy.dialects import postgresql
@@ -36,14 +35,22 @@ class Puzzle(Base):
     popularity: Column | int = Column(SmallInteger, nullable=False)
     nr_plays: Column | int = Column(Integer, nullable=False)
     themes: Column | list[str] = Column(postgresql.ARRAY(Text), nullable=False, default=[])
+    themes_mask: Column | int = Column(BigInteger, nullable=False, server_default='0')  # See themes.THEME_VOCABULARY
     url: Column | str = Column(String, nullable=False)
     opening_family: Column | str = Column(String)
     opening_variation: Column | str = Column(String)
+    # Uniform random number in [0, 1) used to select a random puzzle through an index
+    random_key: Column | float = Column(Float, nullable=False, server_default=sa.func.random(), index=True)
+    content_hash: Column | int = Column(BigInteger)  # Hash of the source record, see ingestion.content_hashes
+    retired: Column | bool = Column(Boolean, nullable=False, server_default=sa.false())  # No longer in the source
 
     channels = relationship('ChannelPuzzle', cascade='all, delete, delete-orphan, save-update', back_populates='puzzle')
 
-    # GIN index on themes
-    __table_args__ = (sa.Index('ix_puzzles_themes', themes, postgresql_using='gin'),)
+    # GIN index on themes, an index to filter on the theme bits within a rating range, and an index to select a random
+    # puzzle within a rating range
+    __table_args__ = (sa.Index('ix_puzzles_themes', themes, postgresql_using='gin'),
+                      sa.Index('ix_puzzles_rating_themes_mask', rating, themes_mask),
+                      sa.Index('ix_puzzles_rating_random_key', rating, random_key))
 
 
 class ChannelPuzzle(Base):
@@ -98,46 +105,35 @@ async def drop_database():
                 await conn.execute(sa.text('DROP TABLE :t CASCADE'), {'t': AsIs(table_name)})
 
 
-async def update_puzzles_table():
-    """
-    1. Downloads the puzzle database from https://database.lichess.org/lichess_db_puzzle.csv.bz2
-    2. Unzip the csv
-    3. In manageble chunks, read the CSV with pandas, transform the columns where needed, and ingest puzzles in the
-    database, updating puzzles where present
-    """
-    engine = create_async_engine(f'postgresql+asyncpg://{os.getenv("DATABASE_USER")}'
-                                 f':{os.getenv("DATABASE_PASSWORD")}'
-                                 f'@{os.getenv("DATABASE_HOST")}'
-                                 f'/{os.getenv("DATABASE_NAME")}',
-                                 future=True)
-    os.system('wget -O /tmp/puzzles.csv.zst https://database.lichess.org/lichess_db_puzzle.csv.zst '
-              '&& unzstd --rm /tmp/puzzles.csv.zst')
-
-    try:
-        async with engine.begin() as conn:
-            with pd.read_csv('/tmp/puzzles.csv', chunksize=1000,
-                             names=['puzzle_id', 'fen', 'moves', 'rating', 'rating_deviation', 'popularity', 'nr_plays',
-                                    'themes', 'url', 'opening_family', 'opening_variation']) as reader:
-                for df in reader:
-                    df.moves = df.moves.map(str.split)
-                    df.themes = df.themes.map(str.split, na_action='ignore')
-                    df.opening_family = df.opening_family.str.replace('_', ' ', regex=False)
-                    df.opening_variation = df.opening_variation.str.replace('_', ' ', regex=False)
-                    df.replace({np.nan: None}, inplace=True)
-                    insert_statement = postgresql.insert(Puzzle.__table__).values(df.to_dict(orient='records'))
-                    upsert_statement = insert_statement.on_conflict_do_update(index_elements=['puzzle_id'],
-                                                                              set_={c.key: c for c in
-                                                                                    insert_statement.excluded if
-                                                                                    c.key != 'puzzle_id'})
-                    await conn.execute(upsert_statement)
-    finally:
-        if os.path.exists('/tmp/puzzles.csv'):
-            os.remove('/tmp/puzzles.csv')
+# Columns and indexes added after the initial release, which create_all does not add to existing tables
+MIGRATIONS: list[str] = [
+    'ALTER TABLE puzzles ADD COLUMN IF NOT EXISTS random_key FLOAT NOT NULL DEFAULT random()',
+    'CREATE INDEX IF NOT EXISTS ix_puzzles_random_key ON puzzles (random_key)',
+    'ALTER TABLE puzzles ADD COLUMN IF NOT EXISTS themes_mask BIGINT NOT NULL DEFAULT 0',
+    'CREATE INDEX IF NOT EXISTS ix_puzzles_rating_themes_mask ON puzzles (rating, themes_mask)',
+    'ALTER TABLE puzzles ADD COLUMN IF NOT EXISTS content_hash BIGINT',
+    'ALTER TABLE puzzles ADD COLUMN IF NOT EXISTS retired BOOLEAN NOT NULL DEFAULT false',
+    'CREATE INDEX IF NOT EXISTS ix_puzzles_rating_random_key ON puzzles (rating, random_key)',
+]
 
 
 async def create_tables():
+    # Imported here rather than at the top, so the web app can import this module without the other bot modules
+    from themes import THEME_VOCABULARY
+
     async with engine.begin() as conn:
         await conn.run_sync(Base.metadata.create_all)
+        # create_all adds the column to a new table, so it is only missing from puzzles ingested before it existed
+        has_themes_mask = (await conn.execute(sa.text(
+            "SELECT 1 FROM information_schema.columns WHERE table_name = 'puzzles' AND column_name = 'themes_mask'"
+        ))).first() is not None
+        for migration in MIGRATIONS:
+            await conn.execute(sa.text(migration))
+        if not has_themes_mask:  # Fill the mask of the existing puzzles, once
+            await conn.execute(sa.text(
+                f"UPDATE puzzles SET themes_mask = (SELECT COALESCE(BIT_OR(1::BIGINT << (array_position("
+                f"ARRAY[{', '.join(repr(theme) for theme in THEME_VOCABULARY)}], theme) - 1)), 0) "
+                f"FROM unnest(themes) AS theme)"))
 
 
 if __name__ == '__main__':
@@ -149,4 +145,16 @@ if __name__ == '__main__':
             print("Not dropping tables.")
     asyncio.run(create_tables())
     if 'UPDATE' in sys.argv:
-        asyncio.run(update_puzzles_table())
+        from logger import CustomFormatter
+        from update_puzzles import PUZZLE_DATABASE_URL, update_puzzles_table
+
+        handler = logging.StreamHandler()
+        handler.setFormatter(CustomFormatter())
+        logging.getLogger('bot').addHandler(handler)
+        logging.getLogger('bot').setLevel(logging.INFO)
+
+        # A local copy of the puzzle database can be passed as an argument, e.g. for offline testing
+        source = next((arg for arg in sys.argv[1:] if arg.endswith('.zst')), PUZZLE_DATABASE_URL)
+        mode = 'incremental' if 'INCREMENTAL' in sys.argv else 'copy' if 'COPY' in sys.argv else 'upsert'
+        asyncio.run(update_puzzles_table(source=source, mode=mode, delete_missing='DELETE' in sys.argv,
+                                         force='FORCE' in sys.argv))
@@ -0,0 +1,151 @@
+"""
+Scheduling of message edits that show a changing state, like the board of a live game. Only the newest state of a
+message is kept while it waits for its turn, so a message skips intermediate states instead of falling behind. Edits
+are spaced per message and limited by a global budget, both of which adapt when Discord rate limits the bot.
+"""
+import asyncio
+import logging
+import time
+from typing import Any, Awaitable, Callable, Hashable
+
+import discord
+
+from metrics import LIVE_EDITS, LIVE_EDIT_LAG, LIVE_EDIT_RATE_LIMITS
+
+
+class EditBudget:
+    """
+    Token bucket shared by all edits. The rate is halved when an edit is rate limited, and recovers slowly with every
+    edit that is not.
+    """
+
+    def __init__(self, rate: float, min_rate: float = 1.0):
+        self.max_rate = rate
+        self.min_rate = min(min_rate, rate)
+        self.rate = rate
+        self._tokens = rate
+        self._updated = time.monotonic()
+
+    async def acquire(self) -> None:
+        while True:
+            now = time.monotonic()
+            self._tokens = min(self.rate, self._tokens + (now - self._updated) * self.rate)
+            self._updated = now
+            if self._tokens >= 1:
+                self._tokens -= 1
+                return
+            await asyncio.sleep((1 - self._tokens) / self.rate)
+
+    def rate_limited(self) -> None:
+        self.rate = max(self.min_rate, self.rate / 2)
+
+    def succeeded(self) -> None:
+        self.rate = min(self.max_rate, self.rate + 0.1)
+
+
+class _Slot:
+    def __init__(self, interval: float):
+        self.interval = interval  # Seconds between edits of the message
+        self.next_edit = 0.0
+        self.pending: tuple[Any, float] | None = None  # Newest state not shown yet, and when it was submitted
+        self.worker: asyncio.Task | None = None
+
+
+class EditScheduler:
+    def __init__(self, logger: logging.Logger, budget: float, min_interval: float, max_interval: float,
+                 slow_edit: float = 1.0):
+        """
+        @param budget: edits per second across all messages
+        @param min_interval: seconds between edits of one message, doubled up to max_interval when rate limited
+        @param slow_edit: an edit that takes longer than this many seconds was held back by discord.py's rate limit
+        handling, and counts as rate limited
+        """
+        self.logger = logger
+        self.budget = EditBudget(rate=budget)
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.slow_edit = slow_edit
+        self.edits = 0
+        self.skipped = 0  # States replaced by a newer state before they were shown
+        self.rate_limited = 0
+        self.lag_total = 0.0  # Seconds from submitting a state to showing it, summed over all edits
+        self.lag_max = 0.0
+        self._slots: dict[Hashable, _Slot] = {}
+
+    def submit(self, key: Hashable, state: Any, show: Callable[[Any], Awaitable[None]]) -> None:
+        """
+        Show the state in the message with the key as soon as the message may be edited, unless a newer state is
+        submitted before that
+        @param show: renders the state and edits the message
+        """
+        slot = self._slots.get(key)
+        if slot is None:
+            slot = self._slots[key] = _Slot(self.min_interval)
+        if slot.pending is not None:
+            self.skipped += 1
+            LIVE_EDITS.inc(shard='all', result='skipped')
+        slot.pending = (state, time.monotonic())
+        if slot.worker is None or slot.worker.done():
+            slot.worker = asyncio.create_task(self._work(key, slot, show))
+
+    def discard(self, key: Hashable) -> None:
+        """
+        Forget the message, dropping its pending state
+        """
+        if (slot := self._slots.pop(key, None)) is not None:
+            slot.pending = None
+
+    async def close(self, key: Hashable) -> None:
+        """
+        Forget the message, and wait for an edit in progress to finish
+        """
+        if (slot := self._slots.pop(key, None)) is not None:
+            slot.pending = None
+            if slot.worker is not None and slot.worker is not asyncio.current_task():
+                await asyncio.gather(slot.worker, return_exceptions=True)
+
+    async def _work(self, key: Hashable, slot: _Slot, show: Callable[[Any], Awaitable[None]]) -> None:
+        while slot.pending is not None:
+            if (delay := slot.next_edit - time.monotonic()) > 0:
+                await asyncio.sleep(delay)
+            await self.budget.acquire()
+            if slot.pending is None:  # Discarded while waiting
+                return
+            (state, submitted), slot.pending = slot.pending, None
+            start = time.monotonic()
+            try:
+                await show(state)
+            except discord.HTTPException as e:
+                if e.status != 429:
+                    self.logger.warning(f'Failed to edit message {key}: {e}')
+                    LIVE_EDITS.inc(shard='all', result='failed')
+                    continue
+                self._rate_limited(slot)
+            except Exception as e:
+                self.logger.exception(f'Failed to edit message {key}\n{type(e).__name__}: {e}')
+                LIVE_EDITS.inc(shard='all', result='failed')
+                continue
+            else:
+                end = time.monotonic()
+                self.edits += 1
+                self.lag_total += end - submitted
+                self.lag_max = max(self.lag_max, end - submitted)
+                LIVE_EDITS.inc(shard='all', result='shown')
+                LIVE_EDIT_LAG.observe(end - submitted, shard='all')
+                if end - start > self.slow_edit:
+                    self._rate_limited(slot)
+                else:
+                    slot.interval = max(self.min_interval, slot.interval * 0.9)
+                    self.budget.succeeded()
+            slot.next_edit = time.monotonic() + slot.interval
+
+    def _rate_limited(self, slot: _Slot) -> None:
+        self.rate_limited += 1
+        LIVE_EDIT_RATE_LIMITS.inc(shard='all')
+        slot.interval = min(self.max_interval, slot.interval * 2)
+        self.budget.rate_limited()
+
+    def stats(self) -> dict[str, int | float]:
+        return {'messages': len(self._slots), 'edits': self.edits, 'skipped': self.skipped,
+                'rate_limited': self.rate_limited, 'budget': self.budget.rate,
+                'lag_avg': self.lag_total / self.edits if self.edits else 0.0, 'lag_max': self.lag_max}
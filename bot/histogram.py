@@ -0,0 +1,81 @@
+"""
+Cumulative histogram of the number of puzzles per rating point, in total and per theme
+"""
+from typing import Iterable
+
+import numpy as np
+
+from themes import THEME_VOCABULARY
+
+THEME_ROWS: dict[str, int] = {theme: i + 1 for i, theme in enumerate(THEME_VOCABULARY)}  # Row 0 counts all puzzles
+
+
+class PuzzleHistogram:
+    def __init__(self, min_rating: int, counts: np.ndarray):
+        """
+        @param min_rating: rating of the first column of counts
+        @param counts: number of puzzles per rating point, one row for all puzzles followed by one row per theme
+        """
+        self.min_rating = min_rating
+        self.nr_ratings = counts.shape[1]
+        # cumulative[row, i] is the number of puzzles with a rating below min_rating + i
+        self._cumulative = np.zeros((counts.shape[0], self.nr_ratings + 1), dtype=np.int64)
+        np.cumsum(counts, axis=1, out=self._cumulative[:, 1:])
+
+    @classmethod
+    def from_arrays(cls, ratings: np.ndarray, masks: np.ndarray) -> 'PuzzleHistogram':
+        """
+        Histogram of puzzles given their ratings and theme bitmasks
+        """
+        if len(ratings) == 0:
+            return cls(0, np.zeros((len(THEME_ROWS) + 1, 1), dtype=np.int64))
+        min_rating = int(ratings.min())
+        positions = np.asarray(ratings, dtype=np.int64) - min_rating
+        nr_ratings = int(positions.max()) + 1
+        counts = np.empty((len(THEME_ROWS) + 1, nr_ratings), dtype=np.int64)
+        counts[0] = np.bincount(positions, minlength=nr_ratings)
+        for bit in range(len(THEME_VOCABULARY)):
+            has_theme = (masks & np.uint64(1 << bit)) != 0
+            counts[bit + 1] = np.bincount(positions[has_theme], minlength=nr_ratings)
+        return cls(min_rating, counts)
+
+    @classmethod
+    def from_counts(cls, totals: Iterable[tuple[int, int]],
+                    theme_counts: Iterable[tuple[int, str, int]]) -> 'PuzzleHistogram':
+        """
+        Histogram from (rating, count) rows of all puzzles and (rating, theme, count) rows per theme, as aggregated by
+        the database. Themes that are not in the vocabulary are ignored.
+        """
+        totals, theme_counts = list(totals), list(theme_counts)
+        if not totals:
+            return cls(0, np.zeros((len(THEME_ROWS) + 1, 1), dtype=np.int64))
+        min_rating = min(rating for rating, _ in totals)
+        counts = np.zeros((len(THEME_ROWS) + 1, max(rating for rating, _ in totals) - min_rating + 1), dtype=np.int64)
+        for rating, count in totals:
+            counts[0, rating - min_rating] = count
+        for rating, theme, count in theme_counts:
+            if theme in THEME_ROWS:
+                counts[THEME_ROWS[theme], rating - min_rating] = count
+        return cls(min_rating, counts)
+
+    def _position(self, rating: int) -> int:
+        return min(max(rating - self.min_rating, 0), self.nr_ratings)
+
+    def count(self, rating_from: int | None = None, rating_to: int | None = None, theme: str | None = None) -> int:
+        """
+        Number of puzzles with a rating in [rating_from, rating_to] and the theme, in constant time
+        """
+        row = self._cumulative[0 if theme is None else THEME_ROWS[theme]]
+        start = 0 if rating_from is None else self._position(rating_from)
+        stop = self.nr_ratings if rating_to is None else self._position(rating_to + 1)
+        return int(row[stop] - row[start]) if stop > start else 0
+
+    def nth(self, n: int, rating_from: int | None = None, theme: str | None = None) -> tuple[int, int]:
+        """
+        Locate the n-th (from 0) puzzle with the theme, counting up from rating_from
+        @return: the rating of that puzzle, and its position among the puzzles with the theme and that rating
+        """
+        row = self._cumulative[0 if theme is None else THEME_ROWS[theme]]
+        target = row[0 if rating_from is None else self._position(rating_from)] + n
+        position = int(np.searchsorted(row, target, side='right')) - 1
+        return self.min_rating + position, int(target - row[position])
@@ -0,0 +1,157 @@
+"""
+Streaming pipeline to read the Lichess puzzle database: the compressed dump is decompressed incrementally from a file
+or HTTP source, split into batches of whole records, and the batches are parsed in a pool of worker processes. Only
+a bounded number of batches is in flight at once, so memory use does not depend on the size of the dump, and nothing
+is written to disk.
+"""
+import asyncio
+import hashlib
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from typing import AsyncIterator, Callable, TypeVar
+
+import aiohttp
+import numpy as np
+import pandas as pd
+import zstandard
+
+T = TypeVar('T')
+
+READ_SIZE = 1024 * 1024
+
+
+async def read_source(source: str) -> AsyncIterator[bytes]:
+    """
+    Read the raw bytes of a local file, or of a URL when the source starts with http(s)://
+    """
+    if source.startswith(('http://', 'https://')):
+        async with aiohttp.ClientSession(raise_for_status=True) as web:
+            async with web.get(source, timeout=aiohttp.ClientTimeout(total=None, sock_read=60)) as resp:
+                async for chunk in resp.content.iter_chunked(READ_SIZE):
+                    yield chunk
+    else:
+        with open(source, 'rb') as f:
+            while chunk := await asyncio.to_thread(f.read, READ_SIZE):
+                yield chunk
+
+
+async def decompress_zstd(chunks: AsyncIterator[bytes]) -> AsyncIterator[bytes]:
+    """
+    Incrementally decompress a zstd stream, which may consist of multiple frames
+    @raise zstandard.ZstdError: when the stream ends in the middle of a frame, e.g. after an interrupted download
+    """
+    decompressor = zstandard.ZstdDecompressor()
+    decompressobj = decompressor.decompressobj()
+    in_frame = False  # Whether input of the current frame was read
+    async for chunk in chunks:
+        in_frame = in_frame or bool(chunk)
+        while chunk:
+            data = decompressobj.decompress(chunk)
+            if data:
+                yield data
+            chunk = b''
+            if decompressobj.eof:  # End of a frame, continue with the next one
+                chunk = decompressobj.unused_data
+                in_frame = bool(chunk)
+                decompressobj = decompressor.decompressobj()
+    if in_frame:
+        raise zstandard.ZstdError('The zstd stream ends in the middle of a frame')
+
+
+async def split_records(stream: AsyncIterator[bytes], batch_size: int) -> AsyncIterator[bytes]:
+    """
+    Split a stream of CSV data into batches of about batch_size bytes that end at a record boundary. A header line at
+    the start of the stream is dropped.
+    """
+    buffer = bytearray()  # Appended to and consumed in place, rather than copying the remainder for every chunk
+    first = True
+    async for data in stream:
+        buffer += data
+        if first and b'\n' in buffer:
+            if buffer.startswith(b'PuzzleId,'):
+                del buffer[:buffer.index(b'\n') + 1]
+            first = False
+        if len(buffer) >= batch_size and (end := buffer.rfind(b'\n')) != -1:
+            yield bytes(buffer[:end + 1])
+            del buffer[:end + 1]
+    if buffer.strip():
+        yield bytes(buffer)
+
+
+async def parse_batches(batches: AsyncIterator[bytes], parse: Callable[[bytes], T], workers: int,
+                        queue_size: int) -> AsyncIterator[T]:
+    """
+    Parse batches in a process pool, yielding the results in order. At most queue_size batches are parsed or waiting
+    to be consumed at once; reading the source pauses until the consumer catches up.
+    """
+    loop = asyncio.get_running_loop()
+    queue: asyncio.Queue[asyncio.Future | None] = asyncio.Queue(maxsize=queue_size)
+
+    async def produce(executor: ProcessPoolExecutor):
+        try:
+            async for batch in batches:
+                await queue.put(loop.run_in_executor(executor, parse, batch))
+        except asyncio.CancelledError:
+            raise  # The consumer stopped, so the queue may stay full and nobody waits for its end
+        except BaseException:
+            await queue.put(None)
+            raise
+        await queue.put(None)
+
+    executor = ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context('forkserver'))
+    producer = asyncio.create_task(produce(executor))
+    try:
+        while (future := await queue.get()) is not None:
+            yield await future
+        await producer  # Raise errors of reading the source
+    finally:
+        producer.cancel()
+        # Do not block the event loop until the workers finish their current batches, e.g. after an error
+        executor.shutdown(wait=False, cancel_futures=True)
+
+
+async def stream_puzzle_batches(source: str, parse: Callable[[bytes], T], batch_size: int = 4 * 1024 * 1024,
+                                workers: int | None = None, queue_size: int = 8) -> AsyncIterator[T]:
+    """
+    Parsed batches of the zstd compressed puzzle database CSV at the source (a file path or URL)
+    """
+    records = split_records(decompress_zstd(read_source(source)), batch_size=batch_size)
+    async for result in parse_batches(records, parse, workers=workers or multiprocessing.cpu_count(),
+                                      queue_size=queue_size):
+        yield result
+
+
+def content_hashes(df: pd.DataFrame) -> list[int]:
+    """
+    Signed 64-bit hash of the contents of every row, to detect which rows changed since the last ingestion
+    """
+    return [int.from_bytes(hashlib.blake2b('\x1f'.join(map(str, row)).encode('utf-8'), digest_size=8).digest(),
+                           byteorder='big', signed=True)
+            for row in df.itertuples(index=False, name=None)]
+
+
+class ContentHashDiff:
+    """
+    Compares streamed rows against the content hashes of the rows in the database, and keeps track of which database
+    rows were seen, to find the rows that disappeared from the source
+    """
+
+    def __init__(self, ids: np.ndarray, hashes: np.ndarray):
+        order = np.argsort(ids)
+        self.ids = ids[order]
+        self.hashes = hashes[order]
+        self.seen = np.zeros(len(ids), dtype=bool)
+
+    def changed(self, ids: np.ndarray, hashes: np.ndarray) -> np.ndarray:
+        """
+        Boolean mask of the rows that are new or have a different hash than in the database
+        """
+        if len(self.ids) == 0:
+            return np.ones(len(ids), dtype=bool)
+        positions = np.minimum(np.searchsorted(self.ids, ids), len(self.ids) - 1)
+        found = self.ids[positions] == ids
+        self.seen[positions[found]] = True
+        return ~(found & (self.hashes[positions] == hashes))
+
+    def missing(self) -> list[str]:
+        return [puzzle_id.decode() for puzzle_id in self.ids[~self.seen]]
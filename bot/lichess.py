@@ -0,0 +1,324 @@
+"""
+Async client of the Lichess API, shared by the whole bot. Requests share one connection pool, are limited in number,
+and are retried with jitter. A 429 response pauses all requests for the time Lichess asks, and a circuit breaker stops
+sending requests for a while when Lichess keeps failing.
+https://lichess.org/api
+"""
+import asyncio
+import json
+import logging
+import random
+import time
+from collections import OrderedDict
+from contextlib import asynccontextmanager
+from typing import Any, AsyncIterator, Awaitable, Callable, Hashable
+
+import aiohttp
+
+from metrics import LICHESS_SECONDS, LICHESS_RESPONSES
+
+LICHESS_URL = 'https://lichess.org'
+RATE_LIMIT_BACKOFF = 60.0  # Seconds to wait after a 429 without a Retry-After header, as the API documentation asks
+# Seconds a stream may go without any data, a bit longer than the interval of the empty lines Lichess sends to keep
+# idle streams open. A connection that died without closing is detected after this time.
+STREAM_READ_TIMEOUT = 20.0
+
+
+class LichessError(Exception):
+    def __init__(self, message: str, status: int | None = None):
+        super().__init__(message)
+        self.status = status
+
+
+class LichessNotFound(LichessError):
+    pass
+
+
+class LichessUnavailable(LichessError):
+    """
+    Lichess did not respond successfully after retrying, or the circuit breaker is open
+    """
+
+
+class LichessRateLimited(LichessUnavailable):
+    pass
+
+
+class CircuitBreaker:
+    """
+    Opens after `threshold` consecutive failures, and then lets a single trial request through every `reset_timeout`
+    seconds. A successful request closes it again.
+    """
+
+    def __init__(self, threshold: int, reset_timeout: float):
+        self.threshold = threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened_at: float | None = None
+
+    @property
+    def is_open(self) -> bool:
+        return self.opened_at is not None
+
+    def allow(self) -> bool:
+        if self.opened_at is None:
+            return True
+        if time.monotonic() - self.opened_at >= self.reset_timeout:
+            self.opened_at = time.monotonic()  # Half-open: block other requests until the trial request finishes
+            return True
+        return False
+
+    def record_success(self) -> None:
+        self.failures = 0
+        self.opened_at = None
+
+    def record_failure(self) -> bool:
+        """
+        @return: whether the breaker opened because of this failure
+        """
+        self.failures += 1
+        if self.failures >= self.threshold:
+            opened = self.opened_at is None
+            self.opened_at = time.monotonic()
+            return opened
+        return False
+
+
+class ResponseCache:
+    """
+    Cache of API responses with a TTL per entry, bounded to `max_entries` by evicting the least recently used entries.
+    Concurrent lookups of a key that is not cached share one request. Expired entries are kept for another `stale_ttl`
+    seconds, and served when Lichess is unavailable or rate limits us.
+    """
+
+    def __init__(self, max_entries: int, stale_ttl: float):
+        self.max_entries = max_entries
+        self.stale_ttl = stale_ttl
+        self.hits = 0
+        self.stale_hits = 0
+        self.coalesced = 0  # Lookups that waited for the request of another lookup
+        self.misses = 0  # Lookups that sent a request
+        self._entries: OrderedDict[Hashable, tuple[float, Any]] = OrderedDict()  # Key -> (expiry time, response)
+        self._in_flight: dict[Hashable, asyncio.Task] = {}
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    async def get(self, key: Hashable, fetch: Callable[[], Awaitable], ttl: float | Callable[[Any], float],
+                  refresh: bool = False) -> Any:
+        """
+        Cached response for the key, or the response of fetch() if it is not cached or expired
+        @param ttl: seconds to cache the response, or a function of the response that returns them
+        @param refresh: fetch the response even if it is cached
+        """
+        entry = self._entries.get(key)
+        if not refresh and entry is not None and entry[0] > time.monotonic():
+            self.hits += 1
+            self._entries.move_to_end(key)
+            return entry[1]
+        if (task := self._in_flight.get(key)) is not None:
+            self.coalesced += 1
+        else:
+            self.misses += 1
+            task = self._in_flight[key] = asyncio.create_task(self._fetch(key, fetch, ttl))
+            task.add_done_callback(lambda _: self._in_flight.pop(key, None))
+        return await asyncio.shield(task)
+
+    async def _fetch(self, key: Hashable, fetch: Callable[[], Awaitable], ttl: float | Callable[[Any], float]) -> Any:
+        try:
+            response = await fetch()
+        except LichessUnavailable:
+            entry = self._entries.get(key)
+            if entry is not None and entry[0] + self.stale_ttl > time.monotonic():
+                self.stale_hits += 1
+                return entry[1]
+            raise
+        self._entries[key] = (time.monotonic() + (ttl(response) if callable(ttl) else ttl), response)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+        return response
+
+    def stats(self) -> dict[str, int | float]:
+        saved = self.hits + self.coalesced
+        lookups = saved + self.misses
+        return {'entries': len(self), 'hits': self.hits, 'stale_hits': self.stale_hits, 'coalesced': self.coalesced,
+                'upstream_calls': self.misses, 'saved_calls': saved,
+                'hit_ratio': (saved + self.stale_hits) / lookups if lookups else 0.0}
+
+
+class LichessClient:
+    def __init__(self, logger: logging.Logger, base_url: str = LICHESS_URL, max_concurrency: int = 8,
+                 timeout: float = 10, retries: int = 2, retry_delay: float = 0.5, breaker_threshold: int = 5,
+                 breaker_reset: float = 30, cache: ResponseCache | None = None, user_ttl: float = 60,
+                 game_ttl: float = 10, finished_game_ttl: float = 3600):
+        """
+        @param max_concurrency: maximum number of requests in flight, not counting open streams
+        @param timeout: timeout of a request in seconds, and the longest a request waits for a rate limit back-off
+        @param retries: number of retries after a failed request, waiting a random time up to retry_delay * 2^attempt
+        @param breaker_threshold: number of consecutive failures that opens the circuit breaker
+        @param breaker_reset: seconds after which an open circuit breaker lets a trial request through
+        @param cache: cache of user and game lookups, with user_ttl for users, and game_ttl or finished_game_ttl for
+        ongoing or finished games
+        """
+        self.logger = logger
+        self.base_url = base_url.rstrip('/')
+        self.timeout = timeout
+        self.retries = retries
+        self.retry_delay = retry_delay
+        self.breaker = CircuitBreaker(threshold=breaker_threshold, reset_timeout=breaker_reset)
+        self._limit = asyncio.Semaphore(max_concurrency)
+        self._max_connections = max_concurrency
+        self._retry_at = 0.0  # Monotonic time until which all requests wait after a 429
+        self._session: aiohttp.ClientSession | None = None
+        self._stream_session: aiohttp.ClientSession | None = None
+        self.cache = cache if cache is not None else ResponseCache(max_entries=4096, stale_ttl=3600)
+        self.user_ttl = user_ttl
+        self.game_ttl = game_ttl
+        self.finished_game_ttl = finished_game_ttl
+
+    def start(self) -> None:
+        self._session = aiohttp.ClientSession(connector=aiohttp.TCPConnector(limit=self._max_connections * 2),
+                                              headers={'Accept': 'application/json'})
+        # Streams hold their connection for as long as they are open, so they get a pool of their own that does not
+        # limit the number of connections. Otherwise a few open streams would leave no connections for requests.
+        self._stream_session = aiohttp.ClientSession(connector=aiohttp.TCPConnector(limit=0),
+                                                     headers={'Accept': 'application/json'})
+
+    async def close(self) -> None:
+        if self._session is not None:
+            await self._session.close()
+        if self._stream_session is not None:
+            await self._stream_session.close()
+
+    def url(self, path: str) -> str:
+        return path if path.startswith(('http://', 'https://')) else f'{self.base_url}{path}'
+
+    def _back_off(self, retry_after: str | None) -> None:
+        try:
+            delay = float(retry_after) if retry_after is not None else RATE_LIMIT_BACKOFF
+        except ValueError:
+            delay = RATE_LIMIT_BACKOFF
+        self._retry_at = max(self._retry_at, time.monotonic() + delay)
+        self.logger.warning(f'Rate limited by Lichess, pausing requests for {delay:.0f}s')
+
+    async def _wait_for_back_off(self, url: str) -> None:
+        remaining = self._retry_at - time.monotonic()
+        if remaining > self.timeout:
+            raise LichessRateLimited(f'Rate limited by Lichess for another {remaining:.0f}s: {url}', status=429)
+        if remaining > 0:
+            await asyncio.sleep(remaining)
+
+    def _failure(self) -> None:
+        if self.breaker.record_failure():
+            self.logger.error(f'Lichess failed {self.breaker.failures} times in a row, pausing requests for '
+                              f'{self.breaker.reset_timeout:.0f}s')
+
+    async def _send(self, method: str, path: str, read: Callable[[aiohttp.ClientResponse], Awaitable] | None,
+                    timeout: aiohttp.ClientTimeout, session: aiohttp.ClientSession | None = None, **kwargs) -> Any:
+        """
+        Send a request, retrying on connection errors, timeouts, 5xx and 429 responses
+        @param read: reads the result from the response, or None to return the unread response
+        @param session: session to send the request with, the session of requests by default
+        @raise LichessNotFound: on a 404 response
+        @raise LichessError: on other 4xx responses, or a response that cannot be read
+        @raise LichessUnavailable: when the request kept failing, or the circuit breaker is open
+        """
+        url = self.url(path)
+        session = session if session is not None else self._session
+        error: Exception | None = None
+        for attempt in range(self.retries + 1):
+            if attempt > 0:
+                await asyncio.sleep(random.uniform(0, self.retry_delay * 2 ** attempt))
+            await self._wait_for_back_off(url)
+            if not self.breaker.allow():
+                raise LichessUnavailable(f'Lichess is unavailable: {url}')
+            start = time.perf_counter()
+            try:
+                resp = await session.request(method, url, timeout=timeout, **kwargs)
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                LICHESS_RESPONSES.inc(method=method, status='error')
+                self._failure()
+                error = e
+                continue
+            LICHESS_SECONDS.observe(time.perf_counter() - start, method=method)
+            LICHESS_RESPONSES.inc(method=method, status=resp.status)
+            if resp.status == 429:
+                resp.release()
+                self._back_off(resp.headers.get('Retry-After'))
+                error = LichessRateLimited(f'Rate limited by Lichess: {url}', status=429)
+                continue
+            if resp.status >= 500:
+                resp.release()
+                self._failure()
+                error = LichessError(f'Lichess responded with {resp.status}: {url}', status=resp.status)
+                continue
+            self.breaker.record_success()
+            if resp.status == 404:
+                resp.release()
+                raise LichessNotFound(f'Not found: {url}', status=404)
+            if resp.status >= 400:
+                resp.release()
+                raise LichessError(f'Lichess responded with {resp.status}: {url}', status=resp.status)
+            if read is None:
+                return resp
+            try:
+                async with resp:
+                    return await read(resp)
+            except json.JSONDecodeError as e:
+                raise LichessError(f'Invalid response from Lichess: {url}', status=resp.status) from e
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                self._failure()
+                error = e
+        if isinstance(error, LichessUnavailable):
+            raise error
+        raise LichessUnavailable(f'Lichess request failed after {self.retries + 1} attempts: {url}',
+                                 status=getattr(error, 'status', None)) from error
+
+    async def request(self, method: str, path: str, **kwargs) -> Any:
+        """
+        JSON response of a request to the path on Lichess, or to a full URL
+        """
+        async with self._limit:
+            return await self._send(method, path, read=lambda resp: resp.json(content_type=None),
+                                    timeout=aiohttp.ClientTimeout(total=self.timeout), **kwargs)
+
+    async def get_json(self, path: str, **kwargs) -> Any:
+        return await self.request('GET', path, **kwargs)
+
+    async def get_text(self, path: str, **kwargs) -> str:
+        async with self._limit:
+            return await self._send('GET', path, read=lambda resp: resp.text(),
+                                    timeout=aiohttp.ClientTimeout(total=self.timeout), **kwargs)
+
+    @asynccontextmanager
+    async def stream(self, path: str, method: str = 'GET', timeout: float | None = None,
+                     read_timeout: float | None = STREAM_READ_TIMEOUT,
+                     **kwargs) -> AsyncIterator[aiohttp.ClientResponse]:
+        """
+        Open a streaming response, such as a stream of NDJSON. Only opening the stream counts towards the concurrency
+        limit and is retried.
+        @param timeout: total time the stream may be open, in seconds
+        @param read_timeout: seconds without any data after which reading the stream raises a timeout error
+        """
+        async with self._limit:
+            resp = await self._send(method, path, read=None, session=self._stream_session,
+                                    timeout=aiohttp.ClientTimeout(total=timeout, sock_connect=self.timeout,
+                                                                  sock_read=read_timeout), **kwargs)
+        try:
+            yield resp
+        finally:
+            resp.release()
+
+    async def user(self, username: str) -> dict:
+        return await self.cache.get(('user', username.lower()), lambda: self.get_json(f'/api/user/{username}'),
+                                    ttl=self.user_ttl)
+
+    async def game_export(self, game_id: str, refresh: bool = False) -> dict:
+        """
+        @param refresh: bypass the cache, e.g. to get the result of a game that just finished
+        """
+        return await self.cache.get(('game', game_id), lambda: self.get_json(f'/game/export/{game_id}'),
+                                    ttl=lambda game: (self.game_ttl if game.get('status') in ('created', 'started')
+                                                      else self.finished_game_ttl),
+                                    refresh=refresh)
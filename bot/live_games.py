@@ -0,0 +1,234 @@
+"""
+Live games watched with /watch. Every game is followed through a single Lichess stream, however many messages show
+it, and each position is sent to all messages watching the game through the edit scheduler, which skips positions when
+moves come in faster than the messages may be edited.
+"""
+import asyncio
+import json
+import logging
+import time
+from functools import partial
+
+import aiohttp
+import chess
+import discord
+from sqlalchemy import update, delete
+from sqlalchemy.orm import sessionmaker
+
+from database import WatchedGame
+from edits import EditScheduler
+from lichess import LichessClient, LichessError
+from rendering import RenderKey, RenderService, RenderTimeoutError, render_key, board_file
+
+
+def format_seconds(sec: int) -> str:
+    if sec >= 3600:
+        return time.strftime('⏱ %Hh %Mm %Ss', time.gmtime(sec))
+    if sec >= 60:
+        return time.strftime('⏱ %Mm %Ss', time.gmtime(sec))
+    return f'⏱ {sec}s'
+
+
+def state_key(state: dict, flipped: bool) -> RenderKey:
+    """
+    Render key of a state of the game stream
+    """
+    lastmove_uci = state.get('lm')
+    lastmove = chess.Move(chess.parse_square(lastmove_uci[:2]),
+                          chess.parse_square(lastmove_uci[2:4])) if lastmove_uci else None
+    return render_key(chess.BaseBoard(state['fen'].split(' ', 1)[0]), lastmove=lastmove, flipped=flipped)
+
+
+class LiveWatcher:
+    """
+    A message showing a live game
+    """
+
+    def __init__(self, message: discord.Message, watcher_id: int, flipped: bool):
+        self.message = message
+        self.watcher_id = watcher_id  # Discord ID of the person who invoked the watch command
+        self.flipped = flipped
+        # Result True when the game finished, False when the message was deleted
+        self.done: asyncio.Future[bool] = asyncio.get_running_loop().create_future()
+
+
+class LiveGame:
+    def __init__(self, game_id: str, white: str, black: str):
+        self.game_id = game_id
+        self.white = white  # Embed field names of the players
+        self.black = black
+        self.state: dict | None = None  # Latest state of the game, None if the stream could not be opened
+        self.ready = asyncio.Event()  # Set when the first state is known, or the stream ended
+        self.watchers: dict[int, LiveWatcher] = {}  # By message ID
+        # Joins that have not added a watcher or left yet, the game is followed until they and all watchers are gone
+        self.joining = 0
+        self.ended = False
+        self.task: asyncio.Task | None = None
+
+
+class LiveGameHub:
+    def __init__(self, lichess: LichessClient, renderer: RenderService, edits: EditScheduler,
+                 sessionmaker: sessionmaker, logger: logging.Logger, join_timeout: float = 10):
+        """
+        @param join_timeout: seconds to wait for the first state of a game
+        """
+        self.lichess = lichess
+        self.renderer = renderer
+        self.edits = edits
+        self.Session = sessionmaker
+        self.logger = logger
+        self.games: dict[str, LiveGame] = {}
+        self._by_message: dict[int, LiveGame] = {}
+        self.join_timeout = join_timeout
+
+    async def join(self, game_id: str, white: str, black: str) -> LiveGame:
+        """
+        The live game with the ID, following its stream if it is not followed yet. Returns when the current state of
+        the game is known, or with a state of None if it could not be followed. Every join is followed by add_watcher,
+        or by leave if the game is not shown after all.
+        """
+        game = self.games.get(game_id)
+        if game is None:
+            game = self.games[game_id] = LiveGame(game_id, white=white, black=black)
+            game.task = asyncio.create_task(self._follow(game))
+        game.joining += 1
+        if not await self._wait_ready(game):
+            self.logger.warning(f'No state of game {game_id} within {self.join_timeout}s')
+            await self._end(game)
+        return game
+
+    async def _wait_ready(self, game: LiveGame) -> bool:
+        """
+        @return: False if the first state of the game is not known within the join timeout
+        """
+        try:
+            await asyncio.wait_for(game.ready.wait(), timeout=self.join_timeout)
+            return True
+        except asyncio.TimeoutError:
+            return False
+
+    async def add_watcher(self, game: LiveGame, message: discord.Message, watcher_id: int,
+                          flipped: bool) -> LiveWatcher:
+        watcher = LiveWatcher(message, watcher_id=watcher_id, flipped=flipped)
+        game.joining -= 1
+        if game.ended:  # The game ended in the meantime
+            watcher.done.set_result(True)
+            return watcher
+        game.watchers[message.id] = watcher
+        self._by_message[message.id] = game
+        async with self.Session() as session:
+            session.add(WatchedGame(message_id=message.id, watcher_id=watcher_id, game_id=game.game_id,
+                                    color=not flipped))
+            await session.commit()
+        return watcher
+
+    async def leave(self, game: LiveGame) -> None:
+        """
+        Undo a join of which the game could not be shown, to stop following the game if nobody else watches it
+        """
+        game.joining -= 1
+        if not game.watchers and not game.joining:
+            await self._end(game)
+
+    def stop(self) -> None:
+        for game in list(self.games.values()):
+            if game.task is not None:
+                game.task.cancel()
+
+    def watcher(self, message_id: int) -> LiveWatcher | None:
+        game = self._by_message.get(message_id)
+        return game.watchers.get(message_id) if game is not None else None
+
+    async def flip(self, watcher: LiveWatcher) -> None:
+        """
+        Flip the board of the watcher from the next move on
+        """
+        watcher.flipped = not watcher.flipped
+        async with self.Session() as session:
+            await session.execute(update(WatchedGame)
+                                  .where(WatchedGame.message_id == watcher.message.id)
+                                  .values(color=not watcher.flipped))
+            await session.commit()
+
+    async def _remove(self, game: LiveGame, watcher: LiveWatcher, finished: bool) -> None:
+        game.watchers.pop(watcher.message.id, None)
+        self._by_message.pop(watcher.message.id, None)
+        if finished:  # Let the last edit finish before the summary is shown
+            await self.edits.close(watcher.message.id)
+        else:
+            self.edits.discard(watcher.message.id)
+        if not watcher.done.done():
+            watcher.done.set_result(finished)
+        async with self.Session() as session:
+            await session.execute(delete(WatchedGame).where(WatchedGame.message_id == watcher.message.id))
+            await session.commit()
+        if not game.watchers and not game.joining:  # All messages were deleted
+            await self._end(game)
+
+    async def _end(self, game: LiveGame) -> None:
+        """
+        Stop following the game, and show the summary in all its messages
+        """
+        if game.ended:
+            return
+        game.ended = True
+        game.ready.set()
+        if self.games.get(game.game_id) is game:
+            del self.games[game.game_id]
+        if game.task is not None and game.task is not asyncio.current_task():
+            game.task.cancel()
+        for watcher in list(game.watchers.values()):
+            await self._remove(game, watcher, finished=True)
+
+    async def _follow(self, game: LiveGame) -> None:
+        try:
+            async with self.lichess.stream(f'/api/stream/game/{game.game_id}', timeout=3600) as stream:
+                first = json.loads(await stream.content.readline())
+                game.state = {'fen': first['fen'], 'lm': first.get('lastMove')}
+                game.ready.set()
+                # The stream starts by replaying earlier positions
+                latest_fen = ' '.join(first['fen'].split()[:2])
+                up_to_date = False
+                async for line in stream.content:
+                    if line == b'\n':  # Sent to keep open the connection
+                        continue
+                    state = json.loads(line)
+                    if 'wc' not in state:  # Game over, summary shown
+                        break
+                    if not up_to_date:
+                        if state['fen'] == latest_fen:
+                            up_to_date = True
+                        else:
+                            continue
+                    game.state = state
+                    self._update(game, state)
+        except (asyncio.TimeoutError, aiohttp.ClientError, LichessError, json.JSONDecodeError) as e:
+            self.logger.debug(f'Stopped following game {game.game_id}: {type(e).__name__}: {e}')
+        finally:
+            await self._end(game)
+
+    def _update(self, game: LiveGame, state: dict) -> None:
+        """
+        Schedule showing the state in all messages watching the game. Messages that are watching the game in the same
+        orientation share the render of the board.
+        """
+        for watcher in game.watchers.values():
+            self.edits.submit(watcher.message.id, state, partial(self._show, game, watcher))
+
+    async def _show(self, game: LiveGame, watcher: LiveWatcher, state: dict) -> None:
+        message = watcher.message
+        try:
+            png = await self.renderer.render(state_key(state, watcher.flipped))
+        except RenderTimeoutError:
+            self.logger.warning(f'Skipped a move of game {game.game_id}: rendering timed out')
+            return
+        embed = message.embeds[0]
+        embed.clear_fields()
+        embed.colour = 0x000000 if watcher.flipped else 0xeeeeee
+        embed.add_field(name=game.white, value=format_seconds(state['wc']), inline=True)
+        embed.add_field(name=game.black, value=format_seconds(state['bc']), inline=True)
+        embed.set_image(url=f'attachment://{message.id}.png')
+        try:
+            await message.edit(embed=embed, attachments=[board_file(png, filename=f'{message.id}.png')])
+        except discord.NotFound:  # Message with game deleted
+            await self._remove(game, watcher, finished=False)
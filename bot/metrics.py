@@ -0,0 +1,252 @@
+"""
+Metrics of the bot in the Prometheus text format, served over HTTP from the bot process. Every metric is labelled with
+the shard it was recorded for: the shard of the interaction being handled, 'dm' for interactions in direct messages,
+which are not attributed to a shard, or 'all' for work that is not done for one shard, like background tasks and
+process-wide gauges.
+https://prometheus.io/docs/instrumenting/exposition_formats/
+"""
+import bisect
+import time
+from contextvars import ContextVar
+from typing import Callable
+
+import discord
+from aiohttp import web
+from sqlalchemy import event
+from sqlalchemy.ext.asyncio import AsyncEngine
+
+# Shard of the interaction handled by the current task. Tasks and SQLAlchemy's greenlets inherit it.
+current_shard: ContextVar[str] = ContextVar('current_shard', default='all')
+
+LATENCY_BUCKETS = (.005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10, 30)
+
+
+def _escape(value: str) -> str:
+    return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _format_labels(names: tuple[str, ...], values: tuple[str, ...]) -> str:
+    return '{' + ','.join(f'{name}="{_escape(value)}"' for name, value in zip(names, values)) + '}'
+
+
+def _format_value(value: float) -> str:
+    if value != value:
+        return 'NaN'
+    if value in (float('inf'), float('-inf')):
+        return '+Inf' if value > 0 else '-Inf'
+    return str(int(value)) if float(value).is_integer() else repr(float(value))
+
+
+class Metric:
+    kind = 'untyped'
+
+    def __init__(self, name: str, documentation: str, labelnames: tuple[str, ...] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = ('shard',) + labelnames
+        self._values: dict[tuple[str, ...], object] = {}
+        REGISTRY.register(self)
+
+    def _key(self, labels: dict[str, object]) -> tuple[str, ...]:
+        shard = labels.pop('shard', None)
+        return (str(shard) if shard is not None else current_shard.get(),) + tuple(
+            str(labels[name]) for name in self.labelnames[1:])
+
+    def clear(self) -> None:
+        self._values.clear()
+
+    def samples(self) -> list[tuple[str, tuple[str, ...], tuple[str, ...], float]]:
+        """
+        (name, label names, label values, value) of every sample
+        """
+        return [(self.name, self.labelnames, key, value) for key, value in self._values.items()]
+
+    def expose(self) -> str:
+        lines = [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} {self.kind}']
+        for name, labelnames, labelvalues, value in self.samples():
+            lines.append(f'{name}{_format_labels(labelnames, labelvalues)} {_format_value(value)}')
+        return '\n'.join(lines)
+
+
+class Counter(Metric):
+    kind = 'counter'
+
+    def inc(self, amount: float = 1, **labels) -> None:
+        key = self._key(labels)
+        self._values[key] = self._values.get(key, 0) + amount
+
+
+class Gauge(Metric):
+    kind = 'gauge'
+
+    def set(self, value: float, **labels) -> None:
+        self._values[self._key(labels)] = value
+
+
+class Histogram(Metric):
+    kind = 'histogram'
+
+    def __init__(self, name: str, documentation: str, labelnames: tuple[str, ...] = (),
+                 buckets: tuple[float, ...] = LATENCY_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets)) + (float('inf'),)
+
+    def observe(self, value: float, **labels) -> None:
+        key = self._key(labels)
+        if (entry := self._values.get(key)) is None:
+            entry = self._values[key] = [[0] * len(self.buckets), 0.0, 0]  # Counts per bucket, sum, count
+        entry[0][bisect.bisect_left(self.buckets, value)] += 1
+        entry[1] += value
+        entry[2] += 1
+
+    def samples(self) -> list[tuple[str, tuple[str, ...], tuple[str, ...], float]]:
+        samples = []
+        for key, (counts, total, count) in self._values.items():
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets, counts):
+                cumulative += bucket_count
+                samples.append((f'{self.name}_bucket', self.labelnames + ('le',),
+                                key + (_format_value(bound),), cumulative))
+            samples.append((f'{self.name}_sum', self.labelnames, key, total))
+            samples.append((f'{self.name}_count', self.labelnames, key, count))
+        return samples
+
+
+class Registry:
+    def __init__(self):
+        self.metrics: list[Metric] = []
+        self.collectors: list[Callable[[], None]] = []  # Update gauges right before they are exposed
+
+    def register(self, metric: Metric) -> None:
+        self.metrics.append(metric)
+
+    def expose(self) -> str:
+        for collect in self.collectors:
+            collect()
+        return '\n'.join(metric.expose() for metric in self.metrics) + '\n'
+
+
+REGISTRY = Registry()
+
+COMMAND_SECONDS = Histogram('lichessbot_command_seconds', 'Time to handle an application command',
+                            ('command', 'status'))
+QUERY_SECONDS = Histogram('lichessbot_db_query_seconds', 'Execution time of SQL statements', ('statement',))
+QUERY_ERRORS = Counter('lichessbot_db_query_errors_total', 'SQL statements that raised an error', ('statement',))
+DB_POOL_CONNECTIONS = Gauge('lichessbot_db_pool_connections', 'Connections of the database pool', ('state',))
+RENDER_SECONDS = Histogram('lichessbot_render_seconds', 'Time to render a board in the process pool, including '
+                                                        'waiting for a worker', ('backend',))
+LICHESS_SECONDS = Histogram('lichessbot_lichess_request_seconds', 'Latency of Lichess API requests', ('method',))
+LICHESS_RESPONSES = Counter('lichessbot_lichess_responses_total', 'Lichess API responses by status code, or "error" '
+                                                                  'for connection errors and timeouts',
+                            ('method', 'status'))
+WATCHED_GAMES = Gauge('lichessbot_watched_games', 'Live games followed for /watch')
+GAME_WATCHERS = Gauge('lichessbot_game_watchers', 'Messages showing a live game')
+CACHE_HIT_RATIO = Gauge('lichessbot_cache_hit_ratio', 'Hit ratio of a cache since the start of the bot', ('cache',))
+CACHE_ENTRIES = Gauge('lichessbot_cache_entries', 'Number of entries in a cache', ('cache',))
+LOOP_LAG = Histogram('lichessbot_event_loop_lag_seconds', 'Delay of the event loop in running a task that is due',
+                     buckets=(.001, .005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10))
+LOOP_BLOCKS = Counter('lichessbot_event_loop_blocks_total', 'Times the event loop was blocked longer than the '
+                                                            'watchdog threshold')
+LIVE_EDITS = Counter('lichessbot_live_edits_total', 'States of live games for messages, by result: shown, skipped '
+                                                   '(replaced by a newer state before they were shown) or failed',
+                     ('result',))
+LIVE_EDIT_RATE_LIMITS = Counter('lichessbot_live_edit_rate_limits_total', 'Edits of live game messages that were '
+                                                                          'rate limited by Discord')
+LIVE_EDIT_LAG = Histogram('lichessbot_live_edit_lag_seconds', 'Time from a new state of a live game to showing it')
+LIVE_EDIT_BUDGET = Gauge('lichessbot_live_edit_budget', 'Edits per second allowed across all live game messages')
+GATEWAY_LATENCY = Gauge('lichessbot_gateway_latency_seconds', 'Heartbeat latency of the Discord gateway')
+
+
+def interaction_shard(interaction: discord.Interaction) -> str:
+    return str(interaction.guild.shard_id) if interaction.guild is not None else 'dm'
+
+
+def command_started(interaction: discord.Interaction) -> None:
+    """
+    Start timing the command of the interaction, and attribute the work done by the current task to its shard
+    """
+    interaction.extras['started'] = time.perf_counter()
+    current_shard.set(interaction_shard(interaction))
+
+
+def command_finished(interaction: discord.Interaction, status: str) -> None:
+    if (started := interaction.extras.get('started')) is None:
+        return
+    command = interaction.command.qualified_name if interaction.command is not None else 'unknown'
+    COMMAND_SECONDS.observe(time.perf_counter() - started, shard=interaction_shard(interaction), command=command,
+                            status=status)
+
+
+def instrument_engine(engine: AsyncEngine) -> None:
+    """
+    Time every SQL statement executed by the engine, and expose the state of its connection pool
+    """
+
+    def statement_type(statement: str) -> str:
+        return statement.lstrip().split(None, 1)[0].upper() if statement.strip() else 'UNKNOWN'
+
+    @event.listens_for(engine.sync_engine, 'before_cursor_execute')
+    def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        conn.info.setdefault('query_started', []).append(time.perf_counter())
+
+    @event.listens_for(engine.sync_engine, 'after_cursor_execute')
+    def after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        QUERY_SECONDS.observe(time.perf_counter() - conn.info['query_started'].pop(),
+                              statement=statement_type(statement))
+
+    @event.listens_for(engine.sync_engine, 'handle_error')
+    def handle_error(context):
+        if started := context.connection.info.get('query_started') if context.connection is not None else None:
+            started.pop()
+        QUERY_ERRORS.inc(statement=statement_type(context.statement or ''))
+
+    def collect_pool() -> None:
+        pool = engine.sync_engine.pool
+        if hasattr(pool, 'checkedout'):
+            DB_POOL_CONNECTIONS.set(pool.checkedout(), shard='all', state='checked_out')
+            DB_POOL_CONNECTIONS.set(pool.checkedin(), shard='all', state='idle')
+            DB_POOL_CONNECTIONS.set(pool.size(), shard='all', state='pool_size')
+            DB_POOL_CONNECTIONS.set(max(0, pool.overflow()), shard='all', state='overflow')
+
+    REGISTRY.collectors.append(collect_pool)
+
+
+def collect_cache(name: str, stats: Callable[[], dict], size_key: str = 'entries') -> None:
+    """
+    Expose the hit ratio and size of a cache with a stats() method
+    @param size_key: key of the number of entries in the stats
+    """
+
+    def collect() -> None:
+        values = stats()
+        CACHE_HIT_RATIO.set(values['hit_ratio'], shard='all', cache=name)
+        CACHE_ENTRIES.set(values[size_key], shard='all', cache=name)
+
+    REGISTRY.collectors.append(collect)
+
+
+class MetricsServer:
+    """
+    HTTP server of the /metrics endpoint
+    """
+
+    def __init__(self, host: str, port: int, registry: Registry = REGISTRY):
+        self.host = host
+        self.port = port
+        self.registry = registry
+        self._runner: web.AppRunner | None = None
+
+    async def start(self) -> None:
+        app = web.Application()
+        app.router.add_get('/metrics', self._metrics)
+        self._runner = web.AppRunner(app, access_log=None)
+        await self._runner.setup()
+        await web.TCPSite(self._runner, self.host, self.port).start()
+
+    async def stop(self) -> None:
+        if self._runner is not None:
+            await self._runner.cleanup()
+
+    async def _metrics(self, request: web.Request) -> web.Response:
+        return web.Response(body=self.registry.expose().encode('utf-8'),
+                            headers={'Content-Type': 'text/plain; version=0.0.4; charset=utf-8'})
@@ -0,0 +1,128 @@
+"""
+Buffers of puzzles that are selected and rendered ahead of time, so they can be served without any work on the
+critical path of an interaction
+"""
+import asyncio
+import logging
+from collections import OrderedDict, deque
+from typing import Awaitable, Callable
+
+from database import Puzzle
+from solution import SolutionLine
+
+# (rating bucket of 100 points, theme), None for any rating or theme
+BucketKey = tuple[int | None, str | None]
+
+
+class PreparedPuzzle:
+    """
+    A puzzle with its solution line computed and the board after the opponent's initial move rendered
+    """
+
+    def __init__(self, puzzle: Puzzle, line: SolutionLine, png: bytes):
+        self.puzzle = puzzle
+        self.line = line
+        self.png = png
+
+    @property
+    def fen(self) -> str:
+        """
+        FEN after the initial move
+        """
+        return self.line.fens[1]
+
+    @property
+    def moves(self) -> list[str]:
+        """
+        Moves left to play after the initial move
+        """
+        return self.line.uci[1:]
+
+    @property
+    def initial_move_uci(self) -> str:
+        return self.line.uci[0]
+
+    @property
+    def initial_move_san(self) -> str:
+        return self.line.san[0]
+
+    @property
+    def color(self) -> str:
+        return self.line.color
+
+
+class PuzzlePrefetcher:
+    """
+    Keeps a small buffer of prepared puzzles per bucket. A bucket is created the first time it is asked for, and
+    refilled in the background every time a puzzle is taken from it. The least recently used buckets are dropped when
+    there are more than `max_buckets`.
+    """
+
+    def __init__(self, size: int, max_buckets: int, logger: logging.Logger):
+        self.size = size
+        self.max_buckets = max_buckets
+        self.logger = logger
+        self.hits = 0
+        self.misses = 0
+        # Selects and prepares a puzzle for a bucket, set by the puzzle cog
+        self.source: Callable[[BucketKey], Awaitable[PreparedPuzzle | None]] | None = None
+        self._buffers: OrderedDict[BucketKey, deque[PreparedPuzzle]] = OrderedDict()
+        self._refills: dict[BucketKey, asyncio.Task] = {}
+
+    def pop(self, key: BucketKey) -> PreparedPuzzle | None:
+        """
+        Take a prepared puzzle from the bucket, if there is one, and refill the bucket in the background
+        """
+        buffer = self._buffers.get(key)
+        if buffer is None:
+            buffer = self._buffers[key] = deque(maxlen=self.size)
+            while len(self._buffers) > self.max_buckets:
+                evicted, _ = self._buffers.popitem(last=False)
+                if (task := self._refills.pop(evicted, None)) is not None:
+                    task.cancel()
+        self._buffers.move_to_end(key)
+        prepared = buffer.popleft() if buffer else None
+        if prepared is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        self.refill(key)
+        return prepared
+
+    def refill(self, key: BucketKey) -> None:
+        if self.source is None or key in self._refills:
+            return
+        self._buffers.setdefault(key, deque(maxlen=self.size))
+        task = asyncio.create_task(self._refill(key))
+        self._refills[key] = task
+        # Only forget the task if it is still the refill of the bucket, as it may have been replaced after a clear
+        task.add_done_callback(lambda t: self._refills.pop(key) if self._refills.get(key) is t else None)
+
+    async def _refill(self, key: BucketKey) -> None:
+        buffer = self._buffers.get(key)
+        try:
+            while buffer is not None and len(buffer) < self.size:
+                prepared = await self.source(key)
+                if prepared is None:  # No puzzles in this bucket
+                    return
+                if prepared.puzzle.retired:  # No longer in the puzzle database
+                    continue
+                buffer.append(prepared)
+        except Exception as e:
+            self.logger.exception(f'Failed to prefetch a puzzle for {key}\n{type(e).__name__}: {e}')
+
+    def clear(self) -> None:
+        """
+        Drop the prepared puzzles of all buckets and refill them, e.g. after the puzzles table has been updated
+        """
+        keys = list(self._buffers)
+        self.stop()
+        self._refills.clear()
+        for buffer in self._buffers.values():
+            buffer.clear()
+        for key in keys:
+            self.refill(key)
+
+    def stop(self) -> None:
+        for task in list(self._refills.values()):
+            task.cancel()
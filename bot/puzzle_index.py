@@ -0,0 +1,140 @@
+"""
+Memory-mapped columnar index of the puzzles, to select puzzles without querying the database. The index is written
+when the puzzles table is updated, and consists of one NumPy array per column, sorted by rating. Bot processes on the
+same machine map the same files, so they share the pages through the OS page cache.
+"""
+import json
+import os
+import shutil
+import time
+
+import numpy as np
+import pandas as pd
+
+from histogram import PuzzleHistogram
+from themes import THEME_VOCABULARY
+
+INDEX_DIR = os.getenv('PUZZLE_INDEX_DIR', 'puzzle_index')
+COLUMNS: tuple[str, ...] = ('puzzle_id', 'rating', 'popularity', 'nr_plays', 'themes', 'opening')
+
+
+class PuzzleIndexWriter:
+    """
+    Collects the columns of the index from the chunks of the puzzle database, and writes the index to a new generation
+    directory. The `current` symlink is swapped to the new generation at the end, so readers never see a partial index.
+    """
+
+    def __init__(self):
+        self._chunks: dict[str, list[np.ndarray]] = {column: [] for column in COLUMNS}
+        self._openings: dict[str, int] = {}
+
+    def add(self, df: pd.DataFrame) -> None:
+        """
+        Add a chunk of transformed puzzles, as ingested in the database
+        """
+        self._chunks['puzzle_id'].append(df.puzzle_id.to_numpy(dtype=bytes))
+        self._chunks['rating'].append(df.rating.to_numpy(dtype=np.int16))
+        self._chunks['popularity'].append(df.popularity.to_numpy(dtype=np.int16))
+        self._chunks['nr_plays'].append(df.nr_plays.to_numpy(dtype=np.int32))
+        self._chunks['themes'].append(df.themes_mask.to_numpy(dtype=np.uint64))
+        self._chunks['opening'].append(np.fromiter(
+            (-1 if pd.isna(opening) else self._openings.setdefault(opening, len(self._openings))
+             for opening in df.opening_family), dtype=np.int16, count=len(df)))
+
+    def write(self, directory: str | None = None) -> str:
+        """
+        Write the index as a new generation in the directory and make it the current one. Older generations in the
+        directory are removed.
+        @param directory: directory of the index, INDEX_DIR by default
+        @return: path of the new generation
+        """
+        directory = directory or INDEX_DIR
+        generation = str(time.time_ns())
+        path = os.path.join(directory, generation)
+        os.makedirs(path)
+        columns = {column: np.concatenate(chunks) for column, chunks in self._chunks.items()}
+        order = np.argsort(columns['rating'], kind='stable')
+        for column, values in columns.items():
+            np.save(os.path.join(path, f'{column}.npy'), values[order])
+        with open(os.path.join(path, 'meta.json'), 'w') as f:
+            json.dump({'generation': generation, 'size': len(order), 'themes': THEME_VOCABULARY,
+                       'openings': list(self._openings)}, f)
+
+        link = os.path.join(directory, 'current')
+        if os.path.lexists(link + '.tmp'):  # Left behind by an interrupted earlier write
+            os.remove(link + '.tmp')
+        os.symlink(generation, link + '.tmp')
+        os.replace(link + '.tmp', link)
+        # Processes that mapped an older generation keep their pages until they reload
+        for old in os.listdir(directory):
+            if old not in (generation, 'current'):
+                shutil.rmtree(os.path.join(directory, old), ignore_errors=True)
+        return path
+
+
+class PuzzleIndex:
+    def __init__(self, path: str):
+        with open(os.path.join(path, 'meta.json')) as f:
+            meta = json.load(f)
+        if tuple(meta['themes']) != THEME_VOCABULARY[:len(meta['themes'])]:
+            raise ValueError(f'Puzzle index at {path} was written with a different theme vocabulary')
+        self.generation: str = meta['generation']
+        self.openings: list[str] = meta['openings']
+        self.puzzle_id, self.rating, self.popularity, self.nr_plays, self.themes, self.opening = (
+            np.load(os.path.join(path, f'{column}.npy'), mmap_mode='r') for column in COLUMNS)
+        self.histogram = PuzzleHistogram.from_arrays(self.rating, self.themes)
+        self._rng = np.random.default_rng()
+
+    def __len__(self) -> int:
+        return len(self.rating)
+
+    @staticmethod
+    def current_generation(directory: str | None = None) -> str | None:
+        path = os.path.join(directory or INDEX_DIR, 'current')
+        return os.path.basename(os.path.realpath(path)) if os.path.exists(path) else None
+
+    @classmethod
+    def load(cls, directory: str | None = None) -> 'PuzzleIndex | None':
+        """
+        Load the current generation of the index in the directory, INDEX_DIR by default, or None if there is none
+        """
+        path = os.path.join(directory or INDEX_DIR, 'current')
+        if not os.path.exists(path):
+            return None
+        return cls(os.path.realpath(path))
+
+    def rating_slice(self, rating_from: int | None = None, rating_to: int | None = None) -> slice:
+        """
+        Positions of the puzzles with a rating in [rating_from, rating_to], by binary search
+        """
+        start = 0 if rating_from is None else int(np.searchsorted(self.rating, rating_from, side='left'))
+        stop = len(self) if rating_to is None else int(np.searchsorted(self.rating, rating_to, side='right'))
+        return slice(start, max(start, stop))
+
+    def sample(self, rating_from: int | None = None, rating_to: int | None = None,
+               themes_all: int = 0, themes_none: int = 0) -> str | None:
+        """
+        ID of a uniformly random puzzle with a rating in [rating_from, rating_to] that has all themes in the mask
+        `themes_all` and none of the themes in the mask `themes_none`, or None if there is no such puzzle
+        """
+        window = self.rating_slice(rating_from, rating_to)
+        if window.stop == window.start:
+            return None
+        if not themes_all and not themes_none:
+            return self.puzzle_id[self._rng.integers(window.start, window.stop)].decode()
+        if not themes_none and themes_all & (themes_all - 1) == 0:  # A single theme
+            # Choose the n-th puzzle with the theme, and locate it by its rating in the histogram
+            theme = THEME_VOCABULARY[themes_all.bit_length() - 1]
+            count = self.histogram.count(rating_from, rating_to, theme)
+            if count == 0:
+                return None
+            rating, n = self.histogram.nth(int(self._rng.integers(count)), rating_from, theme)
+            window = self.rating_slice(rating, rating)
+            matches = np.flatnonzero(self.themes[window] & np.uint64(themes_all))
+            return self.puzzle_id[window.start + matches[n]].decode()
+        masks = self.themes[window]
+        required, excluded = np.uint64(themes_all), np.uint64(themes_none)
+        matches = np.flatnonzero(((masks & required) == required) & ((masks & excluded) == 0))
+        if len(matches) == 0:
+            return None
+        return self.puzzle_id[window.start + self._rng.choice(matches)].decode()
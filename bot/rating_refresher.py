@@ -0,0 +1,114 @@
+"""
+Background refresh of the puzzle ratings of connected users. Commands mark users whose rating may have changed, and
+the marked users are fetched from Lichess in bulk and written to the users table in a single statement.
+"""
+import asyncio
+import logging
+import time
+
+from sqlalchemy import update, func, values, column, Integer, String
+from sqlalchemy.orm import sessionmaker
+
+from database import User
+from lichess import LichessClient, LichessError
+
+USERS_PER_REQUEST = 300  # Maximum number of ids of POST /api/users
+
+
+class RatingRefresher:
+    def __init__(self, lichess: LichessClient, sessionmaker: sessionmaker, logger: logging.Logger,
+                 interval: float, min_interval: float):
+        """
+        @param interval: seconds between flushes of the marked users
+        @param min_interval: minimum number of seconds between two refreshes of the same user
+        """
+        self.lichess = lichess
+        self.Session = sessionmaker
+        self.logger = logger
+        self.interval = interval
+        self.min_interval = min_interval
+        self._dirty: set[str] = set()  # Lowercase usernames to fetch
+        self._known: dict[str, int] = {}  # Ratings seen in responses of other requests, not yet written
+        self._refreshed_at: dict[str, float] = {}
+        self._task: asyncio.Task | None = None
+
+    def start(self) -> None:
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+        try:
+            await self.flush()
+        except Exception as e:
+            self.logger.exception(f'Failed to refresh puzzle ratings\n{type(e).__name__}: {e}')
+
+    def mark(self, lichess_username: str) -> None:
+        """
+        Refresh the user's puzzle rating with the next flush, unless it was refreshed recently
+        """
+        key = lichess_username.lower()
+        if time.monotonic() - self._refreshed_at.get(key, float('-inf')) >= self.min_interval:
+            self._dirty.add(key)
+
+    def observe(self, lichess_username: str, puzzle_rating: int | None) -> None:
+        """
+        Save a puzzle rating that was fetched from Lichess by a command with the next flush, instead of fetching it
+        """
+        key = lichess_username.lower()
+        self._refreshed_at[key] = time.monotonic()
+        self._dirty.discard(key)
+        if puzzle_rating is not None:
+            self._known[key] = puzzle_rating
+
+    async def _run(self) -> None:
+        while True:
+            await asyncio.sleep(self.interval)
+            try:
+                await self.flush()
+            except Exception as e:
+                self.logger.exception(f'Failed to refresh puzzle ratings\n{type(e).__name__}: {e}')
+
+    async def fetch_ratings(self, usernames: list[str]) -> dict[str, int]:
+        """
+        Puzzle ratings of the users, fetched in batches of USERS_PER_REQUEST. Users that failed to fetch are marked
+        again for the next flush.
+        """
+        ratings: dict[str, int] = {}
+        for start in range(0, len(usernames), USERS_PER_REQUEST):
+            batch = usernames[start:start + USERS_PER_REQUEST]
+            try:
+                users = await self.lichess.request('POST', '/api/users', data=','.join(batch),
+                                                   headers={'Content-Type': 'text/plain'})
+            except LichessError as e:
+                self.logger.warning(f'Failed to fetch the puzzle ratings of {len(batch)} users: {e}')
+                self._dirty.update(batch)
+                continue
+            now = time.monotonic()
+            for username in batch:
+                self._refreshed_at[username] = now
+            for user in users:
+                if (rating := user.get('perfs', {}).get('puzzle', {}).get('rating')) is not None:
+                    ratings[user['id']] = rating
+        return ratings
+
+    async def flush(self) -> None:
+        """
+        Fetch the marked users and write all changed puzzle ratings
+        """
+        dirty, self._dirty = self._dirty, set()
+        ratings, self._known = self._known, {}
+        ratings.update(await self.fetch_ratings(sorted(dirty)))
+        expired = time.monotonic() - self.min_interval
+        self._refreshed_at = {key: t for key, t in self._refreshed_at.items() if t > expired}
+        if not ratings:
+            return
+        rows = values(column('username', String), column('rating', Integer), name='v').data(list(ratings.items()))
+        async with self.Session() as session:
+            result = await session.execute(update(User)
+                                           .where(func.lower(User.lichess_username) == rows.c.username)
+                                           .where(User.puzzle_rating.is_distinct_from(rows.c.rating))
+                                           .values(puzzle_rating=rows.c.rating)
+                                           .execution_options(synchronize_session=False))
+            await session.commit()
+        self.logger.debug(f'Refreshed {len(ratings)} puzzle ratings, {result.rowcount} changed')
@@ -0,0 +1,231 @@
+"""
+Rendering of chess board images, an in-memory cache of rendered boards and a process pool to render them in
+"""
+import asyncio
+import functools
+import io
+import multiprocessing
+import time
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from typing import Callable
+
+import cairosvg
+import chess
+import discord
+from chess import svg
+from PIL import Image, ImageDraw
+
+from metrics import RENDER_SECONDS
+
+COLOR_SCHEMES: dict[str, dict[str, str]] = {'brown': {'square light': '#f2d0a2', 'square dark': '#aa7249'}}
+DEFAULT_SCHEME = 'brown'
+BOARD_SIZE = 1000
+COORDINATES_MARGIN = 15  # Width of the coordinates border drawn by chess.svg.board, in SVG units
+
+# (board FEN, last move UCI, flipped, colour scheme, size in pixels)
+RenderKey = tuple[str, str | None, bool, str, int]
+
+
+def render_key(board: chess.BaseBoard, lastmove: chess.Move | None = None, flipped: bool = False,
+               scheme: str = DEFAULT_SCHEME, size: int = BOARD_SIZE) -> RenderKey:
+    """
+    Key that uniquely identifies a board image. Only the piece placement is used from the board, as the side to move,
+    castling rights, etc. are not visible in the image.
+    """
+    return board.board_fen(), lastmove.uci() if lastmove else None, flipped, scheme, size
+
+
+def render_board(key: RenderKey) -> bytes:
+    """
+    Render the board described by the key to PNG bytes
+    """
+    board_fen, lastmove_uci, flipped, scheme, size = key
+    image = svg.board(chess.BaseBoard(board_fen),
+                      lastmove=chess.Move.from_uci(lastmove_uci) if lastmove_uci else None,
+                      colors=COLOR_SCHEMES[scheme],
+                      flipped=flipped)
+    return cairosvg.svg2png(bytestring=image.encode('utf-8'), parent_width=size, parent_height=size)
+
+
+@functools.lru_cache(maxsize=8)
+def _board_sprites(scheme: str, size: int, flipped: bool) -> tuple[Image.Image, dict[str, Image.Image]]:
+    """
+    Background (empty board with coordinates) and the 12 piece sprites for a colour scheme and board size. Computed
+    once per worker process, by rasterising the same SVG elements that chess.svg.board is built from.
+    """
+    background = Image.open(io.BytesIO(cairosvg.svg2png(
+        bytestring=svg.board(chess.BaseBoard(None), colors=COLOR_SCHEMES[scheme], flipped=flipped).encode('utf-8'),
+        output_width=size, output_height=size))).convert('RGBA')
+    square_size = round(size * svg.SQUARE_SIZE / (8 * svg.SQUARE_SIZE + 2 * COORDINATES_MARGIN))
+    pieces = {}
+    for symbol in 'PNBRQKpnbrqk':
+        piece_svg = svg.piece(chess.Piece.from_symbol(symbol), size=square_size)
+        pieces[symbol] = Image.open(io.BytesIO(cairosvg.svg2png(bytestring=piece_svg.encode('utf-8'),
+                                                                output_width=square_size,
+                                                                output_height=square_size))).convert('RGBA')
+    return background, pieces
+
+
+def render_board_sprites(key: RenderKey) -> bytes:
+    """
+    Render the board described by the key to PNG bytes by pasting pre-rendered piece sprites onto a pre-rendered board.
+    Looks the same as render_board, but avoids building and parsing an SVG document for every position.
+    """
+    board_fen, lastmove_uci, flipped, scheme, size = key
+    background, pieces = _board_sprites(scheme, size, flipped)
+    colors = svg.DEFAULT_COLORS | COLOR_SCHEMES[scheme]
+    scale = size / (8 * svg.SQUARE_SIZE + 2 * COORDINATES_MARGIN)
+
+    def square_box(square: chess.Square) -> tuple[int, int, int, int]:
+        file_index, rank_index = chess.square_file(square), chess.square_rank(square)
+        x = (COORDINATES_MARGIN + (7 - file_index if flipped else file_index) * svg.SQUARE_SIZE) * scale
+        y = (COORDINATES_MARGIN + (rank_index if flipped else 7 - rank_index) * svg.SQUARE_SIZE) * scale
+        return round(x), round(y), round(x + svg.SQUARE_SIZE * scale), round(y + svg.SQUARE_SIZE * scale)
+
+    canvas = background.copy()
+    if lastmove_uci:
+        draw = ImageDraw.Draw(canvas)
+        lastmove = chess.Move.from_uci(lastmove_uci)
+        for square in (lastmove.from_square, lastmove.to_square):
+            shade = 'light' if chess.BB_SQUARES[square] & chess.BB_LIGHT_SQUARES else 'dark'
+            x0, y0, x1, y1 = square_box(square)
+            draw.rectangle((x0, y0, x1 - 1, y1 - 1), fill=colors[f'square {shade} lastmove'])
+    for square, piece in chess.BaseBoard(board_fen).piece_map().items():
+        x0, y0, _, _ = square_box(square)
+        canvas.alpha_composite(pieces[piece.symbol()], dest=(x0, y0))
+
+    output = io.BytesIO()
+    canvas.convert('RGB').save(output, format='PNG')  # The board is opaque, so drop the alpha channel
+    return output.getvalue()
+
+
+RENDERERS: dict[str, Callable[[RenderKey], bytes]] = {'svg': render_board, 'sprite': render_board_sprites}
+
+
+def board_file(png: bytes, filename: str) -> discord.File:
+    return discord.File(io.BytesIO(png), filename=filename)
+
+
+class BoardRenderCache:
+    """
+    LRU cache of rendered board images, bounded by the total size of the stored PNG bytes
+    """
+
+    def __init__(self, max_bytes: int):
+        self.max_bytes = max_bytes
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self._entries: OrderedDict[RenderKey, bytes] = OrderedDict()
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    @property
+    def hit_ratio(self) -> float:
+        lookups = self.hits + self.misses
+        return self.hits / lookups if lookups else 0.
+
+    def get(self, key: RenderKey) -> bytes | None:
+        try:
+            png = self._entries[key]
+        except KeyError:
+            self.misses += 1
+            return None
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return png
+
+    def put(self, key: RenderKey, png: bytes) -> None:
+        if len(png) > self.max_bytes:  # Would evict everything else and still not fit
+            return
+        if (old := self._entries.pop(key, None)) is not None:
+            self.nbytes -= len(old)
+        self._entries[key] = png
+        self.nbytes += len(png)
+        while self.nbytes > self.max_bytes:
+            _, evicted = self._entries.popitem(last=False)
+            self.nbytes -= len(evicted)
+
+    def stats(self) -> dict[str, int | float]:
+        return {'entries': len(self), 'bytes': self.nbytes, 'hits': self.hits, 'misses': self.misses,
+                'hit_ratio': self.hit_ratio}
+
+
+class RenderTimeoutError(Exception):
+    pass
+
+
+def _retrieve_exception(job: asyncio.Future) -> None:
+    """
+    Mark the error of a job that nobody waits for anymore as retrieved, so asyncio does not log it as unhandled
+    """
+    if not job.cancelled():
+        job.exception()
+
+
+class RenderService:
+    """
+    Renders board images in a pool of worker processes, so rasterisation does not block the event loop. At most
+    `max_workers + max_queue` renders are submitted to the pool at once; callers beyond that wait for a free slot.
+    Concurrent requests for the same board share one render job.
+    """
+
+    def __init__(self, cache: BoardRenderCache, max_workers: int, max_queue: int, timeout: float,
+                 backend: str = 'svg'):
+        self.cache = cache
+        self.backend = backend
+        self.render_function = RENDERERS[backend]
+        self.max_workers = max_workers
+        self.timeout = timeout
+        self._slots = asyncio.Semaphore(max_workers + max_queue)
+        self._in_flight: dict[RenderKey, tuple[asyncio.Future, asyncio.Event]] = {}
+        self._executor: ProcessPoolExecutor | None = None
+
+    def start(self) -> None:
+        # The forkserver context avoids forking the bot process while it runs other threads
+        self._executor = ProcessPoolExecutor(max_workers=self.max_workers,
+                                             mp_context=multiprocessing.get_context('forkserver'))
+
+    def shutdown(self) -> None:
+        if self._executor is not None:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+
+    @property
+    def queued(self) -> int:
+        return len(self._in_flight)
+
+    async def render(self, key: RenderKey) -> bytes:
+        """
+        Get the board image from the cache, or render it in the process pool and store it in the cache
+        @raise RenderTimeoutError: when the render job does not finish within the timeout
+        """
+        png = self.cache.get(key)
+        if png is not None:
+            return png
+        if (in_flight := self._in_flight.get(key)) is None:
+            started = asyncio.Event()  # Set when the job got a slot in the pool
+            job = asyncio.ensure_future(self._submit(key, started))
+            in_flight = self._in_flight[key] = (job, started)
+            job.add_done_callback(lambda _: self._in_flight.pop(key, None))
+            job.add_done_callback(lambda _: started.set())
+            # Nobody may be waiting for the job when it fails, after a timeout or when all callers were cancelled
+            job.add_done_callback(_retrieve_exception)
+        job, started = in_flight
+        # Waiting for a slot does not count towards the timeout, only the render itself
+        await started.wait()
+        try:
+            # The job keeps its slot in the pool until the worker is done, also when the caller stops waiting
+            return await asyncio.wait_for(asyncio.shield(job), timeout=self.timeout)
+        except asyncio.TimeoutError:
+            raise RenderTimeoutError(f'Rendering {key} took longer than {self.timeout} seconds')
+
+    async def _submit(self, key: RenderKey, started: asyncio.Event) -> bytes:
+        async with self._slots:
+            started.set()
+            start = time.perf_counter()
+            png = await asyncio.get_running_loop().run_in_executor(self._executor, self.render_function, key)
+            RENDER_SECONDS.observe(time.perf_counter() - start, backend=self.backend)
+        self.cache.put(key, png)
+        return png
@@ -0,0 +1,109 @@
+"""
+The full solution line of a puzzle, computed once when the puzzle is started, so answers, hints and updated boards
+are lookups by ply instead of move generation, and the tables to match answers in any notation
+"""
+import re
+
+import chess
+
+HINT_PIECES: dict[str, str] = {'R': 'rook', 'N': 'knight', 'B': 'bishop', 'Q': 'queen', 'K': 'king'}
+
+
+def spelling_key(answer: str) -> str:
+    """
+    Normalized spelling of a move, ignoring whitespace, capture, check and mate markers, separators and annotations
+    """
+    return re.sub(r'[\sxX+#|=:!?-]', '', answer).replace('0', 'O')
+
+
+class AnswerTable:
+    """
+    Every accepted spelling of every legal move in a position: SAN, UCI and long algebraic notation, with or without
+    capture, check and mate markers, in any case. Whether a move is checkmate is looked up in the same table.
+    """
+
+    def __init__(self, fen: str):
+        board = chess.Board(fen)
+        self._exact: dict[str, list[str]] = {}
+        self._lower: dict[str, list[str]] = {}
+        self.mates: set[str] = set()
+        for move in board.legal_moves:
+            uci = move.uci()
+            san = board.san(move)
+            piece = board.piece_at(move.from_square).symbol().upper()
+            promotion = f'={chess.piece_symbol(move.promotion).upper()}' if move.promotion else ''
+            long_algebraic = (f'{"" if piece == "P" else piece}{chess.square_name(move.from_square)}'
+                              f'-{chess.square_name(move.to_square)}{promotion}')
+            for spelling in {san, uci, long_algebraic}:
+                key = spelling_key(spelling)
+                self._exact.setdefault(key, []).append(uci)
+                self._lower.setdefault(key.lower(), []).append(uci)
+            if san.endswith('#'):
+                self.mates.add(uci)
+
+    def match(self, answer: str, preferred: str | None = None) -> str | None:
+        """
+        UCI of the move the answer spells, or None if it is not a legal move. When a lowercase answer is ambiguous
+        (bc4 for Bc4 or bxc4), the preferred move is chosen if it is one of the candidates.
+        """
+        key = spelling_key(answer)
+        exact, lower = self._exact.get(key, []), self._lower.get(key.lower(), [])
+        if preferred is not None and (preferred in exact or preferred in lower):
+            return preferred
+        candidates = exact or lower
+        return candidates[0] if candidates else None
+
+
+class SolutionLine:
+    """
+    Every ply of a puzzle, starting with the opponent's initial move. Ply i is played from the position fens[i], so
+    the solver plays the odd plies, and fens[-1] is the final position.
+    """
+
+    def __init__(self, fen: str, moves: list[str]):
+        board = chess.Board(fen)
+        self.fens: list[str] = [fen]
+        self.moves: list[chess.Move] = []
+        self.uci: list[str] = []
+        self.san: list[str] = []
+        self.hint_pieces: list[str] = []  # Piece to move for every ply
+        self._answer_tables: dict[int, AnswerTable] = {}
+        for uci in moves:
+            move = board.parse_uci(uci)
+            san = board.san(move)
+            board.push(move)
+            self.fens.append(board.fen())
+            self.moves.append(move)
+            self.uci.append(uci)
+            self.san.append(san)
+            self.hint_pieces.append(HINT_PIECES.get(san[0], 'pawn'))
+
+    def __len__(self) -> int:
+        return len(self.uci)
+
+    @property
+    def color(self) -> str:
+        """
+        Color of the solver
+        """
+        return 'black' if ' w ' in self.fens[0] else 'white'
+
+    def ply(self, moves_left: int) -> int:
+        """
+        Ply to be played when there are moves_left moves left in the puzzle
+        """
+        return len(self) - moves_left
+
+    def board_fen(self, ply: int) -> str:
+        """
+        Piece placement of the position in which the ply is to be played
+        """
+        return self.fens[ply].split(' ', 1)[0]
+
+    def answer_table(self, ply: int) -> AnswerTable:
+        """
+        Answer table of the position in which the ply is to be played, built on first use
+        """
+        if (table := self._answer_tables.get(ply)) is None:
+            table = self._answer_tables[ply] = AnswerTable(self.fens[ply])
+        return table
@@ -0,0 +1,42 @@
+"""
+Fixed vocabulary of Lichess puzzle themes, to store the themes of a puzzle as a bitmask
+https://github.com/lichess-org/lila/blob/master/translation/source/puzzleTheme.xml
+"""
+import functools
+import re
+from typing import Iterable
+
+# The position of a theme is its bit in the mask. Only append to this tuple, as the masks are stored. It must not
+# exceed 63 themes, to fit the mask in a signed 64-bit integer.
+THEME_VOCABULARY: tuple[str, ...] = (
+    'advancedPawn', 'advantage', 'anastasiaMate', 'arabianMate', 'attackingF2F7', 'attraction', 'backRankMate',
+    'bishopEndgame', 'bodenMate', 'capturingDefender', 'castling', 'clearance', 'crushing', 'defensiveMove',
+    'deflection', 'discoveredAttack', 'doubleBishopMate', 'doubleCheck', 'dovetailMate', 'enPassant', 'endgame',
+    'equality', 'exposedKing', 'fork', 'hangingPiece', 'hookMate', 'interference', 'intermezzo', 'kingsideAttack',
+    'knightEndgame', 'long', 'master', 'masterVsMaster', 'mate', 'mateIn1', 'mateIn2', 'mateIn3', 'mateIn4', 'mateIn5',
+    'middlegame', 'oneMove', 'opening', 'pawnEndgame', 'pin', 'promotion', 'queenEndgame', 'queenRookEndgame',
+    'queensideAttack', 'quietMove', 'rookEndgame', 'sacrifice', 'short', 'skewer', 'smotheredMate', 'superGM',
+    'trappedPiece', 'underPromotion', 'veryLong', 'xRayAttack', 'zugzwang',
+)
+assert len(THEME_VOCABULARY) <= 63
+
+THEME_BITS: dict[str, int] = {theme: 1 << i for i, theme in enumerate(THEME_VOCABULARY)}
+THEME_WORDS = re.compile(r'[a-z]+|(?:[A-Z\d][a-z]*)')
+
+
+def themes_mask(themes: Iterable[str] | None) -> int:
+    """
+    Bitmask of the themes. Themes that are not in the vocabulary are ignored.
+    """
+    mask = 0
+    for theme in themes or ():
+        mask |= THEME_BITS.get(theme, 0)
+    return mask
+
+
+@functools.lru_cache(maxsize=256)
+def theme_name(theme: str) -> str:
+    """
+    Readable name of a theme, e.g. 'Mate in 2' for mateIn2
+    """
+    return ' '.join(THEME_WORDS.findall(theme)).capitalize()
@@ -0,0 +1,196 @@
+"""
+Ingestion of the Lichess puzzle database into the puzzles table, and the puzzle index written along with it. Kept out
+of database.py, which the web app imports without the other bot modules.
+https://database.lichess.org/#puzzles
+"""
+import io
+import logging
+import os
+import time
+
+import asyncpg
+import numpy as np
+import pandas as pd
+from sqlalchemy.ext.asyncio import create_async_engine
+from sqlalchemy.dialects import postgresql
+
+from database import Puzzle
+from ingestion import stream_puzzle_batches, content_hashes, ContentHashDiff
+from puzzle_index import PuzzleIndexWriter
+from themes import THEME_BITS, themes_mask
+
+logger = logging.getLogger('bot.update_puzzles')
+
+PUZZLE_DATABASE_URL = 'https://database.lichess.org/lichess_db_puzzle.csv.zst'
+CSV_COLUMNS: list[str] = ['puzzle_id', 'fen', 'moves', 'rating', 'rating_deviation', 'popularity', 'nr_plays', 'themes',
+                           'url', 'opening_family', 'opening_variation']
+INGESTED_COLUMNS: list[str] = CSV_COLUMNS + ['themes_mask', 'content_hash']
+# Largest fraction of the puzzles that an incremental update retires or deletes without being forced. More missing
+# puzzles rather mean that the source is not a complete puzzle database.
+MAX_MISSING_RATIO = 0.05
+
+
+def transform_puzzles(df: pd.DataFrame) -> pd.DataFrame:
+    """
+    Transform a chunk of the puzzle database CSV to the columns of the puzzles table
+    """
+    df['content_hash'] = content_hashes(df[CSV_COLUMNS])
+    df.moves = df.moves.map(str.split)
+    df.themes = df.themes.map(str.split, na_action='ignore')
+    df.opening_family = df.opening_family.str.replace('_', ' ', regex=False)
+    df.opening_variation = df.opening_variation.str.replace('_', ' ', regex=False)
+    df.replace({np.nan: None}, inplace=True)
+    df['themes_mask'] = df.themes.map(themes_mask)
+    return df
+
+
+def unknown_themes(df: pd.DataFrame) -> set[str]:
+    """
+    Themes of a chunk of transformed puzzles that are not in the theme vocabulary, and so not in their themes_mask
+    """
+    return set(df.themes.explode().dropna().unique()) - THEME_BITS.keys()
+
+
+async def copy_to_staging(conn: asyncpg.Connection, df: pd.DataFrame) -> None:
+    """
+    Stream a chunk of transformed puzzles into the staging table with a binary COPY
+    """
+    records = df[INGESTED_COLUMNS].assign(themes=df.themes.map(lambda themes: themes or [])).astype(object)
+    # Cast to object so the records hold Python scalars instead of NumPy scalars
+    records = list(records.itertuples(index=False, name=None))
+    await conn.copy_records_to_table('puzzles_staging', records=records, columns=INGESTED_COLUMNS)
+
+
+async def merge_staging(conn: asyncpg.Connection) -> None:
+    """
+    Upsert all staged puzzles into the puzzles table in one statement
+    """
+    columns = ', '.join(INGESTED_COLUMNS)
+    updates = ', '.join(f'{column} = EXCLUDED.{column}' for column in INGESTED_COLUMNS if column != 'puzzle_id')
+    await conn.execute(f'INSERT INTO puzzles ({columns}) SELECT {columns} FROM puzzles_staging '
+                       f'ON CONFLICT (puzzle_id) DO UPDATE SET {updates}, retired = false')
+
+
+async def scan_content_hashes(conn: asyncpg.Connection) -> ContentHashDiff:
+    """
+    Read the content hash of every puzzle. Retired puzzles get hash 0, so they are updated when they reappear.
+    """
+    output = io.BytesIO()
+    await conn.copy_from_query('SELECT puzzle_id, CASE WHEN retired THEN 0 ELSE COALESCE(content_hash, 0) END '
+                               'FROM puzzles', output=output, format='csv')
+    output.seek(0)
+    df = pd.read_csv(output, names=['puzzle_id', 'content_hash'], dtype={'puzzle_id': str, 'content_hash': np.int64})
+    return ContentHashDiff(df.puzzle_id.to_numpy(dtype=bytes), df.content_hash.to_numpy())
+
+
+async def retire_puzzles(conn: asyncpg.Connection, puzzle_ids: list[str], delete: bool = False) -> tuple[int, int]:
+    """
+    Soft-delete puzzles that are no longer in the puzzle database, so they are not selected anymore. With delete,
+    puzzles are deleted instead, except the ones that are still being solved in a channel.
+    @return: the number of deleted and retired puzzles
+    """
+    deleted = 0
+    if delete:
+        status = await conn.execute('DELETE FROM puzzles WHERE puzzle_id = ANY($1::text[]) AND NOT EXISTS '
+                                    '(SELECT 1 FROM channel_puzzles WHERE channel_puzzles.puzzle_id = puzzles.puzzle_id)',
+                                    puzzle_ids)
+        deleted = int(status.split()[-1])
+    status = await conn.execute('UPDATE puzzles SET retired = true WHERE puzzle_id = ANY($1::text[]) AND NOT retired',
+                                puzzle_ids)
+    return deleted, int(status.split()[-1])
+
+
+def parse_puzzles(data: bytes) -> pd.DataFrame:
+    """
+    Parse and transform a batch of records of the puzzle database CSV. Runs in the worker processes of the ingestion
+    pipeline.
+    """
+    return transform_puzzles(pd.read_csv(io.BytesIO(data), names=CSV_COLUMNS))
+
+
+async def update_puzzles_table(source: str = PUZZLE_DATABASE_URL, mode: str = 'upsert', delete_missing: bool = False,
+                               index_dir: str | None = None, force: bool = False):
+    """
+    1. Stream the puzzle database from https://database.lichess.org/lichess_db_puzzle.csv.zst, or a local copy, and
+    decompress it on the fly
+    2. Parse and transform batches of puzzles in a pool of worker processes
+    3. Ingest the puzzles in the database, updating puzzles where present
+    4. Write the memory-mapped puzzle index used by the bot to select puzzles
+
+    @param source: URL or path of the zstd compressed puzzle database
+    @param mode: how to ingest the puzzles
+        upsert: upsert every batch of puzzles
+        copy: COPY all puzzles into an unlogged staging table and merge it into the puzzles table with a single upsert,
+        then rebuild the indexes of the puzzles table
+        incremental: like copy, but only stage the puzzles that are new or changed according to their content hash,
+        and retire the puzzles that are no longer in the puzzle database
+    @param delete_missing: in incremental mode, delete puzzles that are no longer in the puzzle database instead of
+    retiring them, unless they are still being solved in a channel
+    @param index_dir: directory of the puzzle index, puzzle_index.INDEX_DIR by default
+    @param force: in incremental mode, retire or delete the missing puzzles also when they are more than
+    MAX_MISSING_RATIO of the puzzles. Otherwise the update is refused and nothing is changed.
+    """
+    batches = stream_puzzle_batches(source, parse_puzzles)
+    index_writer = PuzzleIndexWriter()
+    nr_rows = nr_written = 0
+    unknown = set()
+    start = time.perf_counter()
+    if mode in ('copy', 'incremental'):
+        conn = await asyncpg.connect(user=os.getenv('DATABASE_USER'), password=os.getenv('DATABASE_PASSWORD'),
+                                     host=os.getenv('DATABASE_HOST'), database=os.getenv('DATABASE_NAME'))
+        try:
+            diff = await scan_content_hashes(conn) if mode == 'incremental' else None
+            # Recreated on every run, so a table left over from before a schema change is not reused
+            await conn.execute('DROP TABLE IF EXISTS puzzles_staging')
+            await conn.execute('CREATE UNLOGGED TABLE puzzles_staging (LIKE puzzles INCLUDING DEFAULTS)')
+            async for df in batches:
+                index_writer.add(df)
+                unknown |= unknown_themes(df)
+                nr_rows += len(df)
+                if diff is not None:
+                    df = df[diff.changed(df.puzzle_id.to_numpy(dtype=bytes), df.content_hash.to_numpy())]
+                await copy_to_staging(conn, df)
+                nr_written += len(df)
+            logger.info(f'Copied {nr_written} of {nr_rows} puzzles to the staging table '
+                        f'({nr_rows / (time.perf_counter() - start):.0f} rows/s)')
+            missing = diff.missing() if diff is not None else []
+            if missing and len(missing) > MAX_MISSING_RATIO * len(diff.ids) and not force:
+                raise ValueError(f'{len(missing)} of {len(diff.ids)} puzzles are not in the puzzle database at '
+                                 f'{source}, which is likely incomplete. Force the update to retire them anyway.')
+            async with conn.transaction():
+                await merge_staging(conn)
+                if missing:
+                    deleted, retired = await retire_puzzles(conn, missing, delete=delete_missing)
+                    logger.info(f'{len(missing)} puzzles are no longer in the puzzle database: deleted {deleted}, '
+                                f'retired {retired}')
+            await conn.execute('DROP TABLE puzzles_staging')
+            if mode == 'copy':
+                # Rebuild the indexes bloated by the upsert without blocking the bot
+                await conn.execute('REINDEX TABLE CONCURRENTLY puzzles')
+            await conn.execute('ANALYZE puzzles')
+        finally:
+            await conn.close()
+    else:
+        engine = create_async_engine(f'postgresql+asyncpg://{os.getenv("DATABASE_USER")}'
+                                     f':{os.getenv("DATABASE_PASSWORD")}'
+                                     f'@{os.getenv("DATABASE_HOST")}'
+                                     f'/{os.getenv("DATABASE_NAME")}',
+                                     future=True)
+        async with engine.begin() as conn:
+            async for df in batches:
+                for chunk_start in range(0, len(df), 1000):  # Stay below the maximum number of query parameters
+                    insert_statement = postgresql.insert(Puzzle.__table__).values(
+                        df.iloc[chunk_start:chunk_start + 1000].to_dict(orient='records'))
+                    upsert_statement = insert_statement.on_conflict_do_update(
+                        index_elements=['puzzle_id'],
+                        set_={c.key: c for c in insert_statement.excluded if c.key not in ('puzzle_id', 'random_key')})
+                    await conn.execute(upsert_statement)
+                index_writer.add(df)
+                unknown |= unknown_themes(df)
+                nr_rows += len(df)
+        await engine.dispose()
+    logger.info(f'Ingested {nr_rows} puzzles ({nr_rows / (time.perf_counter() - start):.0f} rows/s)')
+    if unknown:
+        logger.warning(f'Themes that are not in the theme vocabulary, so puzzles cannot be selected by them: '
+                       f'{", ".join(sorted(unknown))}. Append them to THEME_VOCABULARY in themes.py.')
+    index_writer.write(index_dir)
@@ -0,0 +1,109 @@
+"""
+Watchdog of the event loop. A task measures how late the loop wakes it up, and a helper thread notices when the loop
+has not woken it up for too long. The thread then logs the stack of the loop's thread, together with the interaction
+of the task that was running, so a blocking call can be traced back to the code and the command that made it.
+"""
+import asyncio
+import logging
+import sys
+import threading
+import time
+import traceback
+from functools import partial
+
+import discord
+
+from metrics import LOOP_LAG, LOOP_BLOCKS
+
+_interactions: dict[asyncio.Task, str] = {}  # Description of the interaction handled by a task
+
+
+def describe(interaction: discord.Interaction) -> str:
+    if interaction.type == discord.InteractionType.application_command and interaction.command is not None:
+        action = f'/{interaction.command.qualified_name}'
+    elif interaction.type == discord.InteractionType.component and interaction.data is not None:
+        action = f'component {interaction.data.get("custom_id")}'
+    else:
+        action = interaction.type.name
+    return f'{action} by user {interaction.user.id} in channel {interaction.channel_id} of guild {interaction.guild_id}'
+
+
+def track(interaction: discord.Interaction) -> None:
+    """
+    Remember the interaction that the current task handles, to name it when the task blocks the event loop
+    """
+    task = asyncio.current_task()
+    if task is not None and task not in _interactions:
+        _interactions[task] = describe(interaction)
+        task.add_done_callback(lambda t: _interactions.pop(t, None))
+
+
+class LoopWatchdog:
+    def __init__(self, logger: logging.Logger, interval: float = 0.1, threshold: float = 0.5):
+        """
+        @param interval: seconds between measurements of the lag
+        @param threshold: seconds the event loop may be blocked before its stack is logged
+        """
+        self.logger = logger
+        self.interval = interval
+        self.threshold = threshold
+        self.lag_max = 0.0
+        self.lag_total = 0.0
+        self.measurements = 0
+        self.blocks = 0  # Times the loop was blocked longer than the threshold
+        self._loop: asyncio.AbstractEventLoop | None = None
+        self._loop_thread_id: int | None = None
+        self._beat_at = 0.0  # Monotonic time at which the loop last ran the watchdog task
+        self._task: asyncio.Task | None = None
+        self._stopped = threading.Event()
+
+    def start(self) -> None:
+        self._loop = asyncio.get_running_loop()
+        self._loop_thread_id = threading.get_ident()
+        self._beat_at = time.monotonic()
+        self._task = asyncio.create_task(self._measure())
+        threading.Thread(target=self._watch, name='loop-watchdog', daemon=True).start()
+
+    def stop(self) -> None:
+        self._stopped.set()
+        if self._task is not None:
+            self._task.cancel()
+
+    async def _measure(self) -> None:
+        while True:
+            self._beat_at = time.monotonic()
+            await asyncio.sleep(self.interval)
+            lag = max(0.0, time.monotonic() - self._beat_at - self.interval)
+            LOOP_LAG.observe(lag, shard='all')
+            self.measurements += 1
+            self.lag_total += lag
+            self.lag_max = max(self.lag_max, lag)
+
+    def _watch(self) -> None:
+        reported = None  # Beat of which the block was reported, to report every block once
+        while not self._stopped.wait(self.interval):
+            beat_at = self._beat_at
+            blocked = time.monotonic() - beat_at - self.interval
+            if blocked < self.threshold or beat_at == reported:
+                continue
+            reported = beat_at
+            self.blocks += 1
+            # The metrics are not thread-safe, so count the block on the loop's thread, once the loop runs again
+            try:
+                self._loop.call_soon_threadsafe(partial(LOOP_BLOCKS.inc, shard='all'))
+            except RuntimeError:  # The loop was closed
+                return
+            frame = sys._current_frames().get(self._loop_thread_id)
+            stack = ''.join(traceback.format_stack(frame)) if frame is not None else 'unknown\n'
+            task = asyncio.current_task(self._loop)
+            if task is None:
+                running = 'a callback outside of a task'
+            else:
+                running = f'task {task.get_name()} ({getattr(task.get_coro(), "__qualname__", "unknown")})'
+                if (interaction := _interactions.get(task)) is not None:
+                    running += f' handling {interaction}'
+            self.logger.warning(f'Event loop blocked for {blocked:.2f}s by {running}, at:\n{stack}')
+
+    def stats(self) -> dict[str, int | float]:
+        return {'blocks': self.blocks, 'lag_avg': self.lag_total / self.measurements if self.measurements else 0.0,
+                'lag_max': self.lag_max}
@@ -0,0 +1,6 @@
+import os
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.append(os.path.join(ROOT, 'bot'))
+sys.path.append(os.path.join(ROOT, 'benchmarks'))  # The fake Lichess API
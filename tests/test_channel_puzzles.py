@@ -0,0 +1,101 @@
+import asyncio
+import logging
+import unittest
+
+from channel_puzzles import ChannelPuzzleState, ChannelPuzzleStore
+from database import ChannelPuzzle, Puzzle
+
+# Scholar's mate: black plays 3... Nf6 and white mates with 4. Qxf7#
+SCHOLARS_MATE = 'r1bqkbnr/pppp1ppp/2n5/4p2Q/2B1P3/8/PPPP1PPP/RNB1K1NR b KQkq - 3 3'
+CHANNEL = 1234
+
+
+class FakeTable:
+    """
+    The channel_puzzles table, written through fake sessions. Batched updates can be held up to let other writes
+    run in the meantime.
+    """
+
+    def __init__(self):
+        self.rows: dict[int, tuple[str, list[str], str]] = {}  # Channel ID to (puzzle ID, moves, FEN)
+        self.writes: list[str] = []
+        self.hold = asyncio.Event()
+        self.hold.set()
+        self.held = asyncio.Event()  # Set when a batched update is being held up
+
+    def session(self) -> 'FakeSession':
+        return FakeSession(self)
+
+
+class FakeSession:
+    def __init__(self, table: FakeTable):
+        self.table = table
+
+    async def __aenter__(self) -> 'FakeSession':
+        return self
+
+    async def __aexit__(self, *exc) -> None:
+        pass
+
+    def begin(self) -> 'FakeSession':
+        return self
+
+    async def merge(self, c_puzzle: ChannelPuzzle) -> None:
+        await asyncio.sleep(0)
+        self.table.rows[c_puzzle.channel_id] = (c_puzzle.puzzle_id, list(c_puzzle.moves), c_puzzle.fen)
+        self.table.writes.append('put')
+
+    async def execute(self, statement, params=None) -> None:
+        if params is None:
+            raise NotImplementedError(statement)
+        self.table.held.set()
+        await self.table.hold.wait()
+        # The batched UPDATE of ChannelPuzzleStore.flush, matching the channel and the puzzle
+        for param in params:
+            row = self.table.rows.get(param['c_id'])
+            if row is not None and row[0] == param['c_puzzle_id']:
+                self.table.rows[param['c_id']] = (row[0], param['c_moves'], param['c_fen'])
+        self.table.writes.append('flush')
+
+    async def commit(self) -> None:
+        pass
+
+
+class ChannelPuzzleStoreTest(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        self.table = FakeTable()
+        self.store = ChannelPuzzleStore(self.table.session, max_size=10, write_delay=60,
+                                        logger=logging.getLogger('test.channel_puzzles'))
+        self.puzzle = Puzzle(puzzle_id='00001', fen=SCHOLARS_MATE, moves=['g8f6', 'h5f7'])
+
+    def new_state(self) -> ChannelPuzzleState:
+        state = ChannelPuzzleState(CHANNEL, self.puzzle, moves=list(self.puzzle.moves), fen=self.puzzle.fen)
+        state.seek(1)  # The opponent's move was played
+        return state
+
+    async def test_flush_writes_progress(self):
+        state = self.new_state()
+        await self.store.put(state)
+        state.seek(2)
+        await self.store.update(state)
+        self.assertEqual(self.table.rows[CHANNEL][1], ['h5f7'])  # Not written yet
+        await self.store.flush()
+        self.assertEqual(self.table.rows[CHANNEL], ('00001', [], state.line.fens[2]))
+        self.assertEqual(self.store.stats()['pending_writes'], 0)
+
+    async def test_flush_during_restart_of_same_puzzle(self):
+        state = self.new_state()
+        await self.store.put(state)
+        state.seek(2)
+        await self.store.update(state)
+        # The same puzzle is started again while the progress of the first attempt is being flushed
+        self.table.hold.clear()
+        flush = asyncio.create_task(self.store.flush())
+        await self.table.held.wait()
+        restart = asyncio.create_task(self.store.put(self.new_state()))
+        await asyncio.sleep(0.01)
+        self.table.hold.set()
+        await asyncio.gather(flush, restart)
+        self.assertEqual(self.table.writes, ['put', 'flush', 'put'])
+        self.assertEqual(self.table.rows[CHANNEL], ('00001', ['h5f7'], state.line.fens[1]))
+        self.assertEqual((await self.store.get(CHANNEL)).ply, 1)
@@ -0,0 +1,98 @@
+import asyncio
+import logging
+import unittest
+from types import SimpleNamespace
+from unittest import mock
+
+from edits import EditBudget, EditScheduler
+
+
+class Clock:
+    """
+    Monotonic clock that only advances when the code under test sleeps. Tests use rates whose intervals are exact
+    binary fractions, so sleeping always advances the clock.
+    """
+
+    def __init__(self):
+        self.now = 1000.0
+        self.slept = 0.0
+
+    def __call__(self) -> float:
+        return self.now
+
+    async def sleep(self, seconds: float) -> None:
+        self.now += seconds
+        self.slept += seconds
+
+
+class EditBudgetTest(unittest.IsolatedAsyncioTestCase):
+    def setUp(self):
+        self.clock = Clock()
+        # Patch the modules as seen by edits only, the event loop keeps its own clock
+        for target, replacement in (('edits.time', SimpleNamespace(monotonic=self.clock)),
+                                    ('edits.asyncio', SimpleNamespace(sleep=self.clock.sleep))):
+            patcher = mock.patch(target, replacement)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    async def test_burst_then_rate(self):
+        budget = EditBudget(rate=4)
+        for _ in range(4):
+            await budget.acquire()
+        self.assertEqual(self.clock.slept, 0)
+        for _ in range(10):
+            await budget.acquire()
+        self.assertAlmostEqual(self.clock.slept, 2.5)
+
+    async def test_refills_up_to_rate(self):
+        budget = EditBudget(rate=4)
+        for _ in range(4):
+            await budget.acquire()
+        self.clock.now += 60
+        for _ in range(5):
+            await budget.acquire()
+        self.assertAlmostEqual(self.clock.slept, 0.25)
+
+    def test_adapts_rate(self):
+        budget = EditBudget(rate=8, min_rate=1.5)
+        budget.rate_limited()
+        self.assertEqual(budget.rate, 4)
+        for _ in range(3):
+            budget.rate_limited()
+        self.assertEqual(budget.rate, 1.5)
+        for _ in range(5):
+            budget.succeeded()
+        self.assertAlmostEqual(budget.rate, 2.0)
+        for _ in range(100):
+            budget.succeeded()
+        self.assertEqual(budget.rate, 8)
+
+    async def test_slowed_down_after_rate_limit(self):
+        budget = EditBudget(rate=4)
+        budget.rate_limited()
+        for _ in range(12):
+            await budget.acquire()
+        self.assertAlmostEqual(self.clock.slept, 5.0)  # 2 edits at once, then 2 per second
+
+
+class EditSchedulerTest(unittest.IsolatedAsyncioTestCase):
+    async def test_skips_intermediate_states(self):
+        scheduler = EditScheduler(logging.getLogger('tests'), budget=100, min_interval=0, max_interval=1)
+        shown = []
+        release = asyncio.Event()
+
+        async def show(state: int) -> None:
+            shown.append(state)
+            await release.wait()
+
+        scheduler.submit('message', 0, show)
+        await asyncio.sleep(0)
+        for state in range(1, 6):  # Submitted while the first edit is in progress
+            scheduler.submit('message', state, show)
+        release.set()
+        await scheduler.close('message') if False else None
+        while scheduler.stats()['edits'] < 2:
+            await asyncio.sleep(0)
+        self.assertEqual(shown, [0, 5])
+        self.assertEqual(scheduler.stats()['skipped'], 4)
+        await scheduler.close('message')
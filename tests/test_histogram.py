@@ -0,0 +1,69 @@
+import unittest
+
+import numpy as np
+
+from histogram import PuzzleHistogram
+from themes import THEME_BITS
+
+
+class PuzzleHistogramTest(unittest.TestCase):
+    def setUp(self):
+        rng = np.random.default_rng(0)
+        self.ratings = np.sort(rng.integers(600, 900, size=2000)).astype(np.int16)
+        self.masks = rng.integers(0, 1 << 8, size=2000).astype(np.uint64)
+        self.histogram = PuzzleHistogram.from_arrays(self.ratings, self.masks)
+
+    def expected_count(self, rating_from=None, rating_to=None, theme=None):
+        selected = np.ones(len(self.ratings), dtype=bool)
+        if rating_from is not None:
+            selected &= self.ratings >= rating_from
+        if rating_to is not None:
+            selected &= self.ratings <= rating_to
+        if theme is not None:
+            selected &= (self.masks & np.uint64(THEME_BITS[theme])) != 0
+        return int(selected.sum())
+
+    def test_count(self):
+        for rating_from, rating_to in [(None, None), (700, 800), (750, 750), (0, 650), (850, 5000), (800, 700),
+                                       (100, 200), (1000, 1100)]:
+            for theme in (None, 'advancedPawn', 'attraction'):
+                with self.subTest(rating_from=rating_from, rating_to=rating_to, theme=theme):
+                    self.assertEqual(self.histogram.count(rating_from, rating_to, theme),
+                                     self.expected_count(rating_from, rating_to, theme))
+
+    def test_count_theme_not_present(self):
+        self.assertEqual(self.histogram.count(theme='zugzwang'), 0)
+
+    def test_nth(self):
+        for rating_from in (None, 700):
+            for theme in (None, 'advantage'):
+                selected = np.ones(len(self.ratings), dtype=bool) if theme is None else \
+                    (self.masks & np.uint64(THEME_BITS[theme])) != 0
+                if rating_from is not None:
+                    selected &= self.ratings >= rating_from
+                ratings = self.ratings[selected]
+                for n in (0, 1, len(ratings) // 2, len(ratings) - 1):
+                    with self.subTest(rating_from=rating_from, theme=theme, n=n):
+                        rating, position = self.histogram.nth(n, rating_from, theme)
+                        self.assertEqual(rating, ratings[n])
+                        self.assertEqual(position, n - int(np.searchsorted(ratings, rating)))
+
+    def test_from_counts(self):
+        ratings, counts = np.unique(self.ratings, return_counts=True)
+        theme_counts = []
+        for theme in ('advancedPawn', 'advantage'):
+            has_theme = (self.masks & np.uint64(THEME_BITS[theme])) != 0
+            theme_ratings, theme_totals = np.unique(self.ratings[has_theme], return_counts=True)
+            theme_counts += [(int(r), theme, int(c)) for r, c in zip(theme_ratings, theme_totals)]
+        theme_counts.append((700, 'notATheme', 5))
+        histogram = PuzzleHistogram.from_counts([(int(r), int(c)) for r, c in zip(ratings, counts)], theme_counts)
+        for rating_from, rating_to in [(None, None), (650, 720), (899, 899)]:
+            for theme in (None, 'advancedPawn', 'advantage'):
+                self.assertEqual(histogram.count(rating_from, rating_to, theme),
+                                 self.expected_count(rating_from, rating_to, theme))
+
+    def test_empty(self):
+        for histogram in (PuzzleHistogram.from_arrays(np.array([], dtype=np.int16), np.array([], dtype=np.uint64)),
+                          PuzzleHistogram.from_counts([], [])):
+            self.assertEqual(histogram.count(), 0)
+            self.assertEqual(histogram.count(1000, 2000, 'fork'), 0)
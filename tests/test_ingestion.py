@@ -0,0 +1,141 @@
+import asyncio
+import os
+import tempfile
+import unittest
+from typing import AsyncIterator
+
+import numpy as np
+import pandas as pd
+import zstandard
+
+from ingestion import ContentHashDiff, content_hashes, decompress_zstd, parse_batches, read_source, split_records
+
+HEADER = b'PuzzleId,FEN,Moves,Rating,RatingDeviation,Popularity,NbPlays,Themes,GameUrl,OpeningTags\n'
+RECORD_SIZE = len(b'00000,fen,moves,1500,75,90,100,fork,url,\n')
+
+
+async def chunked(data: bytes, size: int) -> AsyncIterator[bytes]:
+    for i in range(0, len(data), size):
+        yield data[i:i + size]
+
+
+async def chunked_list(batches: list[bytes]) -> AsyncIterator[bytes]:
+    for batch in batches:
+        yield batch
+
+
+async def collect(iterator: AsyncIterator) -> list:
+    return [item async for item in iterator]
+
+
+def records(n: int) -> bytes:
+    return b''.join(b'%05d,fen,moves,1500,75,90,100,fork,url,\n' % i for i in range(n))
+
+
+class DecompressTest(unittest.TestCase):
+    def test_chunked(self):
+        data = HEADER + records(1000)
+        compressed = zstandard.ZstdCompressor().compress(data)
+        for size in (1, 7, 1024, len(compressed)):
+            with self.subTest(size=size):
+                self.assertEqual(b''.join(asyncio.run(collect(decompress_zstd(chunked(compressed, size))))), data)
+
+    def test_multiple_frames(self):
+        compressor = zstandard.ZstdCompressor()
+        frames = [records(10), records(20), records(30)]
+        compressed = b''.join(compressor.compress(frame) for frame in frames)
+        for size in (5, len(compressed)):
+            with self.subTest(size=size):
+                self.assertEqual(b''.join(asyncio.run(collect(decompress_zstd(chunked(compressed, size))))),
+                                 b''.join(frames))
+
+    def test_truncated_file(self):
+        compressor = zstandard.ZstdCompressor()
+        first = compressor.compress(HEADER + records(1000))
+        compressed = first + compressor.compress(records(1000))
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'puzzles.csv.zst')
+            for end in (1, len(first) // 2, len(first) + 1, len(compressed) - 1):
+                with self.subTest(end=end):
+                    with open(path, 'wb') as f:
+                        f.write(compressed[:end])
+                    with self.assertRaises(zstandard.ZstdError):
+                        asyncio.run(collect(split_records(decompress_zstd(read_source(path)), batch_size=1000)))
+
+    def test_empty_file(self):
+        self.assertEqual(asyncio.run(collect(decompress_zstd(chunked(b'', 1)))), [])
+
+
+class SplitRecordsTest(unittest.TestCase):
+    def test_whole_records(self):
+        data = records(1000)
+        for size in (1, 13, 4096):
+            with self.subTest(size=size):
+                batches = asyncio.run(collect(split_records(chunked(HEADER + data, size), batch_size=1000)))
+                self.assertEqual(b''.join(batches), data)
+                self.assertTrue(all(batch.endswith(b'\n') for batch in batches))
+                # A batch ends at the last record boundary once the batch size is reached
+                self.assertTrue(all(len(batch) > 1000 - RECORD_SIZE for batch in batches[:-1]))
+
+    def test_no_header(self):
+        data = records(10)
+        self.assertEqual(b''.join(asyncio.run(collect(split_records(chunked(data, 3), batch_size=100)))), data)
+
+    def test_last_record_without_newline(self):
+        data = records(10) + b'last,fen,moves,1500,75,90,100,fork,url,'
+        self.assertEqual(b''.join(asyncio.run(collect(split_records(chunked(data, 64), batch_size=100)))), data)
+
+    def test_empty(self):
+        self.assertEqual(asyncio.run(collect(split_records(chunked(HEADER, 10), batch_size=100))), [])
+
+
+class ParseBatchesTest(unittest.TestCase):
+    def test_in_order(self):
+        batches = [b'x' * i for i in range(50)]
+        results = asyncio.run(collect(parse_batches(chunked_list(batches), len, workers=2, queue_size=3)))
+        self.assertEqual(results, list(range(50)))
+
+    def test_source_error(self):
+        async def failing():
+            yield b'a'
+            raise OSError('connection lost')
+
+        with self.assertRaises(OSError):
+            asyncio.run(collect(parse_batches(failing(), len, workers=1, queue_size=2)))
+
+    def test_consumer_stops_early(self):
+        async def first(n: int) -> list:
+            results = []
+            async for result in parse_batches(chunked_list([b'x'] * 100), len, workers=1, queue_size=2):
+                results.append(result)
+                if len(results) == n:
+                    break
+            return results
+
+        self.assertEqual(asyncio.run(first(3)), [1, 1, 1])
+
+
+class ContentHashDiffTest(unittest.TestCase):
+    def test_content_hashes(self):
+        df = pd.DataFrame({'puzzle_id': ['a', 'b', 'c'], 'rating': [1500, 1500, 1501], 'themes': 'fork'})
+        hashes = content_hashes(df)
+        self.assertEqual(hashes, content_hashes(df.copy()))
+        self.assertEqual(len(set(hashes)), 3)
+        self.assertTrue(all(-2 ** 63 <= h < 2 ** 63 for h in hashes))
+        df.loc[2, 'rating'] = 1502
+        self.assertEqual(content_hashes(df)[:2], hashes[:2])
+        self.assertNotEqual(content_hashes(df)[2], hashes[2])
+
+    def test_changed_and_missing(self):
+        diff = ContentHashDiff(np.array([b'd', b'a', b'c', b'b']), np.array([4, 1, 3, 2], dtype=np.int64))
+        changed = diff.changed(np.array([b'a', b'b', b'e']), np.array([1, 20, 5], dtype=np.int64))
+        self.assertEqual(changed.tolist(), [False, True, True])
+        self.assertEqual(diff.missing(), ['c', 'd'])
+        self.assertEqual(diff.changed(np.array([b'd', b'0', b'z']), np.array([4, 0, 0], dtype=np.int64)).tolist(),
+                         [False, True, True])
+        self.assertEqual(diff.missing(), ['c'])
+
+    def test_empty_database(self):
+        diff = ContentHashDiff(np.array([], dtype='S5'), np.array([], dtype=np.int64))
+        self.assertEqual(diff.changed(np.array([b'a', b'b']), np.array([1, 2], dtype=np.int64)).tolist(), [True, True])
+        self.assertEqual(diff.missing(), [])
@@ -0,0 +1,171 @@
+import asyncio
+import logging
+import unittest
+from contextlib import AsyncExitStack
+from types import SimpleNamespace
+from unittest import mock
+
+from aiohttp.test_utils import TestServer
+
+from fake_lichess import FakeLichess, random_recordings
+from lichess import CircuitBreaker, LichessClient, LichessNotFound, LichessUnavailable, ResponseCache
+
+
+class Clock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self) -> float:
+        return self.now
+
+
+class CircuitBreakerTest(unittest.TestCase):
+    def setUp(self):
+        self.clock = Clock()
+        patcher = mock.patch('lichess.time', SimpleNamespace(monotonic=self.clock))  # Not the clock of the event loop
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.breaker = CircuitBreaker(threshold=3, reset_timeout=30)
+
+    def test_opens_after_consecutive_failures(self):
+        self.assertFalse(self.breaker.record_failure())
+        self.assertFalse(self.breaker.record_failure())
+        self.assertTrue(self.breaker.allow())
+        self.assertTrue(self.breaker.record_failure())
+        self.assertTrue(self.breaker.is_open)
+        self.assertFalse(self.breaker.allow())
+        self.assertFalse(self.breaker.record_failure())  # Already open
+
+    def test_success_resets_failures(self):
+        self.breaker.record_failure()
+        self.breaker.record_failure()
+        self.breaker.record_success()
+        self.assertFalse(self.breaker.record_failure())
+        self.assertFalse(self.breaker.is_open)
+
+    def test_half_open(self):
+        for _ in range(3):
+            self.breaker.record_failure()
+        self.clock.now += 29
+        self.assertFalse(self.breaker.allow())
+        self.clock.now += 1
+        self.assertTrue(self.breaker.allow())  # A single trial request
+        self.assertFalse(self.breaker.allow())
+        self.assertFalse(self.breaker.record_failure())  # The trial request failed
+        self.assertTrue(self.breaker.is_open)
+        self.clock.now += 30
+        self.assertTrue(self.breaker.allow())
+        self.breaker.record_success()
+        self.assertFalse(self.breaker.is_open)
+        self.assertTrue(self.breaker.allow())
+        self.assertTrue(self.breaker.allow())
+
+
+class Fetch:
+    """
+    Fetches the responses in order, counting the calls
+    """
+
+    def __init__(self, *responses):
+        self.responses = list(responses)
+        self.calls = 0
+
+    async def __call__(self):
+        self.calls += 1
+        await asyncio.sleep(0)
+        response = self.responses.pop(0)
+        if isinstance(response, Exception):
+            raise response
+        return response
+
+
+class ResponseCacheTest(unittest.IsolatedAsyncioTestCase):
+    def setUp(self):
+        self.clock = Clock()
+        patcher = mock.patch('lichess.time', SimpleNamespace(monotonic=self.clock))  # Not the clock of the event loop
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.cache = ResponseCache(max_entries=2, stale_ttl=60)
+
+    async def test_ttl(self):
+        fetch = Fetch('first', 'second')
+        self.assertEqual(await self.cache.get('key', fetch, ttl=10), 'first')
+        self.clock.now += 9
+        self.assertEqual(await self.cache.get('key', fetch, ttl=10), 'first')
+        self.clock.now += 1
+        self.assertEqual(await self.cache.get('key', fetch, ttl=10), 'second')
+        self.assertEqual((self.cache.hits, self.cache.misses), (1, 2))
+
+    async def test_ttl_of_response(self):
+        fetch = Fetch({'status': 'started'}, {'status': 'mate'})
+
+        def ttl(game: dict) -> float:
+            return 5 if game['status'] == 'started' else 3600
+
+        await self.cache.get('game', fetch, ttl=ttl)
+        self.clock.now += 5
+        self.assertEqual(await self.cache.get('game', fetch, ttl=ttl), {'status': 'mate'})
+        self.clock.now += 1000
+        self.assertEqual(await self.cache.get('game', fetch, ttl=ttl), {'status': 'mate'})
+        self.assertEqual(fetch.calls, 2)
+
+    async def test_refresh(self):
+        fetch = Fetch('first', 'second')
+        await self.cache.get('key', fetch, ttl=10)
+        self.assertEqual(await self.cache.get('key', fetch, ttl=10, refresh=True), 'second')
+        self.assertEqual(await self.cache.get('key', fetch, ttl=10), 'second')
+
+    async def test_coalesce(self):
+        fetch = Fetch('response')
+        responses = await asyncio.gather(*(self.cache.get('key', fetch, ttl=10) for _ in range(5)))
+        self.assertEqual(responses, ['response'] * 5)
+        self.assertEqual(fetch.calls, 1)
+        self.assertEqual((self.cache.misses, self.cache.coalesced), (1, 4))
+
+    async def test_evicts_least_recently_used(self):
+        for key in ('a', 'b'):
+            await self.cache.get(key, Fetch(key), ttl=10)
+        await self.cache.get('a', Fetch(), ttl=10)  # Hit, so 'b' is now the least recently used
+        await self.cache.get('c', Fetch('c'), ttl=10)
+        self.assertEqual(len(self.cache), 2)
+        self.assertEqual(await self.cache.get('a', Fetch(), ttl=10), 'a')
+        self.assertEqual(await self.cache.get('b', Fetch('b again'), ttl=10), 'b again')
+
+    async def test_stale_when_unavailable(self):
+        fetch = Fetch('first', LichessUnavailable('down'), LichessUnavailable('down'))
+        await self.cache.get('key', fetch, ttl=10)
+        self.clock.now += 10 + 59
+        self.assertEqual(await self.cache.get('key', fetch, ttl=10), 'first')
+        self.assertEqual(self.cache.stale_hits, 1)
+        self.clock.now += 1
+        with self.assertRaises(LichessUnavailable):
+            await self.cache.get('key', fetch, ttl=10)
+
+    async def test_errors_are_not_cached(self):
+        fetch = Fetch(LichessNotFound('no such user', status=404), 'found')
+        with self.assertRaises(LichessNotFound):
+            await self.cache.get('key', fetch, ttl=10)
+        self.assertEqual(await self.cache.get('key', fetch, ttl=10), 'found')
+
+
+class LichessClientTest(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        self.fake = FakeLichess(random_recordings(1, move_time=1.0), seed=0)
+        self.server = TestServer(self.fake.app())
+        await self.server.start_server()
+        self.addAsyncCleanup(self.server.close)
+        self.lichess = LichessClient(logging.getLogger('test.lichess'), base_url=str(self.server.make_url('')),
+                                     max_concurrency=2, timeout=2)
+        self.lichess.start()
+        self.addAsyncCleanup(self.lichess.close)
+
+    async def test_open_streams_leave_connections_for_requests(self):
+        connections = self.lichess._session.connector.limit
+        async with asyncio.timeout(10), AsyncExitStack() as streams:
+            for i in range(connections + 2):
+                stream = await streams.enter_async_context(self.lichess.stream(f'/api/stream/game/game{i:04d}'))
+                self.assertEqual(stream.status, 200)
+            self.assertEqual(self.fake.open_streams, connections + 2)
+            user = await self.lichess.get_json('/api/user/alice')
+            self.assertEqual(user['id'], 'alice')
+            self.assertFalse(self.lichess.breaker.is_open)
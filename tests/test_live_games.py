@@ -0,0 +1,155 @@
+import asyncio
+import logging
+import unittest
+from collections import defaultdict
+from types import SimpleNamespace
+
+from aiohttp import web
+from aiohttp.test_utils import TestServer
+
+from fake_lichess import FakeLichess, random_recordings
+from lichess import LichessClient
+from live_games import LiveGameHub
+
+GAME_STREAM = 'GET /api/stream/game/{game_id}'
+
+
+class RecordingEdits:
+    """
+    Edit scheduler that records the states submitted for every message
+    """
+
+    def __init__(self):
+        self.states: defaultdict[int, list[dict]] = defaultdict(list)
+        self.closed: list[int] = []
+
+    def submit(self, key: int, state: dict, show) -> None:
+        self.states[key].append(state)
+
+    def discard(self, key: int) -> None:
+        self.closed.append(key)
+
+    async def close(self, key: int) -> None:
+        self.closed.append(key)
+
+
+class SlowFakeLichess(FakeLichess):
+    """
+    Fake Lichess of which the stream of a game starts after a delay
+    """
+
+    game_delay = 0.0
+
+    async def _stream_game(self, request: web.Request) -> web.StreamResponse:
+        await asyncio.sleep(self.game_delay)
+        return await super()._stream_game(request)
+
+
+class FakeSession:
+    async def __aenter__(self) -> 'FakeSession':
+        return self
+
+    async def __aexit__(self, *exc) -> None:
+        pass
+
+    def add(self, row) -> None:
+        pass
+
+    async def execute(self, statement) -> None:
+        pass
+
+    async def commit(self) -> None:
+        pass
+
+
+async def until(condition, timeout: float = 5.0) -> None:
+    async with asyncio.timeout(timeout):
+        while not condition():
+            await asyncio.sleep(0.01)
+
+
+class LiveGameHubTest(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        self.logger = logging.getLogger('test.live_games')
+        # Moves about every 50ms
+        self.fake = SlowFakeLichess(random_recordings(10, move_time=1.0), speed=20, seed=0)
+        self.server = TestServer(self.fake.app())
+        await self.server.start_server()
+        self.addAsyncCleanup(self.server.close)
+        self.lichess = LichessClient(self.logger, base_url=str(self.server.make_url('')))
+        self.lichess.start()
+        self.addAsyncCleanup(self.lichess.close)
+        self.edits = RecordingEdits()
+        self.hub = LiveGameHub(self.lichess, renderer=None, edits=self.edits, sessionmaker=FakeSession,
+                               logger=self.logger, join_timeout=0.2)
+        self.addCleanup(self.hub.stop)
+
+    async def watch(self, message_id: int, flipped: bool = False):
+        game = await self.hub.join('game0001', white='White', black='Black')
+        watcher = await self.hub.add_watcher(game, SimpleNamespace(id=message_id), watcher_id=1, flipped=flipped)
+        return game, watcher
+
+    async def test_one_stream_for_all_watchers(self):
+        game, _ = await self.watch(1)
+        same_game, _ = await self.watch(2, flipped=True)
+        self.assertIs(same_game, game)
+        await until(lambda: len(self.edits.states[1]) >= 3 and len(self.edits.states[2]) >= 3)
+        self.assertEqual(self.fake.requests[GAME_STREAM], 1)
+        # Both messages are shown the same moves, from the first move after they joined
+        common = min(len(self.edits.states[1]), len(self.edits.states[2]))
+        self.assertEqual(self.edits.states[1][:common], self.edits.states[2][:common])
+
+    async def test_stops_following_without_watchers(self):
+        game, first = await self.watch(1)
+        _, second = await self.watch(2)
+        await self.hub._remove(game, first, finished=False)
+        self.assertFalse(game.ended)
+        self.assertEqual(await first.done, False)
+        await self.hub._remove(game, second, finished=False)
+        await until(lambda: game.ended and game.task.done())
+        self.assertNotIn('game0001', self.hub.games)
+        await until(lambda: self.fake.open_streams == 0)
+        # A new watcher follows the game again
+        new_game, _ = await self.watch(3)
+        self.assertIsNot(new_game, game)
+        self.assertEqual(self.fake.requests[GAME_STREAM], 2)
+
+    async def test_watchers_are_told_when_the_game_finishes(self):
+        self.fake.finished_ratio = 1.0
+        game, watcher = await self.watch(1)
+        await until(lambda: game.ended)
+        self.assertTrue(await asyncio.wait_for(watcher.done, 1))
+
+    async def test_joiners_share_the_first_state(self):
+        self.fake.game_delay = 0.15
+        first = asyncio.create_task(self.hub.join('game0001', white='White', black='Black'))
+        await asyncio.sleep(0.1)
+        second = await self.hub.join('game0001', white='White', black='Black')
+        self.assertIs(await first, second)
+        self.assertIsNotNone(second.state)
+        self.assertFalse(second.ended)
+        self.assertEqual(self.fake.requests[GAME_STREAM], 1)
+
+    async def test_no_state_within_timeout(self):
+        self.fake.game_delay = 0.5
+        with self.assertLogs(self.logger, logging.WARNING):
+            game = await self.hub.join('game0001', white='White', black='Black')
+        self.assertIsNone(game.state)
+        self.assertTrue(game.ended)
+        self.assertNotIn('game0001', self.hub.games)
+        await until(lambda: game.task.done())
+
+    async def test_stops_following_when_not_shown(self):
+        game = await self.hub.join('game0001', white='White', black='Black')
+        _, watcher = await self.watch(1)
+        await self.hub.leave(game)  # E.g. the first render timed out
+        self.assertFalse(game.ended)
+        await self.hub._remove(game, watcher, finished=False)
+        self.assertTrue(game.ended)
+        await until(lambda: game.task.done() and self.fake.open_streams == 0)
+        # Nobody else joined
+        game = await self.hub.join('game0001', white='White', black='Black')
+        await self.hub.leave(game)
+        self.assertTrue(game.ended)
+        self.assertNotIn('game0001', self.hub.games)
+        await until(lambda: game.task.done())
@@ -0,0 +1,89 @@
+import socket
+import unittest
+from types import SimpleNamespace
+from unittest import mock
+
+import aiohttp
+
+from metrics import Counter, Gauge, Histogram, MetricsServer, Registry, current_shard, interaction_shard
+
+
+class RegistryTest(unittest.TestCase):
+    def setUp(self):
+        self.registry = Registry()
+        patcher = mock.patch('metrics.REGISTRY', self.registry)  # Metrics register themselves
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_counter_and_gauge(self):
+        counter = Counter('test_requests_total', 'Requests', ('method',))
+        gauge = Gauge('test_open', 'Open connections')
+        counter.inc(method='GET', shard=1)
+        counter.inc(2, method='GET', shard=1)
+        counter.inc(method='POST', shard=0)
+        token = current_shard.set('3')
+        try:
+            gauge.set(0.5)  # Labelled with the shard of the current task
+        finally:
+            current_shard.reset(token)
+        self.assertEqual(self.registry.expose(),
+                         '# HELP test_requests_total Requests\n'
+                         '# TYPE test_requests_total counter\n'
+                         'test_requests_total{shard="1",method="GET"} 3\n'
+                         'test_requests_total{shard="0",method="POST"} 1\n'
+                         '# HELP test_open Open connections\n'
+                         '# TYPE test_open gauge\n'
+                         'test_open{shard="3"} 0.5\n')
+
+    def test_histogram(self):
+        histogram = Histogram('test_seconds', 'Latency', buckets=(0.1, 1))
+        for value in (0.05, 0.1, 0.5, 2):
+            histogram.observe(value, shard='all')
+        self.assertEqual(self.registry.expose(),
+                         '# HELP test_seconds Latency\n'
+                         '# TYPE test_seconds histogram\n'
+                         'test_seconds_bucket{shard="all",le="0.1"} 2\n'
+                         'test_seconds_bucket{shard="all",le="1"} 3\n'
+                         'test_seconds_bucket{shard="all",le="+Inf"} 4\n'
+                         'test_seconds_sum{shard="all"} 2.65\n'
+                         'test_seconds_count{shard="all"} 4\n')
+
+    def test_escaped_label_values(self):
+        counter = Counter('test_errors_total', 'Errors', ('error',))
+        counter.inc(error='a "quoted"\\path\nnext', shard='all')
+        self.assertIn('test_errors_total{shard="all",error="a \\"quoted\\"\\\\path\\nnext"} 1\n',
+                      self.registry.expose())
+
+    def test_collectors_run_before_exposure(self):
+        gauge = Gauge('test_entries', 'Entries')
+        entries = [1, 5]
+        self.registry.collectors.append(lambda: gauge.set(entries.pop(0), shard='all'))
+        self.assertIn('test_entries{shard="all"} 1\n', self.registry.expose())
+        self.assertIn('test_entries{shard="all"} 5\n', self.registry.expose())
+
+    def test_empty_metric(self):
+        Counter('test_unused_total', 'Never incremented')
+        self.assertEqual(self.registry.expose(),
+                         '# HELP test_unused_total Never incremented\n# TYPE test_unused_total counter\n')
+
+    def test_interaction_shard(self):
+        self.assertEqual(interaction_shard(SimpleNamespace(guild=SimpleNamespace(shard_id=2))), '2')
+        self.assertEqual(interaction_shard(SimpleNamespace(guild=None)), 'dm')
+
+
+class MetricsServerTest(unittest.IsolatedAsyncioTestCase):
+    async def test_metrics_endpoint(self):
+        registry = Registry()
+        with mock.patch('metrics.REGISTRY', registry):
+            Counter('test_requests_total', 'Requests').inc(shard='all')
+        with socket.socket() as s:
+            s.bind(('127.0.0.1', 0))
+            port = s.getsockname()[1]
+        server = MetricsServer('127.0.0.1', port, registry=registry)
+        await server.start()
+        self.addAsyncCleanup(server.stop)
+        async with aiohttp.ClientSession() as session:
+            async with session.get(f'http://127.0.0.1:{port}/metrics') as resp:
+                self.assertEqual(resp.status, 200)
+                self.assertEqual(resp.headers['Content-Type'], 'text/plain; version=0.0.4; charset=utf-8')
+                self.assertEqual(await resp.text(), registry.expose())
@@ -0,0 +1,52 @@
+import asyncio
+import logging
+import unittest
+from types import SimpleNamespace
+
+from prefetch import PuzzlePrefetcher
+
+
+class Source:
+    """
+    Prepares the puzzles of a generation in order, counting the calls
+    """
+
+    def __init__(self, puzzles: list[SimpleNamespace]):
+        self.puzzles = puzzles
+        self.calls = 0
+
+    async def __call__(self, key) -> SimpleNamespace:
+        await asyncio.sleep(0)
+        puzzle = self.puzzles[self.calls % len(self.puzzles)]
+        self.calls += 1
+        return SimpleNamespace(puzzle=puzzle)
+
+
+async def settle(prefetcher: PuzzlePrefetcher) -> None:
+    while prefetcher._refills:
+        await asyncio.sleep(0)
+
+
+class PuzzlePrefetcherTest(unittest.IsolatedAsyncioTestCase):
+    def setUp(self):
+        self.prefetcher = PuzzlePrefetcher(size=2, max_buckets=4, logger=logging.getLogger('test.prefetch'))
+        self.addCleanup(self.prefetcher.stop)
+
+    async def test_skips_retired_puzzles(self):
+        self.prefetcher.source = Source([SimpleNamespace(puzzle_id='a', retired=True),
+                                         SimpleNamespace(puzzle_id='b', retired=False)])
+        self.prefetcher.refill((None, None))
+        await settle(self.prefetcher)
+        self.assertEqual(self.prefetcher.pop((None, None)).puzzle.puzzle_id, 'b')
+        self.assertEqual(self.prefetcher.pop((None, None)).puzzle.puzzle_id, 'b')
+
+    async def test_clear_refills_from_the_new_generation(self):
+        self.prefetcher.source = Source([SimpleNamespace(puzzle_id='old', retired=False)])
+        for key in ((None, None), (15, 'fork')):
+            self.prefetcher.refill(key)
+        await settle(self.prefetcher)
+        self.prefetcher.source = Source([SimpleNamespace(puzzle_id='new', retired=False)])
+        self.prefetcher.clear()
+        await settle(self.prefetcher)
+        for key in ((None, None), (15, 'fork')):
+            self.assertEqual([self.prefetcher.pop(key).puzzle.puzzle_id for _ in range(2)], ['new', 'new'])
@@ -0,0 +1,92 @@
+import os
+import tempfile
+import unittest
+
+import numpy as np
+import pandas as pd
+
+from puzzle_index import PuzzleIndex, PuzzleIndexWriter
+from themes import THEME_BITS
+
+FORK, PIN, MATE = THEME_BITS['fork'], THEME_BITS['pin'], THEME_BITS['mate']
+
+
+def puzzles(start: int, ratings: list[int], masks: list[int]) -> pd.DataFrame:
+    return pd.DataFrame({
+        'puzzle_id': [f'p{start + i:04d}' for i in range(len(ratings))],
+        'rating': ratings,
+        'popularity': 90,
+        'nr_plays': 100,
+        'themes_mask': masks,
+        'opening_family': [None if i % 2 else 'Sicilian_Defense' for i in range(len(ratings))],
+    })
+
+
+class PuzzleIndexTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.addCleanup(self.directory.cleanup)
+        rng = np.random.default_rng(0)
+        self.ratings = rng.integers(1000, 1100, size=500).tolist()
+        self.masks = rng.choice([0, FORK, PIN, FORK | PIN, FORK | MATE], size=500).tolist()
+        writer = PuzzleIndexWriter()
+        writer.add(puzzles(0, self.ratings[:200], self.masks[:200]))
+        writer.add(puzzles(200, self.ratings[200:], self.masks[200:]))
+        writer.write(self.directory.name)
+        self.index = PuzzleIndex.load(self.directory.name)
+        self.by_id = {f'p{i:04d}': (rating, mask) for i, (rating, mask) in enumerate(zip(self.ratings, self.masks))}
+
+    def test_sorted_by_rating(self):
+        self.assertEqual(len(self.index), 500)
+        self.assertTrue(np.all(np.diff(self.index.rating) >= 0))
+        for puzzle_id, rating in zip(self.index.puzzle_id, self.index.rating):
+            self.assertEqual(self.by_id[puzzle_id.decode()][0], rating)
+
+    def test_rating_slice(self):
+        window = self.index.rating_slice(1020, 1040)
+        self.assertEqual(window.stop - window.start, sum(1020 <= rating <= 1040 for rating in self.ratings))
+        self.assertTrue(np.all((self.index.rating[window] >= 1020) & (self.index.rating[window] <= 1040)))
+        self.assertEqual(self.index.rating_slice(), slice(0, 500))
+        empty = self.index.rating_slice(1050, 1040)
+        self.assertEqual(empty.start, empty.stop)
+
+    def test_sample(self):
+        cases = [(None, None, 0, 0), (1020, 1040, 0, 0), (1020, 1040, FORK, 0), (None, None, PIN, 0),
+                 (1000, 1050, FORK, MATE), (None, 1030, FORK | PIN, 0)]
+        for rating_from, rating_to, themes_all, themes_none in cases:
+            with self.subTest(rating_from=rating_from, rating_to=rating_to, themes_all=themes_all,
+                              themes_none=themes_none):
+                for _ in range(50):
+                    rating, mask = self.by_id[self.index.sample(rating_from, rating_to, themes_all, themes_none)]
+                    self.assertTrue(rating_from is None or rating >= rating_from)
+                    self.assertTrue(rating_to is None or rating <= rating_to)
+                    self.assertEqual(mask & themes_all, themes_all)
+                    self.assertEqual(mask & themes_none, 0)
+
+    def test_sample_single_theme_is_uniform(self):
+        expected = {puzzle_id for puzzle_id, (rating, mask) in self.by_id.items()
+                    if mask & PIN and 1030 <= rating <= 1060}
+        seen = {self.index.sample(1030, 1060, PIN) for _ in range(3000)}
+        self.assertEqual(seen, expected)
+
+    def test_sample_no_match(self):
+        self.assertIsNone(self.index.sample(2000, 2100))
+        self.assertIsNone(self.index.sample(themes_all=THEME_BITS['zugzwang']))
+        self.assertIsNone(self.index.sample(themes_all=MATE, themes_none=FORK))
+
+    def test_write_replaces_generation(self):
+        old = PuzzleIndex.current_generation(self.directory.name)
+        os.symlink(old, os.path.join(self.directory.name, 'current.tmp'))  # Left behind by an interrupted write
+        writer = PuzzleIndexWriter()
+        writer.add(puzzles(0, [1500], [FORK]))
+        path = writer.write(self.directory.name)
+        self.assertEqual(PuzzleIndex.current_generation(self.directory.name), os.path.basename(path))
+        self.assertEqual(sorted(os.listdir(self.directory.name)), sorted(['current', os.path.basename(path)]))
+        index = PuzzleIndex.load(self.directory.name)
+        self.assertEqual(index.sample(themes_all=FORK), 'p0000')
+        self.assertEqual(index.openings, ['Sicilian_Defense'])
+
+    def test_load_missing(self):
+        with tempfile.TemporaryDirectory() as directory:
+            self.assertIsNone(PuzzleIndex.load(directory))
+            self.assertIsNone(PuzzleIndex.current_generation(directory))
@@ -0,0 +1,98 @@
+import logging
+import unittest
+from types import SimpleNamespace
+
+from aiohttp.test_utils import TestServer
+from sqlalchemy.dialects import postgresql
+
+from fake_lichess import FakeLichess, random_recordings
+from lichess import LichessClient
+from rating_refresher import RatingRefresher
+
+USERS = 'POST /api/users'
+
+
+class FakeSession:
+    """
+    Session that records the SQL of the executed statements
+    """
+
+    def __init__(self, statements: list[str]):
+        self.statements = statements
+
+    async def __aenter__(self) -> 'FakeSession':
+        return self
+
+    async def __aexit__(self, *exc) -> None:
+        pass
+
+    async def execute(self, statement) -> SimpleNamespace:
+        self.statements.append(str(statement.compile(dialect=postgresql.dialect(),
+                                                     compile_kwargs={'literal_binds': True})))
+        return SimpleNamespace(rowcount=0)
+
+    async def commit(self) -> None:
+        pass
+
+
+def puzzle_rating(username: str) -> int:
+    return FakeLichess.make_user(username)['perfs']['puzzle']['rating']
+
+
+class RatingRefresherTest(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        self.logger = logging.getLogger('test.rating_refresher')
+        self.fake = FakeLichess(random_recordings(1, move_time=1.0), seed=0)
+        self.server = TestServer(self.fake.app())
+        await self.server.start_server()
+        self.addAsyncCleanup(self.server.close)
+        self.lichess = LichessClient(self.logger, base_url=str(self.server.make_url('')), retries=0)
+        self.lichess.start()
+        self.addAsyncCleanup(self.lichess.close)
+        self.statements: list[str] = []
+        self.refresher = RatingRefresher(self.lichess, lambda: FakeSession(self.statements), self.logger,
+                                         interval=60, min_interval=60)
+
+    async def test_marked_users_are_fetched_in_batches(self):
+        usernames = [f'user{i}' for i in range(301)]
+        for username in usernames:
+            self.refresher.mark(username)
+        self.refresher.mark('USER0')
+        await self.refresher.flush()
+        self.assertEqual(self.fake.requests[USERS], 2)
+        self.assertEqual(len(self.statements), 1)
+        for username in ('user0', 'user150', 'user300'):
+            self.assertIn(f"('{username}', {puzzle_rating(username)})", self.statements[0])
+
+    async def test_recently_refreshed_users_are_not_fetched(self):
+        self.refresher.mark('alice')
+        await self.refresher.flush()
+        self.refresher.mark('Alice')
+        await self.refresher.flush()
+        self.assertEqual(self.fake.requests[USERS], 1)
+        self.assertEqual(len(self.statements), 1)
+
+    async def test_observed_ratings_are_written_without_fetching(self):
+        self.refresher.mark('bob')
+        self.refresher.observe('Bob', 1234)
+        self.refresher.observe('carol', None)  # Never played puzzles
+        await self.refresher.flush()
+        self.assertEqual(self.fake.requests[USERS], 0)
+        self.assertEqual(len(self.statements), 1)
+        self.assertIn("('bob', 1234)", self.statements[0])
+        self.assertNotIn('carol', self.statements[0])
+
+    async def test_failed_users_are_fetched_again(self):
+        self.fake.faults.errors = 1.0
+        self.refresher.mark('dave')
+        with self.assertLogs(self.logger, logging.WARNING):
+            await self.refresher.flush()
+        self.assertEqual(self.statements, [])
+        self.fake.faults.errors = 0.0
+        await self.refresher.flush()
+        self.assertIn(f"('dave', {puzzle_rating('dave')})", self.statements[0])
+
+    async def test_nothing_to_refresh(self):
+        await self.refresher.flush()
+        self.assertEqual(self.fake.requests[USERS], 0)
+        self.assertEqual(self.statements, [])
@@ -0,0 +1,90 @@
+import asyncio
+import gc
+import threading
+import time
+import unittest
+from concurrent.futures import ThreadPoolExecutor
+
+import chess
+
+from rendering import BoardRenderCache, RenderService, RenderTimeoutError, render_key
+
+
+class SlowRender:
+    """
+    Render function that takes the given number of seconds, counting the calls
+    """
+
+    def __init__(self, seconds: float):
+        self.seconds = seconds
+        self.calls = 0
+        self._lock = threading.Lock()
+
+    def __call__(self, key) -> bytes:
+        with self._lock:
+            self.calls += 1
+        time.sleep(self.seconds)
+        return key[0].encode()
+
+
+class FailingRender(SlowRender):
+    def __call__(self, key) -> bytes:
+        super().__call__(key)
+        raise ValueError('Cannot render')
+
+
+class RenderServiceTest(unittest.IsolatedAsyncioTestCase):
+    def service(self, seconds: float, max_workers: int = 1, max_queue: int = 0,
+                timeout: float = 1.0) -> tuple[RenderService, SlowRender]:
+        service = RenderService(BoardRenderCache(max_bytes=1024), max_workers=max_workers, max_queue=max_queue,
+                                timeout=timeout)
+        # Threads instead of worker processes, which cannot run a render function of the test
+        service.render_function = render = SlowRender(seconds)
+        service._executor = ThreadPoolExecutor(max_workers=max_workers)
+        self.addCleanup(service._executor.shutdown)
+        return service, render
+
+    async def test_concurrent_requests_share_a_render(self):
+        service, render = self.service(0.1)
+        key = render_key(chess.BaseBoard())
+        pngs = await asyncio.gather(*(service.render(key) for _ in range(5)))
+        self.assertEqual(pngs, [key[0].encode()] * 5)
+        self.assertEqual(render.calls, 1)
+        self.assertEqual(service.queued, 0)
+        # Later requests are served from the cache
+        self.assertEqual(await service.render(key), key[0].encode())
+        self.assertEqual(render.calls, 1)
+        self.assertEqual(service.cache.hits, 1)
+
+    async def test_timeout(self):
+        service, render = self.service(0.3, timeout=0.1)
+        key = render_key(chess.BaseBoard())
+        with self.assertRaises(RenderTimeoutError):
+            await service.render(key)
+        # The job keeps running, and its result is cached for the next request
+        await asyncio.sleep(0.3)
+        self.assertEqual(service.queued, 0)
+        self.assertEqual(await service.render(key), key[0].encode())
+        self.assertEqual(render.calls, 1)
+
+    async def test_waiting_for_a_slot_does_not_count_towards_timeout(self):
+        service, render = self.service(0.1, timeout=0.15)
+        keys = [render_key(chess.BaseBoard(), flipped=flipped) for flipped in (False, True)]
+        # The second render waits 0.1s for the only worker before it is rendered within its timeout
+        pngs = await asyncio.gather(*(service.render(key) for key in keys))
+        self.assertEqual(pngs, [key[0].encode() for key in keys])
+        self.assertEqual(render.calls, 2)
+
+    async def test_error_without_callers(self):
+        service, _ = self.service(0.1)
+        service.render_function = render = FailingRender(0.1)
+        unhandled = []
+        asyncio.get_running_loop().set_exception_handler(lambda loop, context: unhandled.append(context))
+        caller = asyncio.create_task(service.render(render_key(chess.BaseBoard())))
+        await asyncio.sleep(0.05)
+        caller.cancel()
+        await asyncio.sleep(0.1)
+        self.assertEqual((render.calls, service.queued), (1, 0))
+        del caller  # Its traceback refers to the job
+        gc.collect()  # An unretrieved error of the job is reported when the job is collected
+        self.assertEqual(unhandled, [])
@@ -0,0 +1,81 @@
+import unittest
+
+from solution import AnswerTable, SolutionLine, spelling_key
+
+# Scholar's mate: black plays 3... Nf6 and white mates with 4. Qxf7#
+SCHOLARS_MATE = 'r1bqkbnr/pppp1ppp/2n5/4p2Q/2B1P3/8/PPPP1PPP/RNB1K1NR b KQkq - 3 3'
+# Both the bishop and the b-pawn can capture on c4
+BISHOP_OR_PAWN = '4k3/8/8/8/2n5/1P6/8/4KB2 w - - 0 1'
+
+
+class SolutionLineTest(unittest.TestCase):
+    def setUp(self):
+        self.line = SolutionLine(SCHOLARS_MATE, ['g8f6', 'h5f7'])
+
+    def test_plies(self):
+        self.assertEqual(len(self.line), 2)
+        self.assertEqual(self.line.color, 'white')
+        self.assertEqual(self.line.san, ['Nf6', 'Qxf7#'])
+        self.assertEqual(self.line.uci, ['g8f6', 'h5f7'])
+        self.assertEqual(self.line.hint_pieces, ['knight', 'queen'])
+        self.assertEqual(len(self.line.fens), 3)
+        self.assertEqual(self.line.fens[0], SCHOLARS_MATE)
+
+    def test_ply(self):
+        self.assertEqual(self.line.ply(2), 0)
+        self.assertEqual(self.line.ply(1), 1)
+
+    def test_board_fen(self):
+        self.assertEqual(self.line.board_fen(0), SCHOLARS_MATE.split(' ')[0])
+        self.assertEqual(self.line.board_fen(2), 'r1bqkb1r/pppp1Qpp/2n2n2/4p3/2B1P3/8/PPPP1PPP/RNB1K1NR')
+
+    def test_answer_table_is_cached(self):
+        self.assertIs(self.line.answer_table(1), self.line.answer_table(1))
+        self.assertIn('h5f7', self.line.answer_table(1).mates)
+
+    def test_color_black(self):
+        line = SolutionLine('rnbqkbnr/pppppppp/8/8/8/8/PPPPPPPP/RNBQKBNR w KQkq - 0 1', ['e2e4', 'e7e5'])
+        self.assertEqual(line.color, 'black')
+        self.assertEqual(line.hint_pieces, ['pawn', 'pawn'])
+
+
+class AnswerTableTest(unittest.TestCase):
+    def test_spelling_key(self):
+        self.assertEqual(spelling_key(' Qh5xf7# '), 'Qh5f7')
+        self.assertEqual(spelling_key('QXF7+'), 'QF7')
+        self.assertEqual(spelling_key('e8=Q!?'), 'e8Q')
+        self.assertEqual(spelling_key('0-0-0'), 'OOO')
+
+    def test_match_spellings(self):
+        table = AnswerTable(SolutionLine(SCHOLARS_MATE, ['g8f6']).fens[1])
+        for answer in ('Qxf7#', 'Qxf7', 'Qf7', 'qxf7', 'QXF7', 'h5f7', 'H5F7', 'Qh5-f7', 'Qh5xf7#', 'qh5f7'):
+            with self.subTest(answer=answer):
+                self.assertEqual(table.match(answer), 'h5f7')
+        self.assertEqual(table.mates, {'h5f7'})
+        table = AnswerTable('4k3/8/8/4p3/8/5N2/8/4K3 w - - 0 1')
+        for answer in ('Nxe5', 'NXE5', 'nxe5', 'Ne5', 'Nf3-e5', 'f3e5'):
+            with self.subTest(answer=answer):
+                self.assertEqual(table.match(answer), 'f3e5')
+
+    def test_match_illegal(self):
+        table = AnswerTable(SCHOLARS_MATE)
+        for answer in ('Qxf7', 'e4e5', 'Ke2', '', 'hello', 'O-O'):
+            with self.subTest(answer=answer):
+                self.assertIsNone(table.match(answer))
+
+    def test_match_ambiguous_case(self):
+        table = AnswerTable(BISHOP_OR_PAWN)
+        self.assertEqual(table.match('Bc4'), 'f1c4')
+        self.assertEqual(table.match('bxc4'), 'b3c4')
+        self.assertEqual(table.match('bc4'), 'b3c4')
+        self.assertEqual(table.match('bc4', preferred='f1c4'), 'f1c4')
+        self.assertEqual(table.match('BXC4', preferred='b3c4'), 'b3c4')
+        self.assertEqual(table.match('Bc4', preferred='e1d1'), 'f1c4')
+
+    def test_match_promotion_and_castling(self):
+        table = AnswerTable('4k3/P7/8/8/8/8/8/R3K3 w Q - 0 1')
+        self.assertEqual(table.match('a8=Q+'), 'a7a8q')
+        self.assertEqual(table.match('a8Q'), 'a7a8q')
+        self.assertEqual(table.match('a7a8n'), 'a7a8n')
+        self.assertEqual(table.match('0-0-0'), 'e1c1')
+        self.assertEqual(table.match('O-O-O'), 'e1c1')
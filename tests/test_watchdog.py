@@ -0,0 +1,39 @@
+import asyncio
+import logging
+import time
+import unittest
+
+from metrics import LOOP_BLOCKS
+from watchdog import LoopWatchdog
+
+
+def blocks_total() -> float:
+    return LOOP_BLOCKS._values.get(('all',), 0)
+
+
+class LoopWatchdogTest(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        self.logger = logging.getLogger('test.watchdog')
+        self.watchdog = LoopWatchdog(self.logger, interval=0.01, threshold=0.1)
+        self.watchdog.start()
+        self.addCleanup(self.watchdog.stop)
+        await asyncio.sleep(0.05)
+
+    async def test_block_is_reported_once(self):
+        before = blocks_total()
+        with self.assertLogs(self.logger, level=logging.WARNING) as logs:
+            time.sleep(0.4)  # Blocks the event loop
+            await asyncio.sleep(0.05)
+        self.assertEqual(self.watchdog.blocks, 1)
+        self.assertEqual(len(logs.records), 1)
+        self.assertIn('test_block_is_reported_once', logs.output[0])
+        # Counted on the loop's thread once the loop ran again
+        self.assertEqual(blocks_total(), before + 1)
+        self.assertGreaterEqual(self.watchdog.stats()['lag_max'], 0.3)
+
+    async def test_no_block(self):
+        before = blocks_total()
+        await asyncio.sleep(0.2)
+        self.assertEqual(self.watchdog.blocks, 0)
+        self.assertEqual(blocks_total(), before)
+        self.assertGreater(self.watchdog.measurements, 0)
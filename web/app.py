@@ -14,6 +14,8 @@ sys.path.append(os.getenv('BASE_DIR'))
 from bot.database import APIChallenge, User
 
 
+LICHESS_URL = os.getenv('LICHESS_URL', 'https://lichess.org').rstrip('/')
+
 app = Flask(__name__)
 app.config['SERVER_NAME'] = 'lichess.' + os.getenv('FQDN')
 
@@ -48,7 +50,7 @@ def callback():
             return flask.render_template('expired.html')
 
         # Get OAuth token
-        resp = requests.post(url='https://lichess.org/api/token',
+        resp = requests.post(url=f'{LICHESS_URL}/api/token',
                              json={
                                  'grant_type': 'authorization_code',
                                  'code': code,
@@ -63,7 +65,7 @@ def callback():
         content = resp.json()
 
         # Check connected user data
-        resp = requests.get(url='https://lichess.org/api/account',
+        resp = requests.get(url=f'{LICHESS_URL}/api/account',
                             headers={'Authorization': f'Bearer {content["access_token"]}'})
         try:
             resp.raise_for_status()